@@ -0,0 +1,349 @@
+# action_events.py - Per-session avatar action event stream (Server-Sent Events)
+#
+# Avatar pages subscribe to /action_events once per page load. While the patient
+# reply is being generated, ActionStream runs the ActionMapper patterns over the
+# text produced so far and publishes each detected action together with the word
+# offset at which it should fire, so animations start in sync with the reply
+# instead of after the full /send_message round trip.
+#
+# The subscription and the /send_message calls that feed it can be served by
+# different gunicorn workers, so events and subscriber leases are kept in a
+# sqlite database on local disk shared by every worker (WAL, as in
+# shared_cache.py). A publisher wakes the readers in its own worker at once;
+# readers in other workers pick new events up within ACTION_POLL_INTERVAL.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from action_mapper import action_mapper
+from end_detector import end_detector
+from shared_cache import _os_thread_local
+
+# Events kept per session; a slow subscriber that falls further behind than
+# this loses the oldest events and is told how many it missed.
+ACTION_QUEUE_SIZE = 32
+# Seconds between SSE keep-alive comments on an idle stream
+KEEPALIVE_INTERVAL = 15
+# Channels (and their stored events) are dropped after this many idle seconds
+CHANNEL_IDLE_TIMEOUT = 600
+# Seconds between reads of the shared log while a subscriber waits for events
+ACTION_POLL_INTERVAL = 0.1
+# A subscriber lease lapses when its stream has not renewed it for this long
+SUBSCRIBER_TTL = 2 * KEEPALIVE_INTERVAL
+# Drop idle conversations from the shared log every this many published events
+PRUNE_EVERY = 500
+# Characters of already-scanned text re-read on each chunk, so that a phrase
+# split across chunks ("short" + "ness of breath") is still matched
+STREAM_LOOKBACK = 48
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS action_sequences (
+    conversation_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS action_events (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+);
+CREATE TABLE IF NOT EXISTS action_subscribers (
+    conversation_id TEXT NOT NULL,
+    subscriber TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (conversation_id, subscriber)
+);
+"""
+
+
+class SharedActionLog:
+    """Bounded per-conversation event log and subscriber leases, shared by all workers on the node"""
+
+    def __init__(self, path: str, maxlen: int = ACTION_QUEUE_SIZE):
+        self.path = path
+        self.maxlen = maxlen
+        self._local = _os_thread_local()
+        self._appends = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # One connection per thread and per process, as in SharedCache._db
+        db = getattr(self._local, 'db', None)
+        if db is not None and self._local.pid == os.getpid():
+            return db
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(_SCHEMA)
+        self._local.db = db
+        self._local.pid = os.getpid()
+        return db
+
+    def append(self, conversation_id: str, event_type: str, data: Dict) -> int:
+        """Store an event, evicting the oldest beyond maxlen; returns its sequence number"""
+        db = self._db()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('INSERT INTO action_sequences (conversation_id, seq, updated) VALUES (?, 1, ?) '
+                       'ON CONFLICT(conversation_id) DO UPDATE SET seq = seq + 1, updated = excluded.updated',
+                       (conversation_id, now))
+            seq = db.execute('SELECT seq FROM action_sequences WHERE conversation_id = ?', (conversation_id,)).fetchone()[0]
+            db.execute('INSERT INTO action_events (conversation_id, seq, type, data) VALUES (?, ?, ?, ?)',
+                       (conversation_id, seq, event_type, json.dumps(data, separators=(',', ':'))))
+            db.execute('DELETE FROM action_events WHERE conversation_id = ? AND seq <= ?', (conversation_id, seq - self.maxlen))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        self._appends += 1
+        if self._appends % PRUNE_EVERY == 0:
+            self.prune(now)
+        return seq
+
+    def read(self, conversation_id: str, after_seq: int) -> Tuple[List[Tuple[int, str, Dict]], int]:
+        """Events newer than `after_seq`, and the oldest sequence number still stored (0 if none)"""
+        db = self._db()
+        rows = db.execute('SELECT seq, type, data FROM action_events WHERE conversation_id = ? AND seq > ? ORDER BY seq',
+                          (conversation_id, after_seq)).fetchall()
+        oldest = db.execute('SELECT MIN(seq) FROM action_events WHERE conversation_id = ?', (conversation_id,)).fetchone()[0]
+        return [(seq, event_type, json.loads(data)) for seq, event_type, data in rows], oldest or 0
+
+    def last_seq(self, conversation_id: str) -> int:
+        row = self._db().execute('SELECT seq FROM action_sequences WHERE conversation_id = ?', (conversation_id,)).fetchone()
+        return row[0] if row else 0
+
+    def clear(self, conversation_id: str) -> int:
+        """Drop stored events; the sequence keeps counting so subscribers don't rewind"""
+        return self._db().execute('DELETE FROM action_events WHERE conversation_id = ?', (conversation_id,)).rowcount
+
+    def renew(self, conversation_id: str, subscriber: str, ttl: float = SUBSCRIBER_TTL):
+        self._db().execute('INSERT OR REPLACE INTO action_subscribers (conversation_id, subscriber, expires) VALUES (?, ?, ?)',
+                           (conversation_id, subscriber, time.time() + ttl))
+
+    def leave(self, conversation_id: str, subscriber: str):
+        self._db().execute('DELETE FROM action_subscribers WHERE conversation_id = ? AND subscriber = ?',
+                           (conversation_id, subscriber))
+
+    def has_subscribers(self, conversation_id: str) -> bool:
+        row = self._db().execute('SELECT 1 FROM action_subscribers WHERE conversation_id = ? AND expires > ? LIMIT 1',
+                                 (conversation_id, time.time())).fetchone()
+        return row is not None
+
+    def prune(self, now: Optional[float] = None):
+        """Forget conversations idle for CHANNEL_IDLE_TIMEOUT and lapsed subscriber leases"""
+        now = now or time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            idle = now - CHANNEL_IDLE_TIMEOUT
+            db.execute('DELETE FROM action_events WHERE conversation_id IN '
+                       '(SELECT conversation_id FROM action_sequences WHERE updated < ?)', (idle,))
+            db.execute('DELETE FROM action_sequences WHERE updated < ?', (idle,))
+            db.execute('DELETE FROM action_subscribers WHERE expires < ?', (now,))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+
+class ActionChannel:
+    """One conversation's events in the shared log, with blocking reads"""
+
+    def __init__(self, log: SharedActionLog, conversation_id: str):
+        self.log = log
+        self.conversation_id = conversation_id
+        self.cond = threading.Condition()  # wakes this worker's readers on a local publish
+        self.subscribers = 0
+        self.last_active = time.monotonic()
+
+    def publish(self, event_type: str, data: Dict):
+        try:
+            self.log.append(self.conversation_id, event_type, data)
+        except sqlite3.Error as e:
+            # Animations are best-effort; the /send_message reply still lists the actions
+            print(f"[ActionEvents] Publish failed: {e}")
+            return
+        with self.cond:
+            self.last_active = time.monotonic()
+            self.cond.notify_all()
+
+    def clear(self) -> int:
+        """Drop queued events (the avatar's 'Clear Queue' button); returns how many"""
+        try:
+            return self.log.clear(self.conversation_id)
+        except sqlite3.Error as e:
+            print(f"[ActionEvents] Clear failed: {e}")
+            return 0
+
+    def read(self, after_id: int, timeout: float) -> Tuple[List[Tuple[int, str, Dict]], int]:
+        """
+        Wait up to `timeout` for events newer than `after_id`.
+        Returns (events, missed) where `missed` counts events that were
+        evicted before this reader got to them.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                events, oldest = self.log.read(self.conversation_id, after_id)
+            except sqlite3.Error as e:
+                print(f"[ActionEvents] Read failed: {e}")
+                events, oldest = [], 0
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                missed = max(0, oldest - after_id - 1) if after_id and oldest else 0
+                return events, missed
+            with self.cond:
+                self.cond.wait(min(remaining, ACTION_POLL_INTERVAL))
+
+    def sse_stream(self, last_event_id: int = 0):
+        """Generator of SSE frames for one subscriber"""
+        subscriber = uuid.uuid4().hex
+        with self.cond:
+            self.subscribers += 1
+        renewed = 0.0
+        try:
+            # New subscribers start from now; reconnects resume via Last-Event-ID
+            after_id = last_event_id or self.log.last_seq(self.conversation_id)
+            yield "retry: 3000\n\n"
+            while True:
+                if time.monotonic() - renewed > KEEPALIVE_INTERVAL / 2:
+                    # Lease read by /send_message in whichever worker serves it
+                    self.log.renew(self.conversation_id, subscriber)
+                    renewed = time.monotonic()
+                events, missed = self.read(after_id, KEEPALIVE_INTERVAL)
+                if missed:
+                    yield format_sse('overflow', {'missed': missed})
+                if not events:
+                    yield ": keepalive\n\n"
+                    continue
+                for event_id, event_type, data in events:
+                    yield format_sse(event_type, data, event_id)
+                    after_id = event_id
+        finally:
+            with self.cond:
+                self.subscribers -= 1
+                self.last_active = time.monotonic()
+            try:
+                self.log.leave(self.conversation_id, subscriber)
+            except sqlite3.Error:
+                pass  # the lease lapses after SUBSCRIBER_TTL
+
+
+def format_sse(event_type: str, data: Dict, event_id: Optional[int] = None) -> str:
+    frame = f"event: {event_type}\n"
+    if event_id is not None:
+        frame += f"id: {event_id}\n"
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+
+class ActionChannelRegistry:
+    def __init__(self, path: str):
+        self.log = SharedActionLog(path)
+        self._channels: Dict[str, ActionChannel] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, conversation_id: str) -> ActionChannel:
+        """Get or create the channel for a conversation (called by /action_events)"""
+        with self._lock:
+            self._evict_idle()
+            channel = self._channels.get(conversation_id)
+            if channel is None:
+                channel = self._channels[conversation_id] = ActionChannel(self.log, conversation_id)
+            return channel
+
+    def get(self, conversation_id: str) -> Optional[ActionChannel]:
+        """Channel for a conversation, or None when no worker has a subscriber for it"""
+        try:
+            listening = self.log.has_subscribers(conversation_id)
+        except sqlite3.Error as e:
+            print(f"[ActionEvents] Subscriber lookup failed: {e}")
+            return None
+        return self.subscribe(conversation_id) if listening else None
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        for cid, channel in list(self._channels.items()):
+            if channel.subscribers == 0 and now - channel.last_active > CHANNEL_IDLE_TIMEOUT:
+                del self._channels[cid]
+
+
+class ActionStream:
+    """
+    Incremental action detection over a reply that arrives in chunks.
+    Used as the stream handler for get_patient_response: start() on every
+    attempt, feed() for each text delta, finish() with the final reply.
+    With patient_data, the stream is also watched for the closing phrase once
+    the diagnosis has been given and end_detected is published as soon as it
+    arrives, ahead of reply_end.
+    """
+
+    def __init__(self, channel: ActionChannel, patient_data=None):
+        self.channel = channel
+        self.patient_data = patient_data
+        self.reply_id = 0
+        self._reset()
+
+    def _reset(self):
+        self.text = ''
+        self.scanned_to = 0
+        self.fired = {}
+        self.end_scan = end_detector.stream()
+
+    def start(self):
+        self._reset()
+        self.reply_id += 1
+        self.channel.publish('reply_start', {'reply_id': self.reply_id})
+
+    def feed(self, chunk: str):
+        self.text += chunk
+        if not self.end_scan.ended and self.end_scan.feed(chunk) and self._watch_end():
+            self.channel.publish('end_detected', {'reply_id': self.reply_id, 'end_rule': self.end_scan.rule})
+        # Only scan up to the last word boundary: a trailing partial word
+        # ("hand" of "handle") must not fire yet
+        settled = len(self.text)
+        while settled and (self.text[settled - 1].isalnum() or self.text[settled - 1] in "-'"):
+            settled -= 1
+        self._scan(settled)
+
+    def _watch_end(self) -> bool:
+        return self.patient_data is not None and bool(self.patient_data.get('diagnosis_given'))
+
+    def end_rule(self, reply: str) -> Optional[str]:
+        """End rule for the final reply, reusing the streamed scan when it saw the same text"""
+        if reply.strip() == self.text.strip():
+            return self.end_scan.finish()
+        return end_detector.detect(reply)
+
+    def _scan(self, end: int):
+        if end <= self.scanned_to:
+            return
+        start = max(0, self.scanned_to - STREAM_LOOKBACK)
+        for found in action_mapper.find_actions(self.text, start, end, skip=self.fired):
+            self.fired[found['action']] = found
+            self.channel.publish('action', dict(found, reply_id=self.reply_id))
+        self.scanned_to = end
+
+    def finish(self, reply: str, **extra) -> List[Dict]:
+        """Flush detection for the full reply and publish reply_end"""
+        if reply.strip() != self.text.strip():
+            # Non-streamed reply (or the error text after retries): scan it whole
+            self.start()
+            self.text = reply
+        self._scan(len(self.text))
+        actions = sorted(self.fired.values(), key=lambda a: a['char_offset'])
+        self.channel.publish('reply_end', dict(
+            extra,
+            reply_id=self.reply_id,
+            word_count=len(self.text.split()),
+            actions=[a['action'] for a in actions],
+        ))
+        return actions
+
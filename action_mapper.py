@@ -20,6 +20,7 @@ class ActionMapper:
             'nausea': r"\b(nausea|nauseous|queasy|vomit(?:ing)?|throw(?:ing)?\s*up|retching|puking|motion\s*sickness|car\s*sick|sea\s*sick|food\s*poisoning)\b",
             'blood': r"\b(blood|bleed(?:ing)?|bloody|hematoma|laceration|bruise|bruising|cut|wound|nosebleed|coughing\s*blood|spitting\s*blood|blood\s*in\s*(stool|urine|pee|vomit))\b",
         }
+        self.compiled_patterns = {action: re.compile(pattern) for action, pattern in self.action_patterns.items()}
     
     def analyze_message(self, message: str) -> List[str]:
         """
@@ -29,8 +30,8 @@ class ActionMapper:
         detected_actions = []
         message_lower = message.lower()
         
-        for action, pattern in self.action_patterns.items():
-            if re.search(pattern, message_lower):
+        for action, pattern in self.compiled_patterns.items():
+            if pattern.search(message_lower):
                 detected_actions.append(action)
         
         # Remove duplicates within the same message but preserve order
@@ -39,6 +40,28 @@ class ActionMapper:
         print(f"[ActionMapper] Actions detected in message: {unique_actions}")
         return unique_actions
 
+    def find_actions(self, message: str, start: int = 0, end: int = None, skip=()) -> List[Dict[str, Any]]:
+        """
+        Locate the first occurrence of each action in message[start:end].
+        Returns [{'action', 'char_offset', 'word_offset'}] in the order the
+        actions appear, so animations can be fired at the matching word.
+        """
+        message_lower = message.lower()
+        end = len(message_lower) if end is None else end
+        found = []
+        for action, pattern in self.compiled_patterns.items():
+            if action in skip:
+                continue
+            match = pattern.search(message_lower, start, end)
+            if match:
+                found.append({
+                    'action': action,
+                    'char_offset': match.start(),
+                    'word_offset': len(message[:match.start()].split()),
+                })
+        found.sort(key=lambda a: a['char_offset'])
+        return found
+
 # Global instance
 action_mapper = ActionMapper()
 
@@ -0,0 +1,279 @@
+# admission.py - Admission control for LLM-bound requests
+#
+# Every /send_message turn ends in a call to the model provider. Without a limit,
+# a whole cohort arriving at once ties up every worker thread until OpenRouter
+# starts rate-limiting and everything times out. The controller here sits in front
+# of the LLM call and, per model:
+#   - caps the number of calls in flight (bounded concurrency)
+#   - queues the rest fairly: sessions take turns round-robin, so one impatient
+#     student can't starve the others
+#   - paces calls with a token bucket sized to the provider quota
+#   - rejects early with 429 (this session is already waiting) or 503 (queue full /
+#     waited too long) and a Retry-After hint instead of letting requests pile up
+
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+
+def _env_float(name, default):
+    return float(os.getenv(name, default))
+
+
+# Limits are per process; the provider quota is split across gunicorn workers.
+# gunicorn.conf.py exports its worker count as WEB_CONCURRENCY; without it
+# (flask run, tools) there is a single process.
+WORKER_COUNT = max(1, int(os.getenv('WEB_CONCURRENCY', '1')))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '4'))
+LLM_MAX_QUEUE = int(os.getenv('LLM_MAX_QUEUE', '32'))
+LLM_MAX_WAIT = _env_float('LLM_MAX_WAIT', '30')
+LLM_MAX_PENDING_PER_SESSION = int(os.getenv('LLM_MAX_PENDING_PER_SESSION', '1'))
+LLM_RATE_PER_MINUTE = _env_float('LLM_RATE_PER_MINUTE', '20')  # OpenRouter free-tier quota
+LLM_RATE_BURST = _env_float('LLM_RATE_BURST', '5')
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is not admitted; carries the HTTP status and Retry-After"""
+
+    def __init__(self, status: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def time_until_token(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1 or self.rate <= 0:
+                return 0.0 if self.tokens >= 1 else float('inf')
+            return (1 - self.tokens) / self.rate
+
+
+class _Ticket:
+    __slots__ = ('session_id', 'granted', 'enqueued_at')
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+
+class _ModelLane:
+    """Concurrency slots, fair queue, rate limiter and counters for one model"""
+
+    def __init__(self, controller: 'AdmissionController'):
+        self.controller = controller
+        self.cond = threading.Condition()
+        self.bucket = TokenBucket(controller.rate_per_second, controller.burst)
+        self.active = 0
+        self.queued = 0
+        self.rotation = deque()      # session ids with waiting tickets, round-robin order
+        self.waiting: Dict[str, deque] = {}
+        self.pending: Dict[str, int] = {}  # queued + in flight, per session
+        self.admitted = 0
+        self.rejected = {429: 0, 503: 0}
+        self.timeouts = 0
+        self.max_queue_seen = 0
+        self.total_wait = 0.0
+        self.total_service = 0.0
+        self.completed = 0
+
+    def avg_service_time(self) -> float:
+        return self.total_service / self.completed if self.completed else 10.0
+
+    def _dispatch(self):
+        """Grant waiting tickets round-robin while slots and rate tokens are available"""
+        while self.rotation and self.active < self.controller.max_concurrency:
+            if not self.bucket.try_acquire():
+                return
+            session_id = self.rotation.popleft()
+            tickets = self.waiting[session_id]
+            ticket = tickets.popleft()
+            if tickets:
+                self.rotation.append(session_id)
+            else:
+                del self.waiting[session_id]
+            ticket.granted = True
+            self.queued -= 1
+            self.active += 1
+            self.cond.notify_all()
+
+    def _drop(self, ticket):
+        tickets = self.waiting.get(ticket.session_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            self.queued -= 1
+            if not tickets:
+                del self.waiting[ticket.session_id]
+                self.rotation.remove(ticket.session_id)
+        self._release_pending(ticket.session_id)
+
+    def _release_pending(self, session_id):
+        left = self.pending.get(session_id, 1) - 1
+        if left > 0:
+            self.pending[session_id] = left
+        else:
+            self.pending.pop(session_id, None)
+
+    def acquire(self, session_id: str, max_wait: float) -> _Ticket:
+        ctl = self.controller
+        with self.cond:
+            if self.pending.get(session_id, 0) >= ctl.max_pending_per_session:
+                self.rejected[429] += 1
+                raise AdmissionRejected(429, 'A reply for this conversation is already in progress', self.avg_service_time())
+            if self.queued >= ctl.max_queue:
+                self.rejected[503] += 1
+                retry = self.avg_service_time() * (self.queued + 1) / max(1, ctl.max_concurrency)
+                raise AdmissionRejected(503, 'Server is busy, too many conversations waiting for a reply', retry)
+
+            ticket = _Ticket(session_id)
+            self.pending[session_id] = self.pending.get(session_id, 0) + 1
+            if session_id not in self.waiting:
+                self.waiting[session_id] = deque()
+                self.rotation.append(session_id)
+            self.waiting[session_id].append(ticket)
+            self.queued += 1
+            self.max_queue_seen = max(self.max_queue_seen, self.queued)
+
+            deadline = ticket.enqueued_at + max_wait
+            self._dispatch()
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._drop(ticket)
+                    self.timeouts += 1
+                    self.rejected[503] += 1
+                    retry = self.avg_service_time() * max(1, self.queued) / max(1, ctl.max_concurrency)
+                    raise AdmissionRejected(503, 'Timed out waiting for the model, please try again', retry)
+                # Slots freed by release() notify the waiters; a timeout is only
+                # needed when a slot is free and the queue waits on the next rate token
+                if self.active < ctl.max_concurrency:
+                    remaining = min(remaining, self.bucket.time_until_token())
+                self.cond.wait(remaining)
+                self._dispatch()
+
+            self.admitted += 1
+            self.total_wait += time.monotonic() - ticket.enqueued_at
+            return ticket
+
+    def release(self, ticket: _Ticket, started_at: float):
+        with self.cond:
+            self.active -= 1
+            self.completed += 1
+            self.total_service += time.monotonic() - started_at
+            self._release_pending(ticket.session_id)
+            self._dispatch()
+            self.cond.notify_all()
+
+    def stats(self) -> Dict:
+        with self.cond:
+            return {
+                'active': self.active,
+                'queue_depth': self.queued,
+                'waiting_sessions': len(self.rotation),
+                'max_queue_depth': self.max_queue_seen,
+                'admitted': self.admitted,
+                'rejected_429': self.rejected[429],
+                'rejected_503': self.rejected[503],
+                'timeouts': self.timeouts,
+                'avg_wait_seconds': round(self.total_wait / self.admitted, 3) if self.admitted else 0.0,
+                'avg_service_seconds': round(self.avg_service_time(), 3) if self.completed else None,
+                'rate_tokens_available': round(self.bucket.tokens, 2),
+            }
+
+
+class AdmissionController:
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE, max_wait=LLM_MAX_WAIT,
+                 max_pending_per_session=LLM_MAX_PENDING_PER_SESSION,
+                 rate_per_minute=LLM_RATE_PER_MINUTE / WORKER_COUNT, burst=LLM_RATE_BURST):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_pending_per_session = max_pending_per_session
+        self.rate_per_second = rate_per_minute / 60.0
+        self.burst = burst
+        self._lanes: Dict[str, _ModelLane] = {}
+        self._lock = threading.Lock()
+
+    def _lane(self, model: str) -> _ModelLane:
+        lane = self._lanes.get(model)
+        if lane is None:
+            with self._lock:
+                lane = self._lanes.setdefault(model, _ModelLane(self))
+        return lane
+
+    def admit(self, model: str, session_id: str, max_wait: Optional[float] = None) -> 'Admission':
+        """
+        Wait for a slot to call `model` on behalf of `session_id`.
+        Use as a context manager; raises AdmissionRejected when not admitted.
+        """
+        lane = self._lane(model)
+        ticket = lane.acquire(session_id or 'anonymous', self.max_wait if max_wait is None else max_wait)
+        return Admission(lane, ticket)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lanes = dict(self._lanes)
+        return {
+            'limits': {
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'max_wait_seconds': self.max_wait,
+                'max_pending_per_session': self.max_pending_per_session,
+                'rate_per_minute': round(self.rate_per_second * 60, 2),
+                'burst': self.burst,
+            },
+            'models': {model: lane.stats() for model, lane in lanes.items()},
+        }
+
+
+class Admission:
+    """A granted slot; releasing it lets the next queued session in"""
+
+    def __init__(self, lane: _ModelLane, ticket: _Ticket):
+        self._lane = lane
+        self._ticket = ticket
+        self._started_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._lane.release(self._ticket, self._started_at)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+# Global instance
+admission_controller = AdmissionController()
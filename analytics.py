@@ -0,0 +1,355 @@
+# analytics.py - Columnar (Parquet) export of the conversation and feedback logs
+#
+# Analysts used to parse the raw JSONL logs by hand. The exporter here turns
+# them into Hive-partitioned Parquet datasets with a fixed schema:
+#   analytics/conversations/date=YYYYMMDD/part-0.parquet
+#   analytics/feedback/date=YYYYMMDD/part-0.parquet
+# Rows are sorted by condition and model inside each day, so those columns are
+# run-length/dictionary encoded and filters on them skip row groups by their
+# statistics. (One directory per condition and model as well would leave
+# thousands of files of a few rows each at this traffic.)
+# Export is incremental: export_state.json records the JSONL size of every day
+# already exported, so a run only (re)writes days that are new or have grown
+# since. LogQuery reads the datasets back with partition pruning and provides
+# the common aggregates (turns per conversation, diagnosis rate, symptom
+# coverage, latency).
+
+import json
+import os
+import shutil
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from log_store import LogStore
+
+EXPORT_STATE_VERSION = 3  # 2: disclosed_symptoms, symptom_coverage, primary_coverage; 3: feedback model, personality_type
+UNKNOWN = 'unknown'
+
+# Replies that are the app's error text rather than a patient answer
+ERROR_PREFIXES = (
+    "API Error with model",
+    "Model '",
+    "I'm sorry, I'm having trouble responding",
+)
+
+CONVERSATION_SCHEMA = pa.schema([
+    ('conversation_id', pa.string()),
+    ('turn', pa.int32()),  # position of the turn within its day's log
+    ('timestamp', pa.timestamp('us')),
+    ('patient_name', pa.string()),
+    ('personality_type', pa.string()),
+    ('doctor_message', pa.string()),
+    ('patient_response', pa.string()),
+    ('response_chars', pa.int32()),
+    ('symptoms_revealed', pa.list_(pa.string())),
+    ('diagnosis_attempts', pa.int16()),
+    ('diagnosis_given', pa.bool_()),
+    ('session_end', pa.bool_()),
+    ('is_error', pa.bool_()),
+    ('latency_ms', pa.float32()),  # LLM call time; null for turns logged before it was recorded
+    ('turn_gap_seconds', pa.float32()),  # time since the previous turn of the conversation
+    # Cumulative symptom disclosure (disclosure.py); null before it was logged
+    ('disclosed_symptoms', pa.int64()),
+    ('symptom_coverage', pa.float32()),
+    ('primary_coverage', pa.float32()),
+    ('condition', pa.string()),
+    ('model', pa.string()),
+])
+CONVERSATION_SORT = [('condition', 'ascending'), ('model', 'ascending'), ('timestamp', 'ascending')]
+
+FEEDBACK_RATINGS = [
+    'authenticity_rating',
+    'educational_value_rating',
+    'interaction_quality_rating',
+    'communication_consistency_rating',
+    'symptom_realism_rating',
+]
+FEEDBACK_SCHEMA = pa.schema(
+    [('conversation_id', pa.string()), ('session_id', pa.string()), ('timestamp', pa.timestamp('us'))]
+    + [(name, pa.int8()) for name in FEEDBACK_RATINGS]
+    + [('patient_name', pa.string()), ('personality_type', pa.string()), ('additional_comments', pa.string()),
+       ('condition', pa.string()), ('model', pa.string())]
+)
+FEEDBACK_SORT = [('condition', 'ascending'), ('model', 'ascending'), ('timestamp', 'ascending')]
+# Directory partitioning shared by both datasets
+PARTITIONING = pa.schema([('date', pa.string())])
+ROW_GROUP_SIZE = 64 * 1024
+
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _read_records(store: LogStore, entry: Dict) -> Iterator[Dict]:
+    """Every JSON record of one day (plain or compressed), skipping damaged lines"""
+    data = b''.join(store.read_range(entry, 0, entry['raw_size']))
+    for line in data.splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(record, dict):
+            yield record
+
+
+def conversation_rows(records) -> Iterator[Dict]:
+    """Flatten conversation log records into CONVERSATION_SCHEMA rows"""
+    turns = {}
+    last_seen = {}
+    for record in records:
+        conversation_id = record.get('conversation_id') or UNKNOWN
+        timestamp = _parse_timestamp(record.get('timestamp'))
+        condition = record.get('condition') or UNKNOWN
+        doctor_message = record.get('doctor_message') or ''
+        patient_response = record.get('patient_response') or ''
+
+        turns[conversation_id] = turns.get(conversation_id, 0) + 1
+        previous = last_seen.get(conversation_id)
+        last_seen[conversation_id] = timestamp
+
+        diagnosis_given = record.get('diagnosis_given')
+        if diagnosis_given is None:
+            # Older records: same check the app uses, the condition named by the doctor
+            diagnosis_given = condition != UNKNOWN and condition.lower() in doctor_message.lower()
+
+        yield {
+            'conversation_id': conversation_id,
+            'turn': turns[conversation_id],
+            'timestamp': timestamp,
+            'patient_name': record.get('patient_name'),
+            # Early logs stored the persona key instead of the personality type
+            'personality_type': record.get('personality_type') or record.get('persona'),
+            'doctor_message': doctor_message,
+            'patient_response': patient_response,
+            'response_chars': len(patient_response),
+            'symptoms_revealed': [str(s) for s in record.get('symptoms_revealed') or []],
+            'diagnosis_attempts': _as_int(record.get('diagnosis_attempts')),
+            'diagnosis_given': bool(diagnosis_given),
+            'session_end': bool(record.get('session_end', False)),
+            'is_error': patient_response.startswith(ERROR_PREFIXES),
+            'latency_ms': record.get('latency_ms'),
+            'turn_gap_seconds': (timestamp - previous).total_seconds() if timestamp and previous else None,
+            'disclosed_symptoms': record.get('disclosed_symptoms'),
+            'symptom_coverage': record.get('symptom_coverage'),
+            'primary_coverage': record.get('primary_coverage'),
+            'condition': condition,
+            'model': record.get('model_name') or UNKNOWN,
+        }
+
+
+def feedback_rows(records) -> Iterator[Dict]:
+    """Flatten feedback submissions into FEEDBACK_SCHEMA rows"""
+    for record in records:
+        # `patient` is the compact reference newer records carry instead of patient_data
+        patient_data = record.get('patient') or record.get('patient_data') or {}
+        row = {
+            'conversation_id': record.get('conversation_id'),
+            'session_id': record.get('session_id'),
+            'timestamp': _parse_timestamp(record.get('timestamp')),
+            'patient_name': patient_data.get('name'),
+            'personality_type': patient_data.get('personality_type') or UNKNOWN,
+            'additional_comments': record.get('additional_comments'),
+            'condition': patient_data.get('condition') or patient_data.get('condition_name') or UNKNOWN,
+            'model': record.get('model_name') or UNKNOWN,
+        }
+        for name in FEEDBACK_RATINGS:
+            row[name] = _as_int(record.get(name))
+        yield row
+
+
+class ParquetExporter:
+    """Incrementally exports one LogStore into a partitioned Parquet dataset"""
+
+    def __init__(self, store: LogStore, output_dir: str, schema: pa.Schema, sort_by: List, to_rows):
+        self.store = store
+        self.output_dir = output_dir
+        self.schema = schema
+        self.sort_by = sort_by
+        self.to_rows = to_rows
+        self.state_path = os.path.join(output_dir, 'export_state.json')
+
+    def _load_state(self) -> Dict:
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('version') == EXPORT_STATE_VERSION:
+                return state
+        except (OSError, ValueError):
+            pass
+        return {'version': EXPORT_STATE_VERSION, 'days': {}}
+
+    def _save_state(self, state: Dict):
+        tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def pending_days(self) -> List[Dict]:
+        """Days whose JSONL changed since the last export"""
+        exported = self._load_state()['days']
+        return [e for e in self.store.days() if exported.get(e['day'], {}).get('raw_size') != e['raw_size']]
+
+    def export_day(self, entry: Dict) -> int:
+        """Rewrite the date=<day> partition from the day's log; returns the row count"""
+        rows = list(self.to_rows(_read_records(self.store, entry)))
+        day_dir = os.path.join(self.output_dir, f"date={entry['day']}")
+        # Dot-prefixed so readers skip a partition that is still being written
+        tmp_dir = os.path.join(self.output_dir, f".date={entry['day']}.{os.getpid()}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if rows:
+            os.makedirs(tmp_dir)
+            table = pa.Table.from_pylist(rows, schema=self.schema).sort_by(self.sort_by)
+            pq.write_table(
+                table, os.path.join(tmp_dir, 'part-0.parquet'),
+                compression='zstd', row_group_size=ROW_GROUP_SIZE, use_dictionary=True,
+            )
+        shutil.rmtree(day_dir, ignore_errors=True)
+        if rows:
+            os.replace(tmp_dir, day_dir)
+        return len(rows)
+
+    def export(self, full: bool = False) -> Dict[str, int]:
+        """Export new and grown days (every day with full=True); returns rows per day"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        state = self._load_state()
+        entries = self.store.days() if full else self.pending_days()
+        exported = {}
+        for entry in sorted(entries, key=lambda e: e['day']):
+            exported[entry['day']] = self.export_day(entry)
+            state['days'][entry['day']] = {'raw_size': entry['raw_size'], 'rows': exported[entry['day']]}
+            # Saved per day so an interrupted run resumes where it stopped
+            self._save_state(state)
+        return exported
+
+
+def conversation_exporter(logs_dir: str, output_dir: str) -> ParquetExporter:
+    return ParquetExporter(
+        LogStore(logs_dir, 'conversations_'), os.path.join(output_dir, 'conversations'),
+        CONVERSATION_SCHEMA, CONVERSATION_SORT, conversation_rows,
+    )
+
+
+def feedback_exporter(feedback_dir: str, output_dir: str) -> ParquetExporter:
+    return ParquetExporter(
+        LogStore(feedback_dir, 'feedback_'), os.path.join(output_dir, 'feedback'),
+        FEEDBACK_SCHEMA, FEEDBACK_SORT, feedback_rows,
+    )
+
+
+class LogQuery:
+    """Common aggregates over the exported datasets (results are pandas DataFrames)"""
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+    def _load(self, name: str, schema: pa.Schema, columns=None, start=None, end=None, condition=None, model=None):
+        path = os.path.join(self.output_dir, name)
+        if not os.path.isdir(path):
+            return schema.empty_table().to_pandas()
+        # The declared schema rather than the first file's, so partitions
+        # written before a column existed read it as null
+        dataset = ds.dataset(
+            path, format='parquet', schema=pa.unify_schemas([schema, PARTITIONING]),
+            partitioning=ds.partitioning(PARTITIONING, flavor='hive'),
+            ignore_prefixes=['.', '_', 'export_state'],
+        )
+        # date prunes whole directories; condition/model skip row groups by statistics
+        expr = None
+        terms = [
+            ('date', start, lambda f, v: f >= v),
+            ('date', end, lambda f, v: f <= v),
+            ('condition', condition, lambda f, v: f == v),
+            ('model', model, lambda f, v: f == v),
+        ]
+        for field, value, compare in terms:
+            if value is None:
+                continue
+            term = compare(ds.field(field), value)
+            expr = term if expr is None else expr & term
+        return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+    def conversations(self, columns: Optional[List[str]] = None, start: Optional[str] = None, end: Optional[str] = None,
+                      condition: Optional[str] = None, model: Optional[str] = None):
+        """Turn-level rows; start/end are YYYYMMDD days (inclusive)"""
+        return self._load('conversations', CONVERSATION_SCHEMA, columns, start, end, condition, model)
+
+    def feedback(self, columns: Optional[List[str]] = None, start: Optional[str] = None, end: Optional[str] = None,
+                 condition: Optional[str] = None, model: Optional[str] = None):
+        return self._load('feedback', FEEDBACK_SCHEMA, columns, start, end, condition, model)
+
+    def turns_per_conversation(self, **filters):
+        """One row per conversation: condition, model, number of turns and duration"""
+        df = self.conversations(['conversation_id', 'timestamp', 'condition', 'model'], **filters)
+        grouped = df.groupby('conversation_id').agg(
+            condition=('condition', 'first'),
+            model=('model', 'first'),
+            turns=('timestamp', 'size'),
+            started=('timestamp', 'min'),
+            ended=('timestamp', 'max'),
+        )
+        grouped['duration_seconds'] = (grouped['ended'] - grouped['started']).dt.total_seconds()
+        return grouped.reset_index()
+
+    def diagnosis_rate(self, by: str = 'condition', **filters):
+        """Share of conversations in which the doctor named the condition, per `by` column"""
+        df = self.conversations(['conversation_id', 'diagnosis_given', 'turn', 'condition', 'model'], **filters)
+        per_conversation = df.groupby('conversation_id').agg(
+            key=(by, 'first'),
+            diagnosed=('diagnosis_given', 'max'),
+            turns=('turn', 'size'),
+        )
+        result = per_conversation.groupby('key').agg(
+            conversations=('diagnosed', 'size'),
+            diagnosed=('diagnosed', 'sum'),
+            mean_turns=('turns', 'mean'),
+        )
+        result['diagnosis_rate'] = result['diagnosed'] / result['conversations']
+        return result.rename_axis(by).reset_index()
+
+    def symptom_coverage(self, by: str = 'condition', **filters):
+        """Mean final symptom coverage of conversations per `by` column (coverage is cumulative, so the max is the final value)"""
+        df = self.conversations(['conversation_id', 'symptom_coverage', 'primary_coverage', 'condition', 'model'], **filters)
+        df = df[df['symptom_coverage'].notna()]
+        per_conversation = df.groupby('conversation_id').agg(
+            key=(by, 'first'),
+            coverage=('symptom_coverage', 'max'),
+            primary_coverage=('primary_coverage', 'max'),
+        )
+        result = per_conversation.groupby('key').agg(
+            conversations=('coverage', 'size'),
+            coverage=('coverage', 'mean'),
+            primary_coverage=('primary_coverage', 'mean'),
+        )
+        return result.rename_axis(by).reset_index()
+
+    def latency(self, by: str = 'model', **filters):
+        """LLM latency percentiles (ms) per `by` column, error replies excluded"""
+        df = self.conversations(['latency_ms', 'is_error', 'condition', 'model'], **filters)
+        df = df[~df['is_error'] & df['latency_ms'].notna()]
+        result = df.groupby(by)['latency_ms'].describe(percentiles=[0.5, 0.9, 0.99])
+        return result.rename(columns={'50%': 'p50', '90%': 'p90', '99%': 'p99'}).rename_axis(by).reset_index()
+
+    def error_rate(self, by: str = 'model', **filters):
+        df = self.conversations(['is_error', 'condition', 'model'], **filters)
+        return df.groupby(by)['is_error'].agg(turns='size', error_rate='mean').reset_index()
+
+    def feedback_summary(self, by: str = 'condition', **filters):
+        """Mean of every rating plus submission count per `by` column"""
+        df = self.feedback(FEEDBACK_RATINGS + [by], **filters)
+        result = df.groupby(by)[FEEDBACK_RATINGS].mean()
+        result.insert(0, 'submissions', df.groupby(by).size())
+        return result.reset_index()
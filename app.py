@@ -1,147 +1,206 @@
-from flask import Flask, render_template, request, jsonify, session, redirect
+from flask import Flask, render_template, request, jsonify, session, redirect, Response, g
 import os
+import sys
 import json
 import random
 import time
-import requests
-from openai import OpenAI
 from dotenv import load_dotenv
 from datetime import datetime
 import uuid
+import atexit
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 from prompts_and_evaluator import build_prompt_template
 from action_mapper import process_patient_message, action_mapper
-import pandas as pd
+from action_events import ActionChannelRegistry, ActionStream
+from ws_conversation import ResidentConversation, SocketPublisher, SocketStreamHandler, resident_conversations, async_log_writer
+from end_detector import end_detector
+from disclosure import update_disclosure, reset_disclosure
+from dataset_store import DatasetStore
+from llm_backends import backend_from_env
+from similarity import ConditionIndex
+from admission import admission_controller, AdmissionRejected
+from assets import AssetPipeline
+from log_store import LogStore, stream_download
+from usage import UsageAccountant
+from feedback_stats import FeedbackAggregator, patient_reference
+from shared_cache import SharedCache, cache_key
+from semantic_cache import SemanticCache, turn_stage
+from patient_model import ConversationHistory, Patient, Turn, case_record, intern_case, intern_persona, persona_record
+from profiling import RequestProfiler, authorized as profiling_authorized, collapse, memory_tracer, stack_sampler
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "fallback-secret-key")
 
-# Configure OpenAI client
-client = OpenAI(
-    api_key=os.getenv("OPENROUTER_API_KEY"),
-    base_url=os.getenv("OPENROUTER_BASE_URL"),
-)
+# WebSocket transport for /ws/conversation (optional; HTTP /send_message always works)
+try:
+    from flask_sock import Sock
+    sock = Sock(app)
+except ImportError:
+    sock = None
+
+def cooperative_workers():
+    """
+    True under the gevent worker (cooperative.py), where a long-lived stream
+    costs a greenlet. Under gthread every open stream would pin one of the
+    worker's GUNICORN_THREADS threads, so streaming endpoints are gevent-only.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+# LLM backend (OpenRouter, a local inference server or the offline mock; see
+# llm_backends.py). The client is created lazily: the openai package is only
+# imported on the first LLM call, and under a preloading gunicorn master each
+# worker builds its own client (and connection pool) after the fork.
+llm_backend = backend_from_env()
+_client = None
+
+def get_client():
+    """Return the backend's OpenAI-compatible client, creating it on first use"""
+    global _client
+    if _client is None:
+        _client = llm_backend.create_client()
+    return _client
 
 # Remove environment variable model selection
 MODEL_NAME = 'qwen/qwen-2.5-72b-instruct:free'  # More reliable model
 
-# MODEL_NAMES = [
-#     # === PRIMARY EVALUATION MODELS (6 models) ===
-#     'meta-llama/llama-3.3-70b-instruct:free',  # 65k context, most reliable
-#     'deepseek/deepseek-chat-v3-0324:free',  # 32k context, proven medical reasoning
-#     'qwen/qwen3-235b-a22b-07-25:free',  # 262k context, largest context
-#     'qwen/qwen-2.5-72b-instruct:free',  # 32k context, Qwen2.5 comparison
-#     'google/gemma-3-27b-it:free',  # 96k context, Gemma baseline
-#     'mistralai/mistral-small-3.2-24b-instruct:free',  # 128k context, Mistral 24B
+# Evaluation roster compared by tools/eval_models.py (the app itself only uses MODEL_NAME)
+MODEL_NAMES = [
+    # === PRIMARY EVALUATION MODELS (6 models) ===
+    'meta-llama/llama-3.3-70b-instruct:free',  # 65k context, most reliable
+    'deepseek/deepseek-chat-v3-0324:free',  # 32k context, proven medical reasoning
+    'qwen/qwen3-235b-a22b-07-25:free',  # 262k context, largest context
+    'qwen/qwen-2.5-72b-instruct:free',  # 32k context, Qwen2.5 comparison
+    'google/gemma-3-27b-it:free',  # 96k context, Gemma baseline
+    'mistralai/mistral-small-3.2-24b-instruct:free',  # 128k context, Mistral 24B
     
-#     # === FINE-TUNING MODELS ( models) ===
-#     #'mistralai/mistral-7b-instruct:free',  # 7B params, easy to fine-tune
-#     #'google/gemma-3-4b-it:free',  # 4B params, very easy to fine-tune
-# ]
+    # === FINE-TUNING MODELS ( models) ===
+    #'mistralai/mistral-7b-instruct:free',  # 7B params, easy to fine-tune
+    #'google/gemma-3-4b-it:free',  # 4B params, very easy to fine-tune
+]
 class MedicalPatientSimulator:
     def __init__(self):
+        self._similarity = None
         self.load_data()
     
     def load_data(self):
-        """Load NHS dataset and personas"""
+        """Load NHS dataset and personas from the compiled dataset artifact"""
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        # Prioritized symptom dataset first, fallback to exact
+        self.store = DatasetStore(
+            os.path.join(base_dir, 'data', 'patient_dataset.bin'),
+            [
+                os.path.join(base_dir, 'disease_to_symptom_sentences_prioritized.json'),
+                os.path.join(base_dir, 'disease_to_symptom_sentences_exact.json'),
+            ],
+            os.path.join(base_dir, 'personas.json'),
+        )
         try:
-            # Load NHS dataset - try prioritized version first, fallback to exact
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            nhs_path = os.path.join(base_dir, 'disease_to_symptom_sentences_prioritized.json')
-            
-            if not os.path.exists(nhs_path):
-                nhs_path = os.path.join(base_dir, 'disease_to_symptom_sentences_exact.json')
-                if not os.path.exists(nhs_path):
-                    raise FileNotFoundError(f"No symptom dataset found in {base_dir}")
-            
-            with open(nhs_path, 'r', encoding='utf-8') as f:
-                self.nhs_data = json.load(f)
-            
-            # Handle both old and new format
-            if isinstance(next(iter(self.nhs_data.values())), dict):
-                # New prioritized format
-                print(f"Loaded {len(self.nhs_data)} diseases from prioritized dataset")
-                self.use_prioritized_symptoms = True
-            else:
-                # Old format
-                print(f"Loaded {len(self.nhs_data)} diseases from exact dataset")
-                self.use_prioritized_symptoms = False
-                
-            self.disease_names = list(self.nhs_data.keys())
-            
-            # Load personas
-            personas_path = os.path.join(base_dir, 'personas.json')
-            with open(personas_path, 'r', encoding='utf-8') as f:
-                self.personas_data = json.load(f)
-            print(f"Loaded {len(self.personas_data['personalities'])} personality types from {personas_path}")
+            dataset = self.store.load()
+            print(f"Loaded {len(dataset.disease_names)} diseases from {'prioritized' if dataset.prioritized else 'exact'} dataset")
+            print(f"Loaded {len(dataset.personas)} personality types")
         except FileNotFoundError as e:
             print(f"Error loading data files: {e}")
-            self.nhs_data = {}
-            self.personas_data = None
+            self.store = None
+
+    @property
+    def dataset(self):
+        """Current compiled dataset (swapped in automatically when the artifact changes)"""
+        return self.store.current() if self.store else None
+
+    @property
+    def similarity(self):
+        """Condition-similarity index for the current dataset (rebuilt when the dataset changes)"""
+        dataset = self.dataset
+        if dataset is None:
+            return None
+        index = self._similarity
+        if index is None or index.source_digest != dataset.source_digest:
+            index = self._similarity = ConditionIndex(dataset)
+        return index
+
+    @property
+    def disease_names(self):
+        dataset = self.dataset
+        return dataset.disease_names if dataset else []
 
     def generate_patient(self):
         """Randomly select a case and build patient data"""
-        if not self.nhs_data:
+        dataset = self.dataset
+        if not dataset or not dataset.disease_names:
             return None
-        disease = random.choice(list(self.nhs_data.keys()))
-        symptoms = self.nhs_data[disease]
+        disease = random.choice(dataset.disease_names)
         return {
             'condition_name': disease,
-            'symptoms': symptoms,
+            'symptoms': dataset.all_symptoms(disease),
         }
     
     def generate_random_patient(self):
         """Generate a random patient with NHS condition and personality"""
-        if not self.nhs_data or not self.personas_data:
+        dataset = self.dataset
+        if not dataset or not dataset.disease_names or not dataset.personas:
             return self._fallback_patient()
         
         # Select random condition from NHS dataset
-        disease = random.choice(list(self.nhs_data.keys()))
-        
-        # Handle both old and new symptom formats
-        if hasattr(self, 'use_prioritized_symptoms') and self.use_prioritized_symptoms:
-            # New prioritized format
-            disease_data = self.nhs_data[disease]
-            symptoms = disease_data['primary_symptoms'] + disease_data['secondary_symptoms']
-            primary_symptoms = disease_data['primary_symptoms']
-            secondary_symptoms = disease_data['secondary_symptoms']
-        else:
-            # Old format
-            symptoms = self.nhs_data[disease]
-            primary_symptoms = symptoms[:min(3, len(symptoms))]
-            secondary_symptoms = symptoms[min(3, len(symptoms)):] if len(symptoms) > 3 else []
+        disease = random.choice(dataset.disease_names)
         
         # Select random personality
-        personality = random.choice(self.personas_data['personalities'])
+        personality = random.choice(dataset.personas)
         
-        # Generate demographic details
-        demographics = self._generate_demographics(personality)
+        return self.build_patient(disease, personality)
+    
+    def build_patient(self, disease, personality):
+        """Build patient data for a given condition and persona"""
+        dataset = self.dataset
         
-        # Build patient data
-        patient_data = {
-            'name': demographics['name'],
-            'age': demographics['age'],
-            'gender': demographics['gender'],
-            'occupation': demographics['occupation'],
-            'personality_type': personality['id'],
-            'condition_name': disease,
-            'condition_url': '',  # No URL for Symbipredict data
-            'symptoms': symptoms,
-            'primary_symptoms': primary_symptoms,
-            'secondary_symptoms': secondary_symptoms,
-            'treatments': [],  # No treatments in Symbipredict data
-            'personality_traits': personality['personality_traits'],
-            'behavior_notes': personality['behavior_notes'],
-            'communication_style': personality['communication_style'],
-            'diagnosis_given': False  # Flag to track if correct diagnosis was given
-        }
+        # Primary/secondary split is precomputed in the compiled dataset; the
+        # symptom lists and persona text are shared by every patient of the case
+        case = intern_case(disease, *dataset.symptoms(disease))  # No URL or treatments in Symbipredict data
         
-        # Generate the prompt template
-        patient_data['prompt_template'] = build_prompt_template(patient_data, disease, symptoms)
+        # Generate demographic details
+        demographics = self._generate_demographics(personality)
         
+        # The prompt is compiled on first use and shared by patients with the same case and demographics
+        return Patient(
+            case, intern_persona(personality),
+            demographics['name'], demographics['age'], demographics['gender'], demographics['occupation'],
+        )
+    
+    def restore_patient(self, reference):
+        """Rebuild full patient data (prompt included) from a feedback_stats.patient_reference"""
+        personality = next((p for p in self.dataset.personas if p['id'] == reference['personality_type']), None)
+        if personality is None:
+            raise ValueError(f"Unknown persona '{reference['personality_type']}'")
+        patient_data = self.build_patient(reference['condition_name'], personality)
+        for field in ('name', 'age', 'gender', 'occupation', 'diagnosis_given'):
+            if field in reference:
+                patient_data[field] = reference[field]
         return patient_data
     
+    def patient_from_session(self, value):
+        """
+        The Patient a session holds: Patient.pack() output, or a patient_data
+        dict from older sessions. None when there is none or its case is gone.
+        """
+        if not value:
+            return None
+        if isinstance(value, dict):
+            return Patient.from_dict(value)
+        condition, persona_id = value[0], value[1]
+        dataset = self.dataset
+        if dataset is None:
+            patient = self._fallback_patient()
+            patient.diagnosis_given, patient.disclosed_symptoms = bool(value[6]), value[7]
+            return patient
+        case = intern_case(condition, *dataset.symptoms(condition)) if condition in dataset else case_record(condition)
+        personality = next((p for p in dataset.personas if p['id'] == persona_id), None)
+        persona = intern_persona(personality) if personality else persona_record(persona_id)
+        if case is None or persona is None:
+            return None
+        return Patient.unpack(value, case, persona)
+    
     def _generate_demographics(self, personality):
         """Generate demographics from fixed persona data"""
         # Use fixed name, age, and occupation from persona
@@ -162,12 +221,12 @@ class MedicalPatientSimulator:
         """Generate MCQ questions based on the patient's condition"""
         questions = []
         
-        # Get all available conditions for distractors from Symbipredict dataset
-        all_conditions = [disease for disease in self.disease_names if disease != patient_data['condition_name']]
+        # Distractors come from the conditions whose symptoms are closest to the patient's
+        index = self.similarity
         
         # Question 1: What is the most likely diagnosis?
         correct_answer = patient_data['condition_name']
-        distractors = random.sample(all_conditions, min(3, len(all_conditions)))
+        distractors = index.differentials(correct_answer, 3) if index else []
         options = [correct_answer] + distractors
         random.shuffle(options)
         
@@ -182,22 +241,10 @@ class MedicalPatientSimulator:
         if patient_data.get('primary_symptoms'):
             # Use primary symptoms for this question
             correct_symptom = random.choice(patient_data['primary_symptoms'])
-            # Generate distractors from other conditions 
-            all_symptoms = []
-            for disease, symptoms in self.nhs_data.items():
-                if disease != patient_data['condition_name']:
-                    if hasattr(self, 'use_prioritized_symptoms') and self.use_prioritized_symptoms:
-                        # New format
-                        disease_data = symptoms
-                        if isinstance(disease_data, dict):
-                            all_symptoms.extend(disease_data.get('primary_symptoms', []))
-                        else:
-                            all_symptoms.extend(symptoms[:min(3, len(symptoms))])
-                    else:
-                        # Old format
-                        all_symptoms.extend(symptoms[:min(3, len(symptoms))])
-            
-            distractors = random.sample(all_symptoms, min(3, len(all_symptoms))) if all_symptoms else ["Headache", "Fatigue", "Nausea"]
+            # Distractors: primary symptoms of similar conditions the patient doesn't have
+            distractors = index.symptom_distractors(patient_data['condition_name'], patient_data['symptoms'], 3) if index else []
+            if not distractors:
+                distractors = ["Headache", "Fatigue", "Nausea"]
             options = [correct_symptom] + distractors
             random.shuffle(options)
             
@@ -240,35 +287,84 @@ class MedicalPatientSimulator:
     
     def _fallback_patient(self):
         """Fallback patient if data files are missing"""
-        return {
+        case = intern_case('Asthma', ['wheezing', 'coughing', 'shortness of breath'], (),
+                           'https://www.nhs.uk/conditions/asthma/', ['inhaler'])
+        persona = intern_persona({
+            'id': 'anxious_professional',
             'name': 'Test Patient',
             'age': 35,
-            'gender': 'Female',
             'occupation': 'Office worker',
-            'personality_type': 'anxious_professional',
-            'condition_name': 'Asthma',
-            'condition_url': 'https://www.nhs.uk/conditions/asthma/',
-            'symptoms': ['wheezing', 'coughing', 'shortness of breath'],
-            'treatments': ['inhaler'],
             'personality_traits': 'Anxious and concerned about health',
             'behavior_notes': 'Asks many questions',
             'communication_style': 'Formal but worried',
-            'prompt_template': 'You are a concerned patient with asthma symptoms.',
-            'diagnosis_given': False
-        }
+        })
+        return Patient(case, persona, 'Test Patient', 35, 'Female', 'Office worker',
+                       prompt_override='You are a concerned patient with asthma symptoms.')
 
 # Initialize simulator
 simulator = MedicalPatientSimulator()
 
-def get_patient_response(patient_data, conversation_history, user_message, model_name=MODEL_NAME):
-    """Generate patient response using OpenAI API with enhanced responses. Returns (response, is_error)."""
+# Daily JSONL logs; closed days are compressed and indexed in a manifest by
+# the async log writer, off the request path
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+conversation_logs = LogStore(os.path.join(_base_dir, 'logs'), 'conversations_', async_log_writer.submit)
+feedback_logs = LogStore(os.path.join(_base_dir, 'feedback_logs'), 'feedback_', async_log_writer.submit)
+
+# Token/cost accounting per model, condition and session; records are
+# buffered and flushed to usage_logs/ in batches by the async log writer
+usage_accountant = UsageAccountant(LogStore(os.path.join(_base_dir, 'usage_logs'), 'usage_', async_log_writer.submit), async_log_writer.submit)
+atexit.register(usage_accountant.flush)
+
+# Node-wide response cache shared by all workers (sqlite WAL + per-worker L1);
+# LLM_CACHE_TTL=0 turns it off
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', '600'))
+response_cache = SharedCache(os.getenv('SHARED_CACHE_PATH', os.path.join(_base_dir, 'cache', 'shared_cache.sqlite3')), 'llm')
+
+# Avatar action events, shared by all workers so /action_events and
+# /send_message may be served by different ones
+action_channels = ActionChannelRegistry(os.getenv('ACTION_EVENTS_PATH', os.path.join(_base_dir, 'cache', 'action_events.sqlite3')))
+
+# Paraphrased early-turn questions reuse replies from this worker's
+# similarity index (see semantic_cache.py); SEMANTIC_CACHE_THRESHOLD=0 turns it off
+semantic_cache = SemanticCache()
+
+# Per-request cProfile output (X-Profile header, see profiling.py)
+request_profiler = RequestProfiler(os.path.join(_base_dir, 'profiles'))
+
+# Running rating aggregates over feedback_logs/, caught up incrementally
+feedback_aggregator = FeedbackAggregator(feedback_logs, os.path.join(feedback_logs.directory, 'feedback_stats.json'))
+
+# Fingerprinted, precompressed static assets (built on startup when stale)
+asset_pipeline = AssetPipeline(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+asset_pipeline.load()
+app.jinja_env.globals['asset_url'] = asset_pipeline.url
+
+def session_patient():
+    """The session's Patient (None before one is generated, or when its case was removed)"""
+    return simulator.patient_from_session(session.get('patient_data'))
+
+def start_session(patient_data):
+    """Put a new patient in the session with an empty conversation"""
+    # Packed: a few values instead of the full patient (the prompt alone is ~3KB) in the cookie
+    session['patient_data'] = patient_data.pack()
+    session['conversation_history'] = ConversationHistory().pack()
+    session['conversation_id'] = str(uuid.uuid4())
+
+def get_patient_response(patient_data, conversation_history, user_message, model_name=MODEL_NAME, stream_handler=None, prompt_template=None, conversation_id=None):
+    """
+    Generate patient response using OpenAI API with enhanced responses. Returns (response, is_error).
+    With a stream_handler the reply is streamed: stream_handler.start() is called
+    on every attempt and stream_handler.feed(text) with each delta as it arrives.
+    A precompiled prompt_template skips rebuilding the system prompt.
+    Token usage and cost of each call are recorded against conversation_id.
+    """
     
     # Retry configuration
     RESPONSE_RETRY_LIMIT = 3
     RESPONSE_RETRY_DELAY = 5  # seconds
     
-    # Use the provided model_name if given, otherwise default
-    model = model_name if model_name is not None else MODEL_NAME
+    # Use the provided model_name if given, otherwise default (the local backend serves one model)
+    model = llm_backend.model_for(model_name if model_name is not None else MODEL_NAME)
     
     # Check if this is a new patient session (reset diagnosis flag)
     if 'diagnosis_given' not in patient_data:
@@ -299,8 +395,10 @@ def get_patient_response(patient_data, conversation_history, user_message, model
             ]
             is_diagnosis_attempt = any(keyword in user_message_lower for keyword in diagnosis_keywords)
             
-            # Build conversation context using new prompt template
-            prompt_template = build_prompt_template(patient_data, patient_data['condition_name'], patient_data['symptoms'])
+            # Build conversation context using new prompt template (compiled once
+            # per patient and carried in patient_data; only rebuilt for old sessions)
+            if prompt_template is None:
+                prompt_template = patient_data.get('prompt_template') or build_prompt_template(patient_data, patient_data['condition_name'], patient_data['symptoms'])
             messages = [
                 {"role": "system", "content": prompt_template},
             ]
@@ -327,26 +425,87 @@ def get_patient_response(patient_data, conversation_history, user_message, model
                         "content": f"The doctor just gave an incorrect diagnosis. Help them understand better by describing your symptoms more clearly."
                     })
             
-            response = client.chat.completions.create(
+            request_args = dict(
                 model=model,
                 messages=messages,
                 max_tokens=250,  # Increased to 250 tokens for word limit testing
                 temperature=0.8  # Slightly higher for more natural variation
             )
-            content = response.choices[0].message.content.strip() if response.choices[0].message.content else "I'm not sure how to respond to that."
+            
+            # Early questions can reuse the reply to a paraphrase asked of the same patient
+            # (same prompt, model, stage and diagnosis note); correct diagnoses end the
+            # session and always get a fresh reply
+            stage = turn_stage(len(conversation_history))
+            semantic_ticket = None
+            if semantic_cache.enabled and stage is not None and not (is_diagnosis_attempt and is_correct_diagnosis):
+                scope = (model, patient_data['condition_name'], patient_data.get('personality_type'), stage, is_diagnosis_attempt, cache_key(prompt_template)[:16])
+                content, semantic_ticket = semantic_cache.lookup(scope, user_message, avoid=(e['patient'] for e in conversation_history))
+                if content is not None:
+                    if stream_handler is not None:
+                        stream_handler.start()
+                        stream_handler.feed(content)
+                    return content, False
+            
+            def call_llm():
+                started = time.perf_counter()
+                if stream_handler is None:
+                    response = get_client().chat.completions.create(**request_args)
+                    usage = getattr(response, 'usage', None)
+                    content = response.choices[0].message.content.strip() if response.choices[0].message.content else "I'm not sure how to respond to that."
+                else:
+                    stream_handler.start()
+                    chunks = []
+                    usage = None
+                    # include_usage adds a final chunk with no choices and the token counts
+                    for chunk in get_client().chat.completions.create(stream=True, stream_options={'include_usage': True}, **request_args):
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            chunks.append(delta)
+                            stream_handler.feed(delta)
+                        if getattr(chunk, 'usage', None) is not None:
+                            usage = chunk.usage
+                    content = ''.join(chunks).strip() or "I'm not sure how to respond to that."
+                usage_accountant.record(
+                    model, usage, (time.perf_counter() - started) * 1000,
+                    conversation_id=conversation_id,
+                    condition=patient_data['condition_name'],
+                    prompt_parts={
+                        'system': ''.join(m['content'] for m in messages if m['role'] == 'system'),
+                        'history': ''.join(f"Doctor: {e['doctor']}{e['patient']}" for e in recent_history),
+                        'message': f"Doctor: {user_message}",
+                    },
+                    completion=content,
+                )
+                computed.append(True)
+                return content
+            
+            # Identical requests (same model, prompt, history and message) share one
+            # reply across workers; concurrent duplicates wait for a single call
+            computed = []
+            if LLM_CACHE_TTL > 0:
+                content = response_cache.get_or_compute(cache_key(request_args), call_llm, LLM_CACHE_TTL)
+            else:
+                content = call_llm()
+            if stream_handler is not None and not computed:
+                # Cache hit: deliver the stored reply as a single delta
+                stream_handler.start()
+                stream_handler.feed(content)
+            if semantic_ticket is not None and computed:
+                semantic_cache.store(semantic_ticket, content)
             return content, False
             
         except Exception as e:
             # Better error handling for model issues
             error_str = str(e)
             if "503" in error_str or "No instances available" in error_str:
-                error_msg = f"Model '{model}' is currently unavailable on OpenRouter. Please try a different model."
+                error_msg = f"Model '{model}' is currently unavailable on {llm_backend.label}. Please try a different model."
             elif "idk how to respond" in error_str.lower():
                 error_msg = f"Model '{model}' is not responding properly. This may be a compatibility issue."
             else:
                 error_msg = f"API Error with model '{model}': {error_str}"
             
             print(f"Model error (attempt {retry + 1}/{RESPONSE_RETRY_LIMIT}): {error_msg}")
+            usage_accountant.record_error(model)
             
             # If this is the last retry, return the error
             if retry == RESPONSE_RETRY_LIMIT - 1:
@@ -361,25 +520,21 @@ def admin_dashboard():
     """Admin dashboard to monitor logs and feedback"""
     return render_template('admin_dashboard.html')
 
+@app.route('/assets/<path:filename>')
+def fingerprinted_asset(filename):
+    """Serve a fingerprinted static asset, precompressed when the browser accepts it"""
+    return asset_pipeline.send(filename, request.headers.get('Accept-Encoding', ''))
+
 @app.route('/disease_list')
 def disease_list():
     """Show list of available diseases for users"""
     # Create a list of diseases with their symptoms
     diseases_with_symptoms = []
+    dataset = simulator.dataset
     for disease_name in simulator.disease_names:
-        disease_data = simulator.nhs_data[disease_name]
-        
-        # Handle both old and new symptom formats
-        if hasattr(simulator, 'use_prioritized_symptoms') and simulator.use_prioritized_symptoms:
-            # New prioritized format
-            symptoms = disease_data['primary_symptoms'] + disease_data['secondary_symptoms']
-        else:
-            # Old format
-            symptoms = disease_data if isinstance(disease_data, list) else []
-        
         diseases_with_symptoms.append({
             'name': disease_name,
-            'symptoms': symptoms
+            'symptoms': dataset.all_symptoms(disease_name)
         })
     
     return render_template('disease_list.html', diseases=diseases_with_symptoms)
@@ -399,13 +554,8 @@ def generate_patient():
     """Generate a new random patient and redirect to chat"""
     patient_data = simulator.generate_random_patient()
     
-    # Ensure diagnosis flag is reset for new patient
-    patient_data['diagnosis_given'] = False
-    
     # Store patient data in session
-    session['patient_data'] = patient_data
-    session['conversation_history'] = []
-    session['conversation_id'] = str(uuid.uuid4())
+    start_session(patient_data)
     
     return jsonify({
         'success': True,
@@ -415,30 +565,30 @@ def generate_patient():
 @app.route('/chat')
 def chat():
     """Chat interface - Pure text-based chat"""
-    patient_data = session.get('patient_data')
+    patient_data = session_patient()
     if not patient_data:
         return redirect('/')
     
-    return render_template('chat.html', patient_data=patient_data)
+    return render_template('chat.html', patient_data=patient_data, websocket=sock is not None and cooperative_workers())
 
 @app.route('/chat_2d')
 def chat_2d():
     """2D animated character interface with action mapping"""
-    patient_data = session.get('patient_data')
+    patient_data = session_patient()
     if not patient_data:
         return redirect('/')
     
-    return render_template('chat_2d.html', patient_data=patient_data)
+    return render_template('chat_2d.html', patient_data=patient_data, action_streaming=cooperative_workers())
 
 @app.route('/animation_test')
 def animation_test():
     """2D animation testing interface (for debugging)"""
-    return render_template('chat_2d_animation_test.html')
+    return render_template('chat_2d_animation_test.html', action_streaming=cooperative_workers())
 
 @app.route('/chat_3d')
 def chat_3d():
     """Chat interface with comprehensive 3D Three.js character"""
-    patient_data = session.get('patient_data')
+    patient_data = session_patient()
     if not patient_data:
         return redirect('/')
     
@@ -447,7 +597,7 @@ def chat_3d():
 @app.route('/chat_3d_avatar')
 def chat_3d_avatar():
     """Advanced 3D avatar with detailed human model and animations"""
-    patient_data = session.get('patient_data')
+    patient_data = session_patient()
     if not patient_data:
         return redirect('/')
     
@@ -456,89 +606,43 @@ def chat_3d_avatar():
 @app.route('/chat_3d_procedural')
 def chat_3d_procedural():
     """3D procedural avatar interface"""
-    patient_data = session.get('patient_data')
+    patient_data = session_patient()
     if not patient_data:
         return redirect('/')
     
     return render_template('chat_3d_procedural.html', patient_data=patient_data)
 
-def check_if_should_end_chat(patient_response, patient_data=None):
-    """Check if patient response indicates the conversation should end"""
-    response_lower = patient_response.lower()
-    
-    # Enhanced thank you patterns with flexible matching (case-insensitive)
-    thank_you_patterns = [
-        'thank you doctor',
-        'thank you doc', 
-        'thanks doctor',
-        'thanks doc',
-        'thankyou doctor',
-        'thankyou doc',
-        'thankyou doctor for helping me',
-        'thanks doc, you have been a great help',
-        'thank you for the diagnosis',
-        'thanks for the diagnosis',
-        'thank you for helping',
-        'thanks for helping',
-        'thank you for your help',
-        'thanks for your help',
-        'thank you so much',
-        'thanks so much'
-    ]
-    
-    # Check for flexible thank you patterns (allowing commas, no spaces, and variations)
-    flexible_patterns = [
-        r'thank\s*you\s*,?\s*doctor',
-        r'thanks\s*,?\s*doc',
-        r'thank\s*you\s*,?\s*doc',
-        r'thanks\s*,?\s*doctor',
-        r'thankyou\s*,?\s*doctor',
-        r'thankyou\s*,?\s*doc',
-        r'thank\s*you\s*,?\s*doctor',
-        r'thanks\s*,?\s*doctor'
-    ]
-    
-    # Check if any exact thank you pattern is found
-    for pattern in thank_you_patterns:
-        if pattern in response_lower:
-            return True
-    
-    # Check for flexible patterns using regex-like matching
-    import re
-    for pattern in flexible_patterns:
-        if re.search(pattern, response_lower, re.IGNORECASE):
-            return True
+def record_turn(conversation_id, patient_data, conversation_history, user_message, patient_response, model_name=MODEL_NAME, log=None, latency_ms=None, stream=None):
+    """
+    Detect actions in a reply, update symptom coverage, append the turn to the
+    history, log it and check whether the consultation has ended (reusing the
+    end scan of the stream handler that delivered the reply, if any).
+    Returns (entry, action_result, end_rule, coverage).
+    """
+    # Detect actions only from the patient's response (per requirement)
+    patient_action_result = process_patient_message(patient_response)
+    action_result = {
+        'actions': patient_action_result.get('actions', []),
+        'execution_plan': patient_action_result.get('execution_plan', '')
+    }
     
-    # Additional flexible matching for common variations
-    additional_patterns = [
-        'thankyou doctor',
-        'thankyou doc',
-        'thank you, doctor',
-        'thank you, doc',
-        'thanks, doctor',
-        'thanks, doc',
-        'thankyou, doctor',
-        'thankyou, doc'
-    ]
+    # Log the conversation
+    conversation_entry = Turn(datetime.now().isoformat(), user_message, patient_response, tuple(action_result.get('actions', [])))
+    conversation_history.append(conversation_entry)
     
-    for pattern in additional_patterns:
-        if pattern in response_lower:
-            return True
+    # Which of the case's symptoms the patient has disclosed so far (bitset on patient_data)
+    coverage = update_disclosure(patient_data, patient_response)
     
-    # Check for goodbye/farewell patterns that might also indicate end
-    farewell_patterns = [
-        'goodbye doctor',
-        'bye doctor',
-        'see you later',
-        'have a good day',
-        'take care'
-    ]
+    # Log to file
+    (log or log_conversation)(conversation_id, patient_data, conversation_entry, model_name, latency_ms, coverage)
     
-    for pattern in farewell_patterns:
-        if pattern in response_lower:
-            return True
+    # Check if patient response indicates end of conversation (thank you messages)
+    # Only end if diagnosis was given AND thank you is detected
+    end_rule = None
+    if patient_data.get('diagnosis_given', False):
+        end_rule = stream.end_rule(patient_response) if stream is not None else end_detector.detect(patient_response)
     
-    return False
+    return conversation_entry, action_result, end_rule, coverage
 
 @app.route('/send_message', methods=['POST'])
 def send_message():
@@ -551,63 +655,201 @@ def send_message():
             return jsonify({'error': 'No message provided'}), 400
         
         # Get patient data from session
-        patient_data = session.get('patient_data')
+        patient_data = session_patient()
         if not patient_data:
             return jsonify({'error': 'No patient data found. Please generate a patient first.'}), 400
         
         # Get conversation history from session
-        conversation_history = session.get('conversation_history', [])
+        conversation_history = ConversationHistory.unpack(session.get('conversation_history'))
         
-        # Generate patient response using OpenAI
-        patient_response, is_error = get_patient_response(
-            patient_data, conversation_history, user_message
-        )
-        
-        # Detect actions only from the patient's response (per requirement)
-        patient_action_result = process_patient_message(patient_response)
-        action_result = {
-            'actions': patient_action_result.get('actions', []),
-            'execution_plan': patient_action_result.get('execution_plan', '')
-        }
-        
-        # Log the conversation
-        conversation_entry = {
-            'timestamp': datetime.now().isoformat(),
-            'doctor': user_message,
-            'patient': patient_response,
-            'symptoms_revealed': action_result.get('actions', []),
-            'diagnosis_attempts': 0,
-            'session_end': False
-        }
-        
-        conversation_history.append(conversation_entry)
-        session['conversation_history'] = conversation_history
-        
-        # Log to file
+        # Generate patient response using OpenAI (admission control queues or
+        # rejects the call when the model is saturated)
         conversation_id = session.get('conversation_id', 'unknown')
-        log_conversation(conversation_id, patient_data, conversation_entry)
+        # Stream the reply when an avatar page is subscribed to /action_events,
+        # so actions are pushed while the text is still being generated
+        channel = action_channels.get(conversation_id)
+        action_stream = ActionStream(channel, patient_data) if channel else None
+        try:
+            check_usage_budget(conversation_id)
+            with admission_controller.admit(MODEL_NAME, conversation_id):
+                started = time.perf_counter()
+                patient_response, is_error = get_patient_response(
+                    patient_data, conversation_history, user_message, stream_handler=action_stream,
+                    conversation_id=conversation_id
+                )
+                latency_ms = (time.perf_counter() - started) * 1000
+        except AdmissionRejected as e:
+            return admission_rejected_response(e)
+        
+        conversation_entry, action_result, end_rule, coverage = record_turn(
+            conversation_id, patient_data, conversation_history, user_message, patient_response,
+            latency_ms=latency_ms, stream=action_stream
+        )
+        # Diagnosis flag and symptom coverage changed with the turn
+        session['patient_data'] = patient_data.pack()
+        session['conversation_history'] = conversation_history.pack()
         
-        # Check if patient response indicates end of conversation (thank you messages)
-        # Only end if diagnosis was given AND thank you is detected
-        should_end = False
-        if patient_data.get('diagnosis_given', False):
-            should_end = check_if_should_end_chat(patient_response, patient_data)
+        if action_stream:
+            action_stream.finish(patient_response, should_end_chat=end_rule is not None)
         
         return jsonify({
             'response': patient_response,
             'detected_actions': action_result.get('actions', []),
             'execution_plan': action_result.get('execution_plan', ''),
-            'should_end_chat': should_end
+            'should_end_chat': end_rule is not None,
+            'end_rule': end_rule,
+            'symptom_coverage': coverage
         })
         
     except Exception as e:
         print(f"Error in send_message: {e}")
         return jsonify({'error': f'Failed to process message: {str(e)}'}), 500
 
+def conversation_socket(ws):
+    """WebSocket conversation channel: state stays resident for the socket's lifetime"""
+    publisher = SocketPublisher(ws)
+    patient_data = session_patient()
+    conversation_id = session.get('conversation_id')
+    if not patient_data or not conversation_id:
+        publisher.send({'type': 'error', 'error': 'No patient data found. Please generate a patient first.'})
+        return
+    
+    if not cooperative_workers():
+        publisher.send({'type': 'error', 'error': 'WebSocket conversations need the gevent worker (GUNICORN_WORKER_CLASS=gevent)'})
+        return
+    
+    history = ConversationHistory.unpack(session.get('conversation_history'))
+    def resident():
+        return ResidentConversation(conversation_id, patient_data, history, MODEL_NAME)
+    conversation = resident_conversations.get_or_create(conversation_id, resident)
+    if len(conversation.history) < len(history):
+        # Turns were taken over HTTP since this worker last held the conversation
+        resident_conversations.discard(conversation_id)
+        conversation = resident_conversations.get_or_create(conversation_id, resident)
+    publisher.send({
+        'type': 'ready',
+        'conversation_id': conversation_id,
+        'model': conversation.model,
+        'turns': len(conversation.history)
+    })
+    
+    def log_async(conversation_id, patient_data, *args):
+        # A copy: the resident patient (diagnosis_given, disclosed symptoms) may
+        # change with the next turn before the queued write runs
+        async_log_writer.submit(log_conversation, conversation_id, patient_data.copy(), *args)
+    
+    while True:
+        raw = ws.receive()
+        if raw is None:
+            break
+        try:
+            frame = json.loads(raw)
+        except ValueError:
+            publisher.send({'type': 'error', 'error': 'Invalid frame'})
+            continue
+        if frame.get('type') == 'ping':
+            publisher.send({'type': 'pong'})
+            continue
+        
+        user_message = (frame.get('message') or '').strip()
+        if not user_message:
+            publisher.send({'type': 'error', 'error': 'No message provided'})
+            continue
+        
+        with conversation.lock:
+            handler = SocketStreamHandler(publisher, conversation.patient_data)
+            publisher.send({'type': 'typing', 'state': True})
+            try:
+                check_usage_budget(conversation_id)
+                with admission_controller.admit(conversation.model, conversation_id):
+                    started = time.perf_counter()
+                    patient_response, is_error = get_patient_response(
+                        conversation.patient_data, conversation.history, user_message,
+                        model_name=conversation.model, stream_handler=handler,
+                        prompt_template=conversation.prompt_template, conversation_id=conversation_id
+                    )
+                    latency_ms = (time.perf_counter() - started) * 1000
+            except AdmissionRejected as e:
+                publisher.send({'type': 'error', 'status': e.status, 'error': e.reason, 'retry_after': e.retry_after})
+                continue
+            finally:
+                publisher.send({'type': 'typing', 'state': False})
+            
+            conversation_entry, action_result, end_rule, coverage = record_turn(
+                conversation_id, conversation.patient_data, conversation.history, user_message,
+                patient_response, model_name=conversation.model, log=log_async, latency_ms=latency_ms,
+                stream=handler
+            )
+            handler.finish(patient_response, should_end_chat=end_rule is not None)
+            publisher.send({
+                'type': 'reply',
+                'response': patient_response,
+                'is_error': is_error,
+                'detected_actions': action_result.get('actions', []),
+                'execution_plan': action_result.get('execution_plan', ''),
+                'should_end_chat': end_rule is not None,
+                'end_rule': end_rule,
+                'symptom_coverage': coverage,
+                'session_state': session_state_signer.dumps(conversation.snapshot())
+            })
+
+if sock is not None:
+    sock.route('/ws/conversation')(conversation_socket)
+
+# Turn state handed to the page by the socket; only this server can produce it,
+# so /sync_session can write it into the cookie as is
+session_state_signer = URLSafeTimedSerializer(app.secret_key, salt='ws-session-state')
+SESSION_STATE_MAX_AGE = 3600
+
+@app.route('/sync_session', methods=['POST'])
+def sync_session():
+    """Write the state after a WebSocket turn back to the cookie session"""
+    data = request.get_json(silent=True) or {}
+    try:
+        state = session_state_signer.loads(data.get('state', ''), max_age=SESSION_STATE_MAX_AGE)
+    except BadSignature:
+        return jsonify({'error': 'Invalid session state'}), 400
+    if state['conversation_id'] != session.get('conversation_id'):
+        # The conversation was reset or replaced since that turn
+        return jsonify({'error': 'Conversation has changed'}), 409
+    if state['turns'] >= len(ConversationHistory.unpack(session.get('conversation_history'))):
+        session['patient_data'] = state['patient_data']
+        session['conversation_history'] = state['conversation_history']
+    return jsonify({'success': True})
+
+def admission_rejected_response(e):
+    """JSON error for a request turned away by admission control, with Retry-After"""
+    response = jsonify({'error': e.reason, 'retry_after': e.retry_after})
+    response.status_code = e.status
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@app.route('/admission_stats')
+def admission_stats():
+    """Queue depth and admission counters for LLM calls in this worker"""
+    return jsonify(admission_controller.stats())
+
+def check_usage_budget(conversation_id):
+    """Turn the request away (429) when an enforced token/cost budget is used up"""
+    exhausted = usage_accountant.over_budget(conversation_id)
+    if exhausted:
+        reason, retry_after = exhausted
+        raise AdmissionRejected(429, reason, retry_after)
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Hit rates of this worker's L1 and the shared L2, the L2 size, and the semantic cache"""
+    return jsonify(dict(response_cache.stats(), semantic=semantic_cache.stats()))
+
+@app.route('/usage_stats')
+def usage_stats():
+    """Today's token usage and cost per model, condition and session, with budget alerts"""
+    return jsonify(usage_accountant.stats(top_sessions=request.args.get('top', 10, type=int)))
+
 @app.route('/generate_mcq', methods=['POST'])
 def generate_mcq():
     """Generate MCQ questions for the current patient"""
-    patient_data = session.get('patient_data')
+    patient_data = session_patient()
     if not patient_data:
         return jsonify({'error': 'No patient data found'})
     
@@ -622,30 +864,40 @@ def generate_mcq():
 @app.route('/reset_conversation', methods=['POST'])
 def reset_conversation():
     """Reset the current conversation"""
-    session['conversation_history'] = []
+    resident_conversations.discard(session.get('conversation_id', ''))
+    session['conversation_history'] = ConversationHistory().pack()
     session['conversation_id'] = str(uuid.uuid4())
     
-    # Reset diagnosis flag when conversation is reset
-    if 'patient_data' in session:
-        session['patient_data']['diagnosis_given'] = False
+    # Reset diagnosis flag and symptom coverage when conversation is reset
+    patient_data = session_patient()
+    if patient_data:
+        patient_data['diagnosis_given'] = False
+        reset_disclosure(patient_data)
+        session['patient_data'] = patient_data.pack()
     
     return jsonify({'success': True})
 
 @app.route('/new_patient', methods=['POST'])
 def new_patient():
-    """Generate a new patient"""
-    patient_data = simulator.generate_random_patient()
-    # Ensure diagnosis flag is reset for new patient
-    patient_data['diagnosis_given'] = False
-    session['patient_data'] = patient_data
-    session['conversation_history'] = []
-    session['conversation_id'] = str(uuid.uuid4())
+    """Generate a new patient; a JSON body may pin the condition and/or personality_type"""
+    resident_conversations.discard(session.get('conversation_id', ''))
+    data = request.get_json(silent=True) or {}
+    if (data.get('condition') or data.get('personality_type')) and simulator.dataset is not None:
+        dataset = simulator.dataset
+        condition = data.get('condition') or random.choice(dataset.disease_names)
+        persona = next((p for p in dataset.personas if p['id'] == data.get('personality_type')), None) or random.choice(dataset.personas)
+        if condition not in dataset.disease_names:
+            return jsonify({'error': f"Unknown condition '{condition}'"}), 400
+        patient_data = simulator.build_patient(condition, persona)
+    else:
+        patient_data = simulator.generate_random_patient()
+    start_session(patient_data)
     
     # No need to clear action queue anymore - actions are processed per message
     
     return jsonify({
         'success': True,
-        'patient_data': patient_data
+        'patient_data': patient_data.to_dict()
     })
 
 @app.route('/submit_diagnosis', methods=['POST'])
@@ -653,7 +905,7 @@ def submit_diagnosis():
     """Check the submitted diagnosis against the patient's true condition"""
     data = request.get_json()
     diagnosis = data.get('diagnosis', '').strip().lower()
-    patient_data = session.get('patient_data')
+    patient_data = session_patient()
     if not patient_data:
         return jsonify({'error': 'No patient data found', 'correct': False})
     true_condition = patient_data['condition_name'].strip().lower()
@@ -663,17 +915,42 @@ def submit_diagnosis():
 
 @app.route('/get_hint', methods=['POST'])
 def get_hint():
-    """Return the correct diagnosis and one random distractor as a hint"""
-    patient_data = session.get('patient_data')
+    """Return the correct diagnosis and a close differential, in random order, as a hint"""
+    patient_data = session_patient()
     if not patient_data:
         return jsonify({'hint': 'No patient data found.'})
     true_condition = patient_data['condition_name']
-    # Get a random distractor from the CSV-based disease list
-    all_conditions = [d for d in simulator.disease_names if d != true_condition]
-    distractor = random.choice(all_conditions) if all_conditions else 'Migraine'
-    hint = f"Possible diagnoses: {true_condition}, {distractor}"
+    # The distractor is one of the conditions with the most similar symptoms
+    index = simulator.similarity
+    differentials = index.differentials(true_condition, 1) if index else []
+    options = [true_condition, differentials[0] if differentials else 'Migraine']
+    random.shuffle(options)
+    hint = f"Possible diagnoses: {', '.join(options)}"
     return jsonify({'hint': hint})
 
+@app.route('/action_events')
+def action_events():
+    """Server-Sent Events stream of avatar actions for the current conversation"""
+    conversation_id = session.get('conversation_id')
+    if not conversation_id:
+        return jsonify({'error': 'No patient data found. Please generate a patient first.'}), 400
+    if not cooperative_workers():
+        return jsonify({'error': 'Action streaming needs the gevent worker (GUNICORN_WORKER_CLASS=gevent)'}), 503
+    
+    channel = action_channels.subscribe(conversation_id)
+    last_event_id = request.headers.get('Last-Event-ID', 0, type=int)
+    return Response(channel.sse_stream(last_event_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # don't let a proxy buffer the stream
+    })
+
+@app.route('/clear_action_queue', methods=['POST'])
+def clear_action_queue():
+    """Drop actions still queued for the current conversation"""
+    channel = action_channels.get(session.get('conversation_id', ''))
+    cleared = channel.clear() if channel else 0
+    return jsonify({'success': True, 'cleared': cleared})
+
 @app.route('/test_action_mapper', methods=['POST'])
 def test_action_mapper():
     """Test the action mapper with a sample message"""
@@ -706,7 +983,9 @@ def submit_feedback():
             'communication_consistency_rating': data.get('communication_consistency_rating'),
             'symptom_realism_rating': data.get('symptom_realism_rating'),
             'additional_comments': data.get('additional_comments', ''),
-            'patient_data': session.get('patient_data', {}),
+            # A reference, not the full patient: the prompt alone is ~2.5KB per record
+            'patient': patient_reference(session_patient() or {}),
+            'model_name': MODEL_NAME,
             'conversation_id': session.get('conversation_id', 'unknown'),
             'session_id': session.get('session_id', 'unknown')
         }
@@ -723,39 +1002,38 @@ def submit_feedback():
 def log_feedback(feedback_data):
     """Log feedback data for analysis"""
     # Save to feedback log file
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    feedback_dir = os.path.join(base_dir, 'feedback_logs')
-    os.makedirs(feedback_dir, exist_ok=True)
-    feedback_file = os.path.join(feedback_dir, f"feedback_{datetime.now().strftime('%Y%m%d')}.jsonl")
-    
-    with open(feedback_file, 'a', encoding='utf-8') as f:
-        f.write(json.dumps(feedback_data) + '\n')
+    feedback_logs.append(feedback_data)
 
 
-def log_conversation(conversation_id, patient_data, entry):
+def log_conversation(conversation_id, patient_data, entry, model_name=MODEL_NAME, latency_ms=None, coverage=None):
     """Log conversation for analysis"""
     log_entry = {
         'conversation_id': conversation_id,
-        'patient_name': patient_data['name'],
-        'condition': patient_data['condition_name'],
-        'personality_type': patient_data['personality_type'],
-        'timestamp': entry['timestamp'],
-        'doctor_message': entry['doctor'],
-        'patient_response': entry['patient'],
-        'model_name': MODEL_NAME,
-        'symptoms_revealed': entry['symptoms_revealed'],
-        'diagnosis_attempts': entry['diagnosis_attempts'],
-        'session_end': entry['session_end']
+        'patient_name': patient_data.name,
+        'condition': patient_data.condition_name,
+        'personality_type': patient_data.personality_type,
+        'timestamp': entry.timestamp,
+        'doctor_message': entry.doctor,
+        'patient_response': entry.patient,
+        'model_name': model_name,
+        'symptoms_revealed': list(entry.symptoms_revealed),
+        'diagnosis_attempts': entry.diagnosis_attempts,
+        'session_end': entry.session_end,
+        'diagnosis_given': patient_data.diagnosis_given,
+        'latency_ms': round(latency_ms, 1) if latency_ms is not None else None
     }
+    if coverage is not None:
+        # Cumulative: the last turn of a conversation holds its final coverage
+        log_entry['disclosed_symptoms'] = coverage['bits']
+        log_entry['symptom_coverage'] = coverage['coverage']
+        log_entry['primary_coverage'] = round(coverage['primary_disclosed'] / coverage['primary_total'], 3) if coverage['primary_total'] else None
+        log_entry['newly_disclosed'] = coverage['newly_disclosed']
     
     # Save to log file
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    logs_dir = os.path.join(base_dir, 'logs')
-    os.makedirs(logs_dir, exist_ok=True)
-    log_file = os.path.join(logs_dir, f"conversations_{datetime.now().strftime('%Y%m%d')}.jsonl")
-    
-    with open(log_file, 'a', encoding='utf-8') as f:
-        f.write(json.dumps(log_entry) + '\n')
+    conversation_logs.append(log_entry)
+
+# A stalled TTS call would otherwise hold its thread (or greenlet) forever
+TTS_TIMEOUT = float(os.getenv('TTS_TIMEOUT', '30'))
 
 @app.route('/generate_audio', methods=['POST'])
 def generate_audio():
@@ -763,7 +1041,7 @@ def generate_audio():
     try:
         data = request.get_json()
         message = data.get('message', '')
-        patient_data = session.get('patient_data')
+        patient_data = session_patient()
         
         if not message or not patient_data:
             return jsonify({'error': 'Missing message or patient data'}), 400
@@ -803,7 +1081,8 @@ def generate_audio():
         if voice_prompt:
             payload["text"] = f"[{voice_prompt}] {cleaned_message}"
         
-        response = requests.post(url, json=payload, headers=headers)
+        import requests
+        response = requests.post(url, json=payload, headers=headers, timeout=TTS_TIMEOUT)
         
         if response.status_code == 200:
             # Save audio file temporarily
@@ -912,105 +1191,106 @@ def build_voice_prompt(message, patient_data):
         print(f"Error building voice prompt: {e}")
         return "Patient speaking naturally"
 
+def download_day(store, filename, label):
+    """Stream one day of logs; .jsonl streams decompressed JSONL, .jsonl.gz sends the archive"""
+    # Validate filename to prevent directory traversal
+    if not filename.startswith(store.prefix) or not filename.endswith(('.jsonl', '.jsonl.gz')):
+        return jsonify({'error': 'Invalid filename'}), 400
+    
+    entry = store.entry_for(filename)
+    if entry is None:
+        return jsonify({'error': 'File not found'}), 404
+    
+    if filename.endswith('.gz'):
+        if not entry['compressed']:
+            return jsonify({'error': f'{label} for {entry["day"]} are not archived yet'}), 404
+        from flask import send_file
+        # send_file handles Range/conditional requests on the archive itself
+        return send_file(os.path.join(store.directory, entry['name']), as_attachment=True,
+                         download_name=filename, mimetype='application/gzip', conditional=True)
+    return stream_download(store, [entry], filename, request.range)
+
+def download_days(store, label):
+    """Stream the latest day, or the days from ?from=YYYYMMDD to ?to=YYYYMMDD concatenated"""
+    days = store.days()
+    if not days:
+        return jsonify({'error': f'No {label} files found'}), 404
+    
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
+    if not date_from and not date_to:
+        latest = days[0]
+        return stream_download(store, [latest], f"{store.prefix}{latest['day']}.jsonl", request.range)
+    
+    date_from = date_from or days[-1]['day']
+    date_to = date_to or days[0]['day']
+    selected = [e for e in days if date_from <= e['day'] <= date_to]
+    if not selected:
+        return jsonify({'error': f'No {label} files between {date_from} and {date_to}'}), 404
+    return stream_download(store, selected, f"{store.prefix}{date_from}-{date_to}.jsonl", request.range)
+
+def list_days(store, limit=5):
+    """File listing from the store manifest (no directory scan)"""
+    files = []
+    for entry in store.days()[:limit]:
+        info = {
+            'filename': f"{store.prefix}{entry['day']}.jsonl",
+            'archived': entry['compressed'],
+            'size': entry['raw_size']
+        }
+        try:
+            info['line_count'] = store.count_lines(entry)
+            if entry['compressed']:
+                info['archive'] = entry['name']
+                info['compressed_size'] = entry['compressed_size']
+            else:
+                info['last_modified'] = entry['last_modified']
+        except Exception as e:
+            info['error'] = str(e)
+        files.append(info)
+    return files
+
 @app.route('/download_logs/<filename>')
 def download_logs(filename):
-    """Download a specific conversation log file"""
+    """Download a specific conversation log file (supports HTTP Range)"""
     try:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        logs_dir = os.path.join(base_dir, 'logs')
-        
-        if not os.path.exists(logs_dir):
+        if not os.path.exists(conversation_logs.directory):
             return jsonify({'error': 'No logs directory found'}), 404
-        
-        # Validate filename to prevent directory traversal
-        if not filename.startswith('conversations_') or not filename.endswith('.jsonl'):
-            return jsonify({'error': 'Invalid filename'}), 400
-        
-        log_path = os.path.join(logs_dir, filename)
-        
-        if not os.path.exists(log_path):
-            return jsonify({'error': 'File not found'}), 404
-        
-        from flask import send_file
-        return send_file(log_path, as_attachment=True, download_name=filename)
+        return download_day(conversation_logs, filename, 'Logs')
         
     except Exception as e:
         return jsonify({'error': f'Failed to download logs: {str(e)}'}), 500
 
 @app.route('/download_feedback/<filename>')
 def download_feedback(filename):
-    """Download a specific feedback log file"""
+    """Download a specific feedback log file (supports HTTP Range)"""
     try:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        feedback_dir = os.path.join(base_dir, 'feedback_logs')
-        
-        if not os.path.exists(feedback_dir):
+        if not os.path.exists(feedback_logs.directory):
             return jsonify({'error': 'No feedback directory found'}), 400
-        
-        # Validate filename to prevent directory traversal
-        if not filename.startswith('feedback_') or not filename.endswith('.jsonl'):
-            return jsonify({'error': 'Invalid filename'}), 400
-        
-        feedback_path = os.path.join(feedback_dir, filename)
-        
-        if not os.path.exists(feedback_path):
-            return jsonify({'error': 'File not found'}), 404
-        
-        from flask import send_file
-        return send_file(feedback_path, as_attachment=True, download_name=filename)
+        return download_day(feedback_logs, filename, 'Feedback')
         
     except Exception as e:
         return jsonify({'error': f'Failed to download feedback: {str(e)}'}), 500
 
-# Keep the old routes for backward compatibility but mark them as deprecated
+# Keep the old routes for backward compatibility; they also take ?from=&to= date ranges
 @app.route('/download_logs')
 def download_logs_legacy():
-    """Download the most recent conversation log file (deprecated)"""
+    """Download the most recent conversation log file, or a date range concatenated"""
     try:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        logs_dir = os.path.join(base_dir, 'logs')
-        
-        if not os.path.exists(logs_dir):
+        if not os.path.exists(conversation_logs.directory):
             return jsonify({'error': 'No logs directory found'}), 404
-        
-        # Get the most recent log file
-        log_files = [f for f in os.listdir(logs_dir) if f.startswith('conversations_') and f.endswith('.jsonl')]
-        if not log_files:
-            return jsonify({'error': 'No log files found'}), 404
-        
-        # Sort by date and get the most recent
-        log_files.sort(reverse=True)
-        latest_log = log_files[0]
-        log_path = os.path.join(logs_dir, latest_log)
-        
-        from flask import send_file
-        return send_file(log_path, as_attachment=True, download_name=latest_log)
+        return download_days(conversation_logs, 'log')
         
     except Exception as e:
         return jsonify({'error': f'Failed to download logs: {str(e)}'}), 500
 
 @app.route('/download_feedback')
 def download_feedback_legacy():
-    """Download the most recent feedback log file (deprecated)"""
+    """Download the most recent feedback log file, or a date range concatenated"""
     try:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        feedback_dir = os.path.join(base_dir, 'feedback_logs')
-        
-        if not os.path.exists(feedback_dir):
+        if not os.path.exists(feedback_logs.directory):
             return jsonify({'error': 'No feedback directory found'}), 400
-        
-        # Get the most recent feedback file
-        feedback_files = [f for f in os.listdir(feedback_dir) if f.startswith('feedback_') and f.endswith('.jsonl')]
-        if not feedback_files:
-            return jsonify({'error': 'No feedback files found'}), 400
-        
-        # Sort by date and get the most recent
-        feedback_files.sort(reverse=True)
-        latest_feedback = feedback_files[0]
-        feedback_path = os.path.join(feedback_dir, latest_feedback)
-        
-        from flask import send_file
-        return send_file(feedback_path, as_attachment=True, download_name=latest_feedback)
+        return download_days(feedback_logs, 'feedback')
         
     except Exception as e:
         return jsonify({'error': f'Failed to download feedback: {str(e)}'}), 500
@@ -1019,36 +1299,12 @@ def download_feedback_legacy():
 def view_logs():
     """View logs in browser (for debugging)"""
     try:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        logs_dir = os.path.join(base_dir, 'logs')
-        
-        if not os.path.exists(logs_dir):
+        if not os.path.exists(conversation_logs.directory):
             return jsonify({'error': 'No logs directory found'}), 404
         
-        # Get all log files
-        log_files = [f for f in os.listdir(logs_dir) if f.startswith('conversations_') and f.endswith('.jsonl')]
-        log_files.sort(reverse=True)
-        
-        logs_data = []
-        for log_file in log_files[:5]:  # Show last 5 log files
-            log_path = os.path.join(logs_dir, log_file)
-            try:
-                with open(log_path, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                    logs_data.append({
-                        'filename': log_file,
-                        'line_count': len(lines),
-                        'last_modified': os.path.getmtime(log_path)
-                    })
-            except Exception as e:
-                logs_data.append({
-                    'filename': log_file,
-                    'error': str(e)
-                })
-        
         return jsonify({
-            'logs_directory': logs_dir,
-            'log_files': logs_data
+            'logs_directory': conversation_logs.directory,
+            'log_files': list_days(conversation_logs)  # Show last 5 log files
         })
         
     except Exception as e:
@@ -1058,40 +1314,127 @@ def view_logs():
 def view_feedback():
     """View feedback in browser (for debugging)"""
     try:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        feedback_dir = os.path.join(base_dir, 'feedback_logs')
-        
-        if not os.path.exists(feedback_dir):
+        if not os.path.exists(feedback_logs.directory):
             return jsonify({'error': 'No feedback directory found'}), 404
         
-        # Get all feedback files
-        feedback_files = [f for f in os.listdir(feedback_dir) if f.startswith('feedback_') and f.endswith('.jsonl')]
-        feedback_files.sort(reverse=True)
-        
-        feedback_data = []
-        for feedback_file in feedback_files[:5]:  # Show last 5 feedback files
-            feedback_path = os.path.join(feedback_dir, feedback_file)
-            try:
-                with open(feedback_path, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                    feedback_data.append({
-                        'filename': feedback_file,
-                        'line_count': len(lines),
-                        'last_modified': os.path.getmtime(feedback_path)
-                    })
-            except Exception as e:
-                feedback_data.append({
-                    'filename': feedback_file,
-                    'error': str(e)
-                })
-        
         return jsonify({
-            'feedback_directory': feedback_dir,
-            'feedback_files': feedback_data
+            'feedback_directory': feedback_logs.directory,
+            'feedback_files': list_days(feedback_logs)  # Show last 5 feedback files
         })
         
     except Exception as e:
         return jsonify({'error': f'Failed to view feedback: {str(e)}'}), 500
 
+@app.route('/feedback_stats')
+def feedback_stats():
+    """Rating mean/variance/histograms overall or per condition, persona or model (?by=)"""
+    by = request.args.get('by')
+    if by not in (None, 'condition', 'persona', 'model'):
+        return jsonify({'error': 'by must be one of condition, persona, model'}), 400
+    return jsonify(feedback_aggregator.stats(by))
+
+# ---------------- PROFILING (PROFILING_TOKEN) ----------------
+def profiling_token():
+    # Header only: a query-string token would end up in access logs and browser history
+    return request.headers.get('X-Profile-Token')
+
+def profiling_denied():
+    # 404 rather than 403 so the endpoints don't advertise themselves
+    return jsonify({'error': 'Not found'}), 404
+
+# Server-Timing header with the request's CPU and wall time (SERVER_TIMING=1),
+# read by tools/replay_traffic.py
+app.config['SERVER_TIMING'] = os.getenv('SERVER_TIMING') == '1'
+
+@app.before_request
+def start_server_timing():
+    if app.config['SERVER_TIMING']:
+        g.timing_started = (time.perf_counter(), time.thread_time())
+
+@app.after_request
+def add_server_timing(response):
+    started = g.pop('timing_started', None)
+    if started is not None:
+        wall = (time.perf_counter() - started[0]) * 1000
+        cpu = (time.thread_time() - started[1]) * 1000
+        response.headers['Server-Timing'] = f"cpu;dur={cpu:.2f}, app;dur={wall:.2f}"
+    return response
+
+@app.before_request
+def start_request_profile():
+    """cProfile this request when it carries X-Profile: 1 and a valid token"""
+    if request.headers.get('X-Profile') == '1' and profiling_authorized(profiling_token()):
+        g.request_profile = request_profiler.start()
+
+@app.after_request
+def finish_request_profile(response):
+    if 'request_profile' not in g:
+        return response
+    profile = g.pop('request_profile')
+    if profile is None:
+        # Another request in this worker is being profiled
+        response.headers['X-Profile-File'] = 'busy'
+    else:
+        result = request_profiler.finish(profile, request.endpoint or request.path)
+        response.headers['X-Profile-File'] = result['file']
+        response.headers['X-Profile-Seconds'] = str(result['total_seconds'])
+    return response
+
+@app.route('/debug/profile/sample')
+def profile_sample():
+    """Sample every thread of this worker for ?seconds= and return collapsed stacks"""
+    if not profiling_authorized(profiling_token()):
+        return profiling_denied()
+    result = stack_sampler.sample(
+        request.args.get('seconds', 10, type=float),
+        interval=request.args.get('interval', 0.005, type=float),
+        idle=request.args.get('idle') == '1'
+    )
+    if result is None:
+        return jsonify({'error': 'A sampling run is already in progress in this worker'}), 409
+    if request.args.get('format') == 'json':
+        return jsonify(dict(result, stacks=dict(result['stacks'].most_common(200)), pid=os.getpid()))
+    return Response(
+        collapse(result['stacks']),
+        mimetype='text/plain',
+        headers={
+            'Content-Disposition': f"attachment; filename=stacks_{os.getpid()}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+            'X-Profile-Samples': str(result['samples']),
+        }
+    )
+
+@app.route('/debug/profile/requests/<name>')
+def profile_download(name):
+    """Download a saved per-request .prof file (open with pstats or snakeviz)"""
+    if not profiling_authorized(profiling_token()):
+        return profiling_denied()
+    path = request_profiler.path(name)
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    from flask import send_file
+    return send_file(path, as_attachment=True, download_name=name, mimetype='application/octet-stream')
+
+@app.route('/debug/memory', methods=['GET', 'POST'])
+def memory_trace():
+    """tracemalloc: POST ?action=start|stop, GET a diff against the baseline"""
+    if not profiling_authorized(profiling_token()):
+        return profiling_denied()
+    if request.method == 'POST':
+        action = request.args.get('action')
+        if action == 'start':
+            return jsonify(memory_tracer.start())
+        if action == 'stop':
+            return jsonify(memory_tracer.stop())
+        return jsonify({'error': 'action must be start or stop'}), 400
+    diff = memory_tracer.diff(
+        top=request.args.get('top', 25, type=int),
+        key_type='traceback' if request.args.get('group') == 'traceback' else 'lineno',
+        match=request.args.get('match'),
+        rebase=request.args.get('rebase') == '1'
+    )
+    if diff is None:
+        return jsonify(dict(memory_tracer.status(), error='Not tracing; POST /debug/memory?action=start first')), 409
+    return jsonify(dict(diff, **memory_tracer.status(), pid=os.getpid()))
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
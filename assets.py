@@ -0,0 +1,176 @@
+# assets.py - Precompressed, fingerprinted static assets for the avatar pages
+#
+# The 3D chat pages pull three.min.js (~650KB) and OrbitControls.js through
+# Flask's default static handler: uncompressed and without long-lived cache
+# headers. The build step here:
+#   - writes each asset under static/dist/ with a content hash in its name
+#   - stores .gz (and .br when the brotli package is installed) next to it
+# and AssetPipeline.send() serves the best precompressed variant with immutable caching.
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+from typing import Dict, Optional
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+MANIFEST_VERSION = 1
+ASSET_URL_PREFIX = '/assets/'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Logical asset paths (relative to static/) that go through the pipeline
+ASSET_SOURCES = [
+    'vendor/three/three.min.js',
+    'vendor/three/OrbitControls.js',
+]
+
+
+def _fingerprint(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def _fingerprinted_name(logical_path: str, digest: str) -> str:
+    root, ext = os.path.splitext(logical_path)
+    return f"{root}.{digest}{ext}"
+
+
+def _write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class AssetPipeline:
+    def __init__(self, static_dir: str, dist_dir: Optional[str] = None):
+        self.static_dir = static_dir
+        self.dist_dir = dist_dir or os.path.join(static_dir, 'dist')
+        self.manifest_path = os.path.join(self.dist_dir, 'manifest.json')
+        self.manifest: Dict = {'assets': {}}
+        self._served: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    # ---------------- BUILD ----------------
+    def _collect_sources(self) -> Dict[str, bytes]:
+        """Read every asset that goes through the pipeline, keyed by logical path"""
+        sources = {}
+        for logical_path in ASSET_SOURCES:
+            path = os.path.join(self.static_dir, logical_path)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    sources[logical_path] = f.read()
+        return sources
+
+    def _source_digest(self, sources: Dict[str, bytes]) -> str:
+        h = hashlib.sha256()
+        for logical_path in sorted(sources):
+            h.update(logical_path.encode('utf-8'))
+            h.update(sources[logical_path])
+        h.update(b'br' if brotli else b'gz')
+        return h.hexdigest()
+
+    def build(self) -> Dict:
+        """Fingerprint and precompress all assets; returns the new manifest"""
+        sources = self._collect_sources()
+        assets = {}
+        for logical_path, data in sources.items():
+            name = _fingerprinted_name(logical_path, _fingerprint(data))
+            out_path = os.path.join(self.dist_dir, name)
+            encodings = ['gzip']
+            _write(out_path, data)
+            _write(out_path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                _write(out_path + '.br', brotli.compress(data, quality=11))
+                encodings.insert(0, 'br')
+            assets[logical_path] = {
+                'path': name,
+                'size': len(data),
+                'encodings': encodings,
+            }
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'source_digest': self._source_digest(sources),
+            'assets': assets,
+        }
+        _write(self.manifest_path, json.dumps(manifest, indent=2).encode('utf-8'))
+        self._prune(manifest)
+        return manifest
+
+    def _prune(self, manifest: Dict):
+        """Delete fingerprinted files left over from earlier builds"""
+        keep = {os.path.normpath(a['path']) for a in manifest['assets'].values()}
+        for dirpath, _, filenames in os.walk(self.dist_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                rel = os.path.relpath(path, self.dist_dir)
+                base = rel[:-3] if rel.endswith(('.gz', '.br')) else rel
+                if rel != 'manifest.json' and os.path.normpath(base) not in keep:
+                    os.remove(path)
+
+    def load(self) -> Dict:
+        """Load the manifest, rebuilding it when the sources have changed"""
+        with self._lock:
+            sources = self._collect_sources()
+            manifest = None
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                pass
+            if not manifest or manifest.get('version') != MANIFEST_VERSION or manifest.get('source_digest') != self._source_digest(sources):
+                try:
+                    manifest = self.build()
+                    print(f"[Assets] Built {len(manifest['assets'])} fingerprinted assets in {self.dist_dir}")
+                except OSError as e:
+                    # Read-only deploys keep serving the plain /static files
+                    print(f"[Assets] Could not build assets ({e}); serving unversioned static files")
+                    manifest = {'assets': {}}
+            self.manifest = manifest
+            self._served = {a['path']: a for a in manifest['assets'].values()}
+            return manifest
+
+    # ---------------- SERVE ----------------
+    def url(self, logical_path: str) -> str:
+        """URL for an asset: fingerprinted when built, plain /static otherwise"""
+        asset = self.manifest['assets'].get(logical_path)
+        if asset:
+            return ASSET_URL_PREFIX + asset['path']
+        return '/static/' + logical_path
+
+    def send(self, filename: str, accept_encoding: str):
+        """Flask response for a fingerprinted asset, precompressed when the client allows it"""
+        from flask import abort, send_file
+
+        asset = self._served.get(filename)
+        if asset is None:
+            abort(404)
+
+        accepted = set()
+        for part in accept_encoding.lower().split(','):
+            token, _, params = part.strip().partition(';')
+            if token and params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                accepted.add(token)
+
+        path = os.path.join(self.dist_dir, asset['path'])
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if candidate in asset['encodings'] and (candidate in accepted or '*' in accepted):
+                encoding = candidate
+                path += suffix
+                break
+
+        mimetype = mimetypes.guess_type(asset['path'])[0] or 'application/octet-stream'
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=True, max_age=31536000)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
@@ -0,0 +1,49 @@
+# cooperative.py - gevent (cooperative) gunicorn workers
+#
+# With GUNICORN_WORKER_CLASS=gevent every request runs in a greenlet, so a
+# conversation waiting on the LLM costs a few KB instead of one of the
+# worker's GUNICORN_THREADS threads, and one worker holds hundreds of waiting
+# conversations (tools/bench_concurrency.py). That is only safe when every
+# blocking call yields to the other greenlets:
+#   - gunicorn.conf.py calls patch() before the app is preloaded, so socket,
+#     ssl, select, threading, queue and time.sleep are gevent's everywhere:
+#     the openai client (httpx over sockets), requests (/generate_audio), the
+#     admission controller's conditions, the action event streams, the
+#     WebSocket and the background log writer all wait cooperatively
+#   - the worker is CooperativeWorker, gunicorn's gevent worker minus its own
+#     patch_all() after the fork, which would undo the non-aggressive patch
+#   - sqlite (shared_cache, action_events) and file writes block the worker while they run;
+#     they are short, and the shared cache keeps one sqlite connection per OS
+#     thread rather than opening one per greenlet
+#   - CPU-bound work (symptom matching, prompt building) runs between waits as
+#     before: one worker still uses at most one core
+# Imported only by gunicorn.conf.py in gevent mode; requires gevent.
+
+from typing import List
+
+from gevent import monkey, socket
+from gunicorn.workers.ggevent import GeventWorker
+
+# Modules the app's waits go through; all of them must be gevent's
+REQUIRED_PATCHES = ('socket', 'ssl', 'select', 'selectors', 'threading', 'time', 'queue')
+
+
+def patch():
+    """Monkey-patch the standard library for gevent (before the app is imported)"""
+    # Not aggressive: keep select.epoll. httpcore imports trio when it is
+    # installed, and trio's import fails without epoll (AttributeError, which
+    # httpcore doesn't catch). select/poll and selectors.DefaultSelector are
+    # still gevent's; nothing in the app creates an epoll object itself.
+    monkey.patch_all(aggressive=False)
+
+
+def unpatched() -> List[str]:
+    """Required modules gevent has not patched (empty when the worker is cooperative-safe)"""
+    return [name for name in REQUIRED_PATCHES if not monkey.is_module_patched(name)]
+
+
+class CooperativeWorker(GeventWorker):
+    """gunicorn's gevent worker, relying on the master's patch() instead of patching again"""
+
+    def patch(self):
+        self.sockets = [socket.socket(s.FAMILY, socket.SOCK_STREAM, fileno=s.sock.fileno()) for s in self.sockets]
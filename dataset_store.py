@@ -0,0 +1,278 @@
+# dataset_store.py - Compiled patient dataset (symptoms + personas) with hot reload
+#
+# The NHS symptom JSON and personas.json are compiled into one versioned binary
+# artifact. Every string is stored once in a string table; conditions point at a
+# slice of the symptom table with the primary/secondary split precomputed, so the
+# runtime never has to care which JSON format the data came from. Workers
+# memory-map the artifact (the pages are shared between processes) and swap in a
+# new one when the file is replaced.
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+MAGIC = b'MPSD'
+FORMAT_VERSION = 1
+
+FLAG_PRIORITIZED = 0x1
+
+# magic, format version, flags, source digest, #strings, #symptom refs, #conditions, #personas
+_HEADER = struct.Struct('<4sHH8sIIII')
+# name, first symptom ref, #primary, #secondary
+_CONDITION = struct.Struct('<IIHH')
+# string ids for PERSONA_STRING_FIELDS followed by age
+PERSONA_STRING_FIELDS = ('id', 'name', 'occupation', 'personality_traits', 'behavior_notes', 'communication_style')
+_PERSONA = struct.Struct('<%dII' % len(PERSONA_STRING_FIELDS))
+_U32 = struct.Struct('<I')
+
+# How often (seconds) a worker stats the artifact to see if it was replaced
+DATASET_CHECK_INTERVAL = float(os.getenv('DATASET_CHECK_INTERVAL', '5'))
+
+
+# ---------------- BUILD ----------------
+def _source_digest(paths: List[str]) -> bytes:
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.digest()[:8]
+
+
+def pick_symptom_source(candidates: List[str]) -> str:
+    """Return the first existing symptom dataset (prioritized before exact)"""
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No symptom dataset found in {os.path.dirname(candidates[0])}")
+
+
+def compile_dataset(nhs_path: str, personas_path: str) -> bytes:
+    """Compile the symptom dataset and personas into the binary artifact format"""
+    with open(nhs_path, 'r', encoding='utf-8') as f:
+        nhs_data = json.load(f)
+    with open(personas_path, 'r', encoding='utf-8') as f:
+        personas = json.load(f)['personalities']
+
+    strings: List[str] = []
+    string_ids: Dict[str, int] = {}
+
+    def intern(s) -> int:
+        s = str(s)
+        sid = string_ids.get(s)
+        if sid is None:
+            sid = string_ids[s] = len(strings)
+            strings.append(s)
+        return sid
+
+    prioritized = bool(nhs_data) and isinstance(next(iter(nhs_data.values())), dict)
+    symptom_refs: List[int] = []
+    conditions = []
+    for disease, disease_data in nhs_data.items():
+        if prioritized:
+            primary = disease_data.get('primary_symptoms', [])
+            secondary = disease_data.get('secondary_symptoms', [])
+        else:
+            # Old format: first 3 symptoms are treated as primary
+            primary = disease_data[:min(3, len(disease_data))]
+            secondary = disease_data[min(3, len(disease_data)):]
+        conditions.append((intern(disease), len(symptom_refs), len(primary), len(secondary)))
+        symptom_refs.extend(intern(s) for s in list(primary) + list(secondary))
+
+    persona_rows = [
+        tuple(intern(p.get(field, '')) for field in PERSONA_STRING_FIELDS) + (int(p.get('age', 0)),)
+        for p in personas
+    ]
+
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = [0]
+    for b in encoded:
+        offsets.append(offsets[-1] + len(b))
+
+    out = bytearray(_HEADER.pack(
+        MAGIC, FORMAT_VERSION, FLAG_PRIORITIZED if prioritized else 0,
+        _source_digest([nhs_path, personas_path]),
+        len(strings), len(symptom_refs), len(conditions), len(persona_rows),
+    ))
+    out += struct.pack('<%dI' % len(offsets), *offsets)
+    out += struct.pack('<%dI' % len(symptom_refs), *symptom_refs)
+    for row in conditions:
+        out += _CONDITION.pack(*row)
+    for row in persona_rows:
+        out += _PERSONA.pack(*row)
+    out += b''.join(encoded)
+    return bytes(out)
+
+
+def write_artifact(data: bytes, path: str):
+    """Write the artifact atomically so readers never see a partial file"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# ---------------- READ ----------------
+class CompiledDataset:
+    """Read-only view over a compiled artifact (an mmap or an in-memory buffer)"""
+
+    def __init__(self, buf, path: Optional[str] = None):
+        self._buf = buf
+        self.path = path
+        magic, version, flags, digest, n_strings, n_refs, n_conditions, n_personas = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Not a compiled patient dataset: {path}")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported dataset format version {version} (expected {FORMAT_VERSION})")
+
+        self.format_version = version
+        self.prioritized = bool(flags & FLAG_PRIORITIZED)
+        self.source_digest = digest
+        self._n_strings = n_strings
+        self._offsets_at = _HEADER.size
+        self._refs_at = self._offsets_at + (n_strings + 1) * 4
+        self._conditions_at = self._refs_at + n_refs * 4
+        self._personas_at = self._conditions_at + n_conditions * _CONDITION.size
+        self._blob_at = self._personas_at + n_personas * _PERSONA.size
+        self._strings: Dict[int, str] = {}
+        self._symptoms: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]] = {}
+
+        self._conditions = {}
+        for i in range(n_conditions):
+            name_sid, first, n_primary, n_secondary = _CONDITION.unpack_from(buf, self._conditions_at + i * _CONDITION.size)
+            self._conditions[self.string(name_sid)] = (first, n_primary, n_secondary)
+        self.disease_names = list(self._conditions)
+
+        self.personas = []
+        for i in range(n_personas):
+            row = _PERSONA.unpack_from(buf, self._personas_at + i * _PERSONA.size)
+            persona = {field: self.string(sid) for field, sid in zip(PERSONA_STRING_FIELDS, row)}
+            persona['age'] = row[-1]
+            self.personas.append(persona)
+
+    @classmethod
+    def open(cls, path: str) -> 'CompiledDataset':
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buf, path)
+
+    def string(self, sid: int) -> str:
+        """Decode (once) and return an interned string from the string table"""
+        s = self._strings.get(sid)
+        if s is None:
+            start, end = struct.unpack_from('<II', self._buf, self._offsets_at + sid * 4)
+            s = self._strings[sid] = sys.intern(bytes(self._buf[self._blob_at + start:self._blob_at + end]).decode('utf-8'))
+        return s
+
+    def __contains__(self, disease: str) -> bool:
+        return disease in self._conditions
+
+    def symptoms(self, disease: str) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        """Return (primary_symptoms, secondary_symptoms) for a condition"""
+        split = self._symptoms.get(disease)
+        if split is None:
+            first, n_primary, n_secondary = self._conditions[disease]
+            sids = struct.unpack_from('<%dI' % (n_primary + n_secondary), self._buf, self._refs_at + first * 4)
+            names = tuple(self.string(sid) for sid in sids)
+            split = self._symptoms[disease] = (names[:n_primary], names[n_primary:])
+        return split
+
+    def primary_symptoms(self, disease: str) -> List[str]:
+        return list(self.symptoms(disease)[0])
+
+    def secondary_symptoms(self, disease: str) -> List[str]:
+        return list(self.symptoms(disease)[1])
+
+    def all_symptoms(self, disease: str) -> List[str]:
+        primary, secondary = self.symptoms(disease)
+        return list(primary + secondary)
+
+
+# ---------------- HOT RELOAD ----------------
+class DatasetStore:
+    """
+    Owns the current CompiledDataset for a process. The artifact is rebuilt on
+    load if it is missing or was built from different sources, and swapped for
+    a fresh mapping whenever the file on disk is replaced.
+    """
+
+    def __init__(self, artifact_path: str, symptom_sources: List[str], personas_path: str,
+                 check_interval: float = DATASET_CHECK_INTERVAL):
+        self.artifact_path = artifact_path
+        self.symptom_sources = symptom_sources
+        self.personas_path = personas_path
+        self.check_interval = check_interval
+        self._dataset: Optional[CompiledDataset] = None
+        self._stat = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def build(self) -> bytes:
+        """Compile the sources and write the artifact; returns the compiled bytes"""
+        data = compile_dataset(pick_symptom_source(self.symptom_sources), self.personas_path)
+        write_artifact(data, self.artifact_path)
+        return data
+
+    def _is_stale(self) -> bool:
+        try:
+            dataset = CompiledDataset.open(self.artifact_path)
+        except (OSError, ValueError, struct.error):
+            return True
+        sources = [pick_symptom_source(self.symptom_sources), self.personas_path]
+        return dataset.source_digest != _source_digest(sources)
+
+    def load(self) -> CompiledDataset:
+        """Make sure the artifact is up to date and map it"""
+        with self._lock:
+            if self._is_stale():
+                try:
+                    self.build()
+                    print(f"[DatasetStore] Compiled dataset artifact {self.artifact_path}")
+                except OSError as e:
+                    # Read-only deploys: compile in memory instead of failing
+                    print(f"[DatasetStore] Could not write {self.artifact_path} ({e}); using in-memory dataset")
+                    data = compile_dataset(pick_symptom_source(self.symptom_sources), self.personas_path)
+                    self._dataset = CompiledDataset(data)
+                    self._last_check = time.monotonic()
+                    return self._dataset
+            self._open()
+            return self._dataset
+
+    def _open(self):
+        st = os.stat(self.artifact_path)
+        self._dataset = CompiledDataset.open(self.artifact_path)
+        self._stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        self._last_check = time.monotonic()
+
+    def current(self) -> Optional[CompiledDataset]:
+        """Return the live dataset, reopening it if the artifact was replaced"""
+        if self._stat is not None and time.monotonic() - self._last_check >= self.check_interval:
+            self._maybe_reload()
+        return self._dataset
+
+    def _maybe_reload(self):
+        if not self._lock.acquire(blocking=False):
+            return  # another thread is already checking
+        try:
+            self._last_check = time.monotonic()
+            try:
+                st = os.stat(self.artifact_path)
+            except OSError:
+                return  # keep serving the mapped copy
+            if (st.st_ino, st.st_mtime_ns, st.st_size) == self._stat:
+                return
+            try:
+                self._open()
+                print(f"[DatasetStore] Reloaded dataset artifact ({len(self._dataset.disease_names)} diseases)")
+            except (OSError, ValueError, struct.error) as e:
+                print(f"[DatasetStore] Ignoring unreadable artifact {self.artifact_path}: {e}")
+        finally:
+            self._lock.release()
@@ -0,0 +1,144 @@
+# dedup.py - Near-duplicate conversation detection (MinHash + LSH banding)
+#
+# Each conversation's assistant (patient) turns are normalized and cut into
+# word shingles; a MinHash signature estimates the Jaccard similarity of two
+# shingle sets. Signatures are split into bands and each band is hashed into a
+# bucket, so only conversations sharing a bucket are compared: the work per
+# conversation is constant instead of growing with the corpus. The filter is
+# streaming (first occurrence wins), so it works over corpora that never fit
+# in one list.
+
+import hashlib
+import json
+import re
+import unicodedata
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_NUM_PERM = 128
+DEFAULT_SHINGLE_SIZE = 5
+SEED = 1
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_WORD_RE = re.compile(r"[a-z0-9']+")
+
+
+def shingles(text: str, size: int = DEFAULT_SHINGLE_SIZE) -> set:
+    """Word `size`-grams of the normalized text (the whole text when it is shorter)"""
+    words = _WORD_RE.findall(unicodedata.normalize("NFKC", text).lower().replace("’", "'"))
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _shingle_hash(shingle: str) -> int:
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little")
+
+
+def optimal_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    (bands, rows) with bands * rows <= num_perm whose S-curve threshold
+    (1/bands) ** (1/rows) is closest to `threshold`
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = DEFAULT_NUM_PERM, shingle_size: int = DEFAULT_SHINGLE_SIZE, seed: int = SEED):
+        import numpy as np
+
+        self.np = np
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        # a < 2**31 and 32-bit shingle hashes keep a * h + b inside uint64
+        self.a = rng.randint(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 31, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str):
+        np = self.np
+        grams = shingles(text, self.shingle_size)
+        if not grams:
+            return np.full(self.num_perm, _MAX_HASH, dtype=np.uint32)
+        hashes = np.fromiter((_shingle_hash(g) for g in grams), dtype=np.uint64, count=len(grams))
+        permuted = (hashes[:, None] * self.a + self.b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+
+class NearDuplicateFilter:
+    """
+    Streaming near-duplicate filter. check(key, text) returns None for a new
+    conversation (which is then indexed) or (kept_key, similarity) when an
+    already indexed conversation is at least `threshold` similar.
+    """
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, num_perm: int = DEFAULT_NUM_PERM,
+                 shingle_size: int = DEFAULT_SHINGLE_SIZE):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, shingle_size)
+        self.bands, self.rows = optimal_bands(threshold, num_perm)
+        self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(self.bands)]
+        self.keys: List = []
+        self.signatures: List = []
+        self.kept = 0
+        self.dropped: List[Dict] = []
+
+    def _band_keys(self, signature) -> List[bytes]:
+        raw = signature.tobytes()
+        width = self.rows * 4
+        return [raw[i * width:(i + 1) * width] for i in range(self.bands)]
+
+    def check(self, key, text: str) -> Optional[Tuple[object, float]]:
+        signature = self.hasher.signature(text)
+        band_keys = self._band_keys(signature)
+        candidates = set()
+        for band, band_key in enumerate(band_keys):
+            candidates.update(self.buckets[band].get(band_key, ()))
+
+        best = None
+        for candidate in candidates:
+            similarity = float((self.signatures[candidate] == signature).mean())
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (candidate, similarity)
+        if best is not None:
+            self.dropped.append({"key": key, "duplicate_of": self.keys[best[0]], "similarity": round(best[1], 3)})
+            return self.keys[best[0]], best[1]
+
+        index = len(self.keys)
+        self.keys.append(key)
+        self.signatures.append(signature)
+        for band, band_key in enumerate(band_keys):
+            self.buckets[band].setdefault(band_key, []).append(index)
+        self.kept += 1
+        return None
+
+    def filter(self, items: Iterable, key, text) -> Iterator:
+        """Yield the items that are not near-duplicates of an earlier item"""
+        for item in items:
+            if self.check(key(item), text(item)) is None:
+                yield item
+
+    def report(self) -> Dict:
+        return {
+            "threshold": self.threshold,
+            "num_perm": self.hasher.num_perm,
+            "shingle_size": self.hasher.shingle_size,
+            "bands": self.bands,
+            "rows": self.rows,
+            "kept": self.kept,
+            "dropped": len(self.dropped),
+            "duplicates": self.dropped,
+        }
+
+    def write_report(self, path: str) -> Dict:
+        report = self.report()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, default=str)
+        return report
@@ -0,0 +1,132 @@
+# disclosure.py - Which of the patient's symptoms have been disclosed so far
+#
+# Every symptom phrase of a case is reduced once to its key terms (stopwords
+# dropped, the rest lemmatized) and indexed term -> symptoms. Each patient
+# reply is normalized the same way and counted against that index, so a turn
+# costs one pass over the reply no matter how long the conversation is. The
+# result is OR-ed into a per-conversation bitset stored on patient_data (bit i
+# = patient_data['symptoms'][i]), which is what ends up in the response and
+# the logs; coverage never needs the history re-scanned.
+
+import math
+import re
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+# A symptom counts as disclosed once this share of its key terms was said
+DISCLOSURE_THRESHOLD = 0.5
+BITS_KEY = 'disclosed_symptoms'
+
+_WORD_RE = re.compile(r"[a-z]+")
+
+# Function words plus the qualifiers the NHS phrasing wraps around symptoms
+# ("a high temperature", "pain that gets worse when you move")
+STOPWORDS = frozenset("""
+a an the and or but if of in on at to for from by with without into onto over under up down out off about
+as is are was were be been being am do does did have has had having get gets getting got can could may might
+will would should must shall it its this that these those there here what which who whom when where why how
+you your yours yourself i me my mine we our us they them their he she him her his hers not no nor so than
+too very more most less some any all each every other such only own same also just even still then once
+feel feeling feels felt like usual usually unusually generally slightly sometimes often always much many lot
+lots thing things way area anywhere everywhere around including body part parts time times new high low
+haven hasn hadn isn aren wasn weren don doesn didn won wouldn couldn shouldn ve ll re
+""".split())
+
+
+@lru_cache(maxsize=1)
+def _lemmatizer():
+    """
+    WordNet lemmatizer when its corpus is installed (python -m nltk.downloader
+    wordnet), otherwise nltk's Snowball stemmer, which needs no data. Either
+    way symptoms and replies go through the same function.
+    """
+    try:
+        from nltk.corpus import wordnet
+        from nltk.stem import WordNetLemmatizer
+        wordnet.ensure_loaded()
+        lemmatizer = WordNetLemmatizer()
+        return lambda word: lemmatizer.lemmatize(lemmatizer.lemmatize(word, 'n'), 'v')
+    except LookupError:
+        from nltk.stem.snowball import SnowballStemmer
+        return SnowballStemmer('english').stem
+
+
+@lru_cache(maxsize=50000)
+def _normalize(word: str) -> str:
+    return _lemmatizer()(word)
+
+
+def key_terms(text: str) -> List[str]:
+    """Lemmatized content words of a text, in order, without duplicates"""
+    terms = []
+    for word in _WORD_RE.findall(text.lower()):
+        if word in STOPWORDS or len(word) < 3:
+            continue
+        term = _normalize(word)
+        if term not in terms:
+            terms.append(term)
+    return terms
+
+
+class SymptomMatcher:
+    """Precompiled matcher for one case's symptom list"""
+
+    def __init__(self, symptoms: Tuple[str, ...]):
+        self.symptoms = symptoms
+        self.required = []
+        self.index: Dict[str, List[int]] = {}
+        for i, symptom in enumerate(symptoms):
+            terms = key_terms(symptom)
+            self.required.append(max(1, math.ceil(len(terms) * DISCLOSURE_THRESHOLD)) if terms else 0)
+            for term in terms:
+                self.index.setdefault(term, []).append(i)
+
+    def match(self, text: str) -> int:
+        """Bitset of the symptoms `text` discloses"""
+        hits = {}
+        for term in key_terms(text):
+            for i in self.index.get(term, ()):
+                hits[i] = hits.get(i, 0) + 1
+        bits = 0
+        for i, count in hits.items():
+            if count >= self.required[i]:
+                bits |= 1 << i
+        return bits
+
+
+@lru_cache(maxsize=512)
+def compile_matcher(symptoms: Tuple[str, ...]) -> SymptomMatcher:
+    # Symptom lists come from the dataset, so cases of the same condition share one matcher
+    return SymptomMatcher(symptoms)
+
+
+def update_disclosure(patient_data: Dict, reply: str) -> Dict:
+    """
+    Match one patient reply, update the bitset on patient_data and return the
+    coverage summary for the response and the log.
+    """
+    symptoms = tuple(patient_data.get('symptoms') or ())
+    previous = patient_data.get(BITS_KEY, 0)
+    bits = previous | compile_matcher(symptoms).match(reply) if symptoms else 0
+    patient_data[BITS_KEY] = bits
+    return coverage_summary(patient_data, bits, bits & ~previous)
+
+
+def coverage_summary(patient_data: Dict, bits: int, new_bits: int = 0) -> Dict:
+    symptoms = patient_data.get('symptoms') or []
+    primary_total = len(patient_data.get('primary_symptoms') or [])
+    primary_mask = (1 << primary_total) - 1
+    disclosed = bin(bits).count('1')
+    return {
+        'disclosed': disclosed,
+        'total': len(symptoms),
+        'coverage': round(disclosed / len(symptoms), 3) if symptoms else 0.0,
+        'primary_disclosed': bin(bits & primary_mask).count('1'),
+        'primary_total': primary_total,
+        'bits': bits,
+        'newly_disclosed': [s for i, s in enumerate(symptoms) if new_bits >> i & 1],
+    }
+
+
+def reset_disclosure(patient_data: Dict):
+    patient_data[BITS_KEY] = 0
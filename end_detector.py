@@ -0,0 +1,80 @@
+# end_detector.py - Conversation-end detection for patient replies
+
+import re
+from typing import Optional
+
+# One alternation with a named group per rule. The old list scans in
+# check_if_should_end_chat collapse into these four rules:
+#   - every "thank(s/ you/you)[,] doc(tor)" literal is covered by the flexible regexes
+#   - "goodbye doctor" is a superset of "bye doctor"
+END_RULES = {
+    'thanks_doctor': r"thank\s*you\s*,?\s*doc|thanks\s*,?\s*doc",
+    'thanks_for_help': r"(?:thank you|thanks) for (?:the diagnosis|helping|your help)",
+    'thanks_so_much': r"(?:thank you|thanks) so much",
+    'farewell': r"bye doctor|see you later|have a good day|take care",
+}
+
+# How far back (in characters) an incremental scan re-reads already-seen text,
+# enough to catch any rule that straddles two tokens.
+STREAM_LOOKBACK = 64
+
+
+class ConversationEndDetector:
+    def __init__(self, rules=None):
+        self.rules = dict(rules or END_RULES)
+        self.pattern = re.compile(
+            "|".join(f"(?P<{name}>{regex})" for name, regex in self.rules.items()),
+            re.IGNORECASE,
+        )
+
+    def detect(self, text: str) -> Optional[str]:
+        """
+        Scan a full reply once and return the name of the rule that fired,
+        or None if the reply does not close the conversation.
+        """
+        if not text:
+            return None
+        match = self.pattern.search(text)
+        return match.lastgroup if match else None
+
+    def stream(self) -> 'StreamingEndDetector':
+        """Start an incremental scan over a token stream"""
+        return StreamingEndDetector(self)
+
+
+class StreamingEndDetector:
+    """
+    Incremental end detection for a streamed reply. Each fed chunk only
+    re-scans a short tail of what came before, so a reply can be flagged as
+    ending as soon as the closing phrase arrives.
+    """
+
+    def __init__(self, detector: ConversationEndDetector):
+        self.detector = detector
+        self.text = ''
+        self.rule = None
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """Add the next chunk of the reply; returns the rule once one has fired"""
+        if self.rule or not chunk:
+            return self.rule
+        start = max(0, len(self.text) - STREAM_LOOKBACK)
+        self.text += chunk
+        match = self.detector.pattern.search(self.text, start)
+        if match:
+            self.rule = match.lastgroup
+        return self.rule
+
+    def finish(self) -> Optional[str]:
+        """Final answer for the whole reply, identical to detect() on the full text"""
+        if self.rule is None:
+            self.rule = self.detector.detect(self.text)
+        return self.rule
+
+    @property
+    def ended(self) -> bool:
+        return self.rule is not None
+
+
+# Global instance
+end_detector = ConversationEndDetector()
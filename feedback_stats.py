@@ -0,0 +1,173 @@
+# feedback_stats.py - Incremental aggregates over the feedback log
+#
+# Keeps a running count / mean / variance (Welford) and a 1-5 histogram for
+# every rating dimension, overall and per condition, persona and model. The
+# aggregator remembers how many bytes of each day's feedback file it has
+# consumed, so a refresh only parses submissions appended since the last one
+# (from any worker, since they all append to the same file) and each entry
+# costs O(1). State is persisted as a small JSON snapshot next to the logs;
+# a restart resumes from it instead of re-reading the history.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+RATINGS = [
+    'authenticity_rating',
+    'educational_value_rating',
+    'interaction_quality_rating',
+    'communication_consistency_rating',
+    'symptom_realism_rating',
+]
+RATING_MIN, RATING_MAX = 1, 5
+BREAKDOWNS = ('condition', 'persona', 'model')
+UNKNOWN = 'unknown'
+SNAPSHOT_VERSION = 1
+# Seconds between snapshot writes
+SNAPSHOT_INTERVAL = 30
+
+# Patient fields kept in a feedback record. With the persona id and the
+# condition, the dataset reproduces the symptoms and traits, so these fields
+# are enough to rebuild the prompt (see MedicalPatientSimulator.restore_patient).
+PATIENT_REFERENCE_FIELDS = ('name', 'age', 'gender', 'occupation', 'personality_type', 'condition_name', 'diagnosis_given')
+
+
+def patient_reference(patient_data: Dict) -> Dict:
+    """Compact stand-in for patient_data in feedback records (no prompt, no symptom lists)"""
+    reference = {field: patient_data[field] for field in PATIENT_REFERENCE_FIELDS if field in patient_data}
+    if patient_data.get('prompt_template'):
+        # Identifies the exact prompt the patient ran with, to check a rebuilt one against
+        reference['prompt_sha256'] = hashlib.sha256(patient_data['prompt_template'].encode('utf-8')).hexdigest()[:16]
+    return reference
+
+
+def _rating(value) -> Optional[int]:
+    try:
+        rating = int(value)
+    except (TypeError, ValueError):
+        return None
+    return rating if RATING_MIN <= rating <= RATING_MAX else None
+
+
+def _new_stats() -> Dict:
+    return {'count': 0, 'mean': 0.0, 'm2': 0.0, 'histogram': [0] * (RATING_MAX - RATING_MIN + 1)}
+
+
+def _update(stats: Dict, rating: int):
+    stats['count'] += 1
+    delta = rating - stats['mean']
+    stats['mean'] += delta / stats['count']
+    stats['m2'] += delta * (rating - stats['mean'])
+    stats['histogram'][rating - RATING_MIN] += 1
+
+
+def _summary(stats: Dict) -> Dict:
+    count = stats['count']
+    return {
+        'count': count,
+        'mean': round(stats['mean'], 3) if count else None,
+        'variance': round(stats['m2'] / (count - 1), 3) if count > 1 else None,
+        'histogram': dict(zip(range(RATING_MIN, RATING_MAX + 1), stats['histogram'])),
+    }
+
+
+class FeedbackAggregator:
+    def __init__(self, store, snapshot_path: str):
+        self.store = store
+        self.snapshot_path = snapshot_path
+        self._lock = threading.Lock()
+        self._last_snapshot = 0.0
+        self._state = self._load_snapshot()
+
+    # ---------------- SNAPSHOT ----------------
+    def _empty_state(self) -> Dict:
+        return {'version': SNAPSHOT_VERSION, 'offsets': {}, 'submissions': 0, 'groups': {}}
+
+    def _load_snapshot(self) -> Dict:
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('version') == SNAPSHOT_VERSION:
+                return state
+        except (OSError, ValueError):
+            pass
+        return self._empty_state()
+
+    def _save_snapshot(self):
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._state, f, separators=(',', ':'))
+        os.replace(tmp_path, self.snapshot_path)
+        self._last_snapshot = time.monotonic()
+
+    # ---------------- UPDATE ----------------
+    def add(self, record: Dict):
+        """Fold one feedback submission into the aggregates"""
+        patient = record.get('patient') or record.get('patient_data') or {}
+        keys = {
+            'condition': patient.get('condition_name') or patient.get('condition') or UNKNOWN,
+            'persona': patient.get('personality_type') or UNKNOWN,
+            'model': record.get('model_name') or UNKNOWN,
+        }
+        groups = self._state['groups']
+        targets = [groups.setdefault('all', {})]
+        targets += [groups.setdefault(f"{by}:{keys[by]}", {}) for by in BREAKDOWNS]
+        self._state['submissions'] += 1
+        for name in RATINGS:
+            rating = _rating(record.get(name))
+            if rating is None:
+                continue
+            for group in targets:
+                _update(group.setdefault(name, _new_stats()), rating)
+
+    def refresh(self) -> int:
+        """Consume submissions appended since the last refresh; returns how many"""
+        with self._lock:
+            added = 0
+            offsets = self._state['offsets']
+            for entry in self.store.days():
+                start = offsets.get(entry['day'], 0)
+                if entry['raw_size'] <= start:
+                    continue
+                data = b''.join(self.store.read_range(entry, start, entry['raw_size']))
+                # A line still being written is left for the next refresh
+                complete = data.rfind(b'\n') + 1
+                for line in data[:complete].splitlines():
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict):
+                        self.add(record)
+                        added += 1
+                offsets[entry['day']] = start + complete
+            if added and time.monotonic() - self._last_snapshot >= SNAPSHOT_INTERVAL:
+                self._save_snapshot()
+            return added
+
+    # ---------------- READ ----------------
+    def stats(self, by: Optional[str] = None) -> Dict:
+        """
+        Rating summaries overall, or per value of `by` (condition, persona or
+        model). Cost depends on the number of groups, not on the submissions.
+        """
+        self.refresh()
+        with self._lock:
+            groups = self._state['groups']
+            if by is None:
+                selected = {'all': groups.get('all', {})}
+            else:
+                prefix = f"{by}:"
+                selected = {key[len(prefix):]: group for key, group in groups.items() if key.startswith(prefix)}
+            return {
+                'submissions': self._state['submissions'],
+                'by': by,
+                'ratings': {
+                    key: {name: _summary(group[name]) for name in RATINGS if name in group}
+                    for key, group in sorted(selected.items())
+                },
+            }
@@ -0,0 +1,57 @@
+# gunicorn.conf.py - Production server settings
+# Picked up automatically by `gunicorn app:app` when started from this directory.
+
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# Exported so the per-worker limits (admission.py, usage.py) split the provider
+# quota and budgets by the number of workers actually started. Set the worker
+# count through WEB_CONCURRENCY rather than `-w`, which the app cannot see.
+workers = int(os.environ.setdefault('WEB_CONCURRENCY', '2'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+# Threaded workers (gthread) so requests waiting on the LLM queue up inside the
+# worker's admission controller (admission.py) instead of blocking the process.
+# GUNICORN_WORKER_CLASS=gevent serves each request in a greenlet instead
+# (cooperative.py): a worker then holds up to GUNICORN_WORKER_CONNECTIONS
+# conversations at once rather than GUNICORN_THREADS.
+gevent_workers = os.getenv('GUNICORN_WORKER_CLASS', 'gthread') == 'gevent'
+worker_class = 'cooperative.CooperativeWorker' if gevent_workers else 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+
+if gevent_workers:
+    # Patch here, before the preloaded app imports threading and the HTTP
+    # clients: gunicorn's own patching happens in the worker, after the fork,
+    # too late for modules and locks the master already created.
+    import cooperative
+    cooperative.patch()
+    # Waiting requests no longer tie up a thread, so the LLM queue can hold
+    # as many as the worker accepts (LLM_MAX_CONCURRENCY still caps calls in flight)
+    os.environ.setdefault('LLM_MAX_QUEUE', str(worker_connections))
+
+# Import app.py once in the master so the symptom dataset and personas are
+# parsed a single time and shared copy-on-write by every forked worker.
+# Set GUNICORN_PRELOAD=0 to go back to per-worker imports (e.g. for --reload).
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+
+def when_ready(server):
+    """Freeze everything the master has loaded before workers are forked"""
+    if server.cfg.workers != workers:
+        server.log.warning("Started %d workers but WEB_CONCURRENCY=%d: LLM rate limits and budgets are split %d ways",
+                           server.cfg.workers, workers, workers)
+    if preload_app:
+        # Objects in the permanent generation are never visited by the cyclic
+        # GC, so workers don't dirty (and un-share) the preloaded pages.
+        gc.freeze()
+        server.log.info("Preloaded app, froze %d objects for copy-on-write sharing", gc.get_freeze_count())
+
+
+def post_worker_init(worker):
+    """Refuse to serve from a gevent worker where a blocking module is left unpatched"""
+    if gevent_workers:
+        missing = cooperative.unpatched()
+        if missing:
+            # Raised before the worker is booted, so gunicorn halts instead of respawning it
+            raise RuntimeError(f"gevent worker with unpatched {', '.join(missing)}: LLM calls would block every request in the worker")
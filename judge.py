@@ -0,0 +1,260 @@
+# judge.py - LLM-as-judge scoring of patient conversations
+#
+# A judge model rates transcripts on the same five dimensions students rate in
+# the feedback form, so judge scores can be checked against the human ratings
+# in feedback_logs/. To keep re-scoring a whole corpus cheap:
+#   - several conversations go into one judge call (the rubric and
+#     instructions are paid for once per batch, not once per conversation)
+#   - batches run concurrently, paced by an AdmissionController sized to the
+#     judge's rate limit
+#   - verdicts are appended to a JSONL store keyed by (conversation hash,
+#     rubric version, judge model) as each batch finishes, so an interrupted
+#     run resumes where it stopped and a rerun only calls the judge for
+#     conversations that are new or changed
+# Conversations a batch reply leaves out (or scores invalidly) are retried
+# one at a time.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from admission import AdmissionController, AdmissionRejected
+
+# Bump when the rubric or the instructions change: old verdicts stop matching
+RUBRIC_VERSION = 1
+# Same dimensions as the feedback form (feedback_stats.RATINGS without "_rating")
+RUBRIC = [
+    ('authenticity', 'Does the patient sound like a real person with this condition, not a textbook or a chatbot?'),
+    ('educational_value', 'Would interviewing this patient teach a student to elicit and recognise the key symptoms?'),
+    ('interaction_quality', 'Does the patient answer what the doctor actually asked, at a natural length?'),
+    ('communication_consistency', 'Does the patient stay in character and consistent with earlier answers throughout?'),
+    ('symptom_realism', 'Are the symptoms described plausibly, in lay terms, and consistent with the condition?'),
+]
+DIMENSIONS = [name for name, _ in RUBRIC]
+SCORE_MIN, SCORE_MAX = 1, 5
+DEFAULT_BATCH_SIZE = 8
+# Long transcripts are cut to this many characters so a batch stays within context
+MAX_TRANSCRIPT_CHARS = 6000
+
+JUDGE_SYSTEM_PROMPT = (
+    "You are an examiner assessing simulated patients used to train medical students. "
+    "Each conversation below is between a student doctor and an AI playing a patient with the stated condition. "
+    "Rate only the patient's side, on each criterion from 1 (poor) to 5 (excellent):\n"
+    + "\n".join(f"- {name}: {description}" for name, description in RUBRIC)
+    + "\nReply with only a JSON array, one object per conversation: "
+    '{"id": "<conversation id>", "scores": {' + ', '.join(f'"{name}": <1-5>' for name in DIMENSIONS) + '}, '
+    '"rationale": "<one sentence>"}'
+)
+
+def conversation_hash(conversation: Dict) -> str:
+    """Content hash of a conversation: its condition, persona and turns"""
+    content = [
+        conversation.get('condition'),
+        conversation.get('personality_type'),
+        [[turn['doctor'], turn['patient']] for turn in conversation['turns']],
+    ]
+    return hashlib.sha256(json.dumps(content, separators=(',', ':')).encode('utf-8')).hexdigest()[:32]
+
+
+def verdict_key(digest: str, judge_model: str) -> str:
+    return f"{digest}:{RUBRIC_VERSION}:{judge_model}"
+
+
+def format_batch(batch: List[Dict]) -> str:
+    """User message for one judge call; conversations are labelled with their hash"""
+    sections = []
+    for conversation in batch:
+        lines = [f"### Conversation {conversation['hash']}", f"Condition: {conversation.get('condition') or 'unknown'}"]
+        for turn in conversation['turns']:
+            lines.append(f"Doctor: {turn['doctor']}")
+            lines.append(f"Patient: {turn['patient']}")
+        transcript = '\n'.join(lines)
+        if len(transcript) > MAX_TRANSCRIPT_CHARS:
+            transcript = transcript[:MAX_TRANSCRIPT_CHARS] + '\n[... transcript truncated]'
+        sections.append(transcript)
+    return '\n\n'.join(sections)
+
+
+def parse_verdicts(content: str, ids: List[str]) -> Dict[str, Dict]:
+    """Valid verdicts in a judge reply, by conversation id; anything malformed is left out"""
+    start, end = content.find('['), content.rfind(']')
+    if start == -1 or end <= start:
+        return {}
+    try:
+        items = json.loads(content[start:end + 1])
+    except ValueError:
+        return {}
+    wanted = set(ids)
+    verdicts = {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict) or item.get('id') not in wanted or not isinstance(item.get('scores'), dict):
+            continue
+        scores = {}
+        for name in DIMENSIONS:
+            try:
+                score = int(item['scores'].get(name))
+            except (TypeError, ValueError):
+                break
+            if not SCORE_MIN <= score <= SCORE_MAX:
+                break
+            scores[name] = score
+        else:
+            verdicts[item['id']] = {'scores': scores, 'rationale': str(item.get('rationale', ''))[:500]}
+    return verdicts
+
+
+class VerdictStore:
+    """Append-only JSONL of verdicts, loaded into memory by key"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.verdicts: Dict[str, Dict] = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        verdict = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut off by an interrupted run
+                    self.verdicts[verdict['key']] = verdict
+        except OSError:
+            pass
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self.verdicts.get(key)
+
+    def add_many(self, verdicts: List[Dict]):
+        """Persist a finished batch before it counts as done"""
+        if not verdicts:
+            return
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(v) + '\n' for v in verdicts))
+                f.flush()
+                os.fsync(f.fileno())
+            for verdict in verdicts:
+                self.verdicts[verdict['key']] = verdict
+
+
+class LLMJudge:
+    """
+    Scores conversations ({'conversation_id', 'condition', 'personality_type',
+    'turns': [{'doctor', 'patient'}]}) with `model`, calling the client that
+    `get_client()` returns. At most `concurrency` calls run at once and
+    `rate_per_minute` caps how fast they start.
+    """
+
+    def __init__(self, get_client: Callable, model: str, store: VerdictStore, batch_size: int = DEFAULT_BATCH_SIZE,
+                 concurrency: int = 4, rate_per_minute: float = 60, max_tokens_per_conversation: int = 150):
+        self.get_client = get_client
+        self.model = model
+        self.store = store
+        self.batch_size = max(1, batch_size)
+        self.concurrency = concurrency
+        self.max_tokens_per_conversation = max_tokens_per_conversation
+        self.admission = AdmissionController(
+            max_concurrency=concurrency, max_queue=concurrency, max_wait=600,
+            max_pending_per_session=1, rate_per_minute=rate_per_minute, burst=concurrency,
+        )
+        self.stats = {'cached': 0, 'judged': 0, 'failed': 0, 'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for name, delta in deltas.items():
+                self.stats[name] += delta
+
+    def _call(self, batch: List[Dict], session_id: str) -> Dict[str, Dict]:
+        messages = [
+            {'role': 'system', 'content': JUDGE_SYSTEM_PROMPT},
+            {'role': 'user', 'content': format_batch(batch)},
+        ]
+        try:
+            with self.admission.admit(self.model, session_id):
+                response = self.get_client().chat.completions.create(
+                    model=self.model, messages=messages, temperature=0,
+                    max_tokens=self.max_tokens_per_conversation * len(batch),
+                )
+        except AdmissionRejected as e:
+            print(f"[Judge] Call not admitted: {e.reason}")
+            return {}
+        except Exception as e:
+            print(f"[Judge] Call failed: {e}")
+            return {}
+        usage = getattr(response, 'usage', None)
+        self._count(
+            calls=1,
+            prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+            completion_tokens=getattr(usage, 'completion_tokens', 0) or 0,
+        )
+        content = (response.choices[0].message.content or '') if response.choices else ''
+        return parse_verdicts(content, [c['hash'] for c in batch])
+
+    def _judge_batch(self, batch: List[Dict], session_id: str):
+        parsed = self._call(batch, session_id)
+        missing = [c for c in batch if c['hash'] not in parsed]
+        if len(batch) > 1:
+            # Retry what the batch reply dropped on its own, where it can't be confused with the others
+            for conversation in missing:
+                parsed.update(self._call([conversation], session_id))
+        now = datetime.now().isoformat()
+        verdicts = []
+        for conversation in batch:
+            verdict = parsed.get(conversation['hash'])
+            if verdict is None:
+                continue
+            scores = verdict['scores']
+            verdicts.append({
+                'key': verdict_key(conversation['hash'], self.model),
+                'conversation_hash': conversation['hash'],
+                'conversation_id': conversation.get('conversation_id'),
+                'rubric_version': RUBRIC_VERSION,
+                'judge_model': self.model,
+                'scores': scores,
+                'overall': round(sum(scores.values()) / len(scores), 3),
+                'rationale': verdict['rationale'],
+                'judged_at': now,
+            })
+        self.store.add_many(verdicts)
+        self._count(judged=len(verdicts), failed=len(batch) - len(verdicts))
+
+    def judge(self, conversations: List[Dict], progress: Optional[Callable[[Dict], None]] = None) -> Dict[str, Dict]:
+        """
+        Verdicts for `conversations` by conversation hash. Conversations that
+        already have a verdict for this rubric and model are not sent again;
+        the ones the judge failed on are missing from the result.
+        """
+        pending, seen = [], set()
+        for conversation in conversations:
+            digest = conversation_hash(conversation)
+            if digest in seen:
+                continue
+            seen.add(digest)
+            if self.store.get(verdict_key(digest, self.model)) is not None:
+                self._count(cached=1)
+            else:
+                pending.append(dict(conversation, hash=digest))
+
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        if batches:
+            started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                futures = [pool.submit(self._judge_batch, batch, f"batch-{i}") for i, batch in enumerate(batches)]
+                for done, future in enumerate(futures, 1):
+                    future.result()
+                    if progress:
+                        progress(dict(self.stats, batches_done=done, batches=len(batches), elapsed_seconds=round(time.monotonic() - started, 1)))
+
+        verdicts = {}
+        for digest in seen:
+            verdict = self.store.get(verdict_key(digest, self.model))
+            if verdict is not None:
+                verdicts[digest] = verdict
+        return verdicts
@@ -0,0 +1,90 @@
+# llm_backends.py - Where get_patient_response sends its LLM calls
+#
+# LLM_BACKEND picks one OpenAI-compatible backend per process:
+#   openrouter  hosted models (default; OPENROUTER_API_KEY, OPENROUTER_BASE_URL)
+#   local       tools/serve_local_model.py, or any OpenAI-compatible server, at
+#               LOCAL_LLM_URL; every request goes to the one model it serves
+#   mock        mock_llm.MockLLMClient, fully offline (LLM_MOCK=1 is the same)
+# The app talks to all of them through client.chat.completions.create, so
+# streaming, usage accounting, the response cache and retries work unchanged.
+
+import json
+import os
+from typing import Optional
+
+LOCAL_LLM_URL = os.getenv('LOCAL_LLM_URL', 'http://127.0.0.1:8001/v1')
+LOCAL_LLM_MODEL = os.getenv('LOCAL_LLM_MODEL', 'local')
+LOCAL_LLM_TIMEOUT = float(os.getenv('LOCAL_LLM_TIMEOUT', '120'))
+
+
+class LLMBackend:
+    name = ''
+    # Shown in error messages ("unavailable on ...")
+    label = ''
+
+    def create_client(self):
+        """A new OpenAI-compatible client"""
+        raise NotImplementedError
+
+    def model_for(self, requested: str) -> str:
+        """Model name to send (and to account usage under) for a requested model"""
+        return requested
+
+
+class OpenRouterBackend(LLMBackend):
+    name = 'openrouter'
+    label = 'OpenRouter'
+
+    def create_client(self):
+        from openai import OpenAI
+        return OpenAI(
+            api_key=os.getenv("OPENROUTER_API_KEY"),
+            base_url=os.getenv("OPENROUTER_BASE_URL"),
+        )
+
+
+class LocalBackend(LLMBackend):
+    name = 'local'
+    label = 'the local inference server'
+
+    def __init__(self, url: str = LOCAL_LLM_URL, model: str = LOCAL_LLM_MODEL, timeout: float = LOCAL_LLM_TIMEOUT):
+        self.url = url
+        self.model = model
+        self.timeout = timeout
+
+    def create_client(self):
+        from openai import OpenAI
+        # The local server has no key; retries are left to get_patient_response
+        return OpenAI(api_key='local', base_url=self.url, timeout=self.timeout, max_retries=0)
+
+    def model_for(self, requested: str) -> str:
+        # One model is served; usage is accounted under its name, not the hosted one's
+        return self.model
+
+
+class MockBackend(LLMBackend):
+    name = 'mock'
+    label = 'the mock LLM'
+
+    def __init__(self, latencies_path: Optional[str] = None):
+        self.latencies_path = latencies_path
+
+    def create_client(self):
+        # Deterministic replies; latencies drawn from a JSON list of ms
+        # (tools/replay_traffic.py --export_latencies)
+        from mock_llm import MockLLMClient
+        if self.latencies_path:
+            with open(self.latencies_path, 'r', encoding='utf-8') as f:
+                return MockLLMClient([ms / 1000 for ms in json.load(f)])
+        return MockLLMClient()
+
+
+def backend_from_env() -> LLMBackend:
+    name = os.getenv('LLM_BACKEND') or ('mock' if os.getenv('LLM_MOCK') == '1' else 'openrouter')
+    if name == 'openrouter':
+        return OpenRouterBackend()
+    if name == 'local':
+        return LocalBackend()
+    if name == 'mock':
+        return MockBackend(os.getenv('LLM_MOCK_LATENCIES'))
+    raise ValueError(f"Unknown LLM_BACKEND '{name}' (expected openrouter, local or mock)")
@@ -0,0 +1,432 @@
+# local_llm.py - OpenAI-compatible local inference server with continuous batching
+#
+# Serves one causal LM from a local directory (e.g. a small model fine-tuned on
+# the sft_*.jsonl files of tools/prepare_dataset.py) on CPU, behind the part of
+# the OpenAI API the app uses: /v1/chat/completions, streamed or not, with a
+# usage block, and /v1/models. Run it with tools/serve_local_model.py and
+# point the app at it with LLM_BACKEND=local (see llm_backends.py).
+#
+# Concurrent sessions share the model through iteration-level ("continuous")
+# batching. One scheduler thread runs a single decode step for every active
+# sequence at once. New requests are prefilled and join the batch between
+# steps, and finished ones leave right away, so a short reply never waits for
+# a long one. The running batch keeps one left-padded KV cache: rows are
+# merged in and filtered out as sequences come and go, and padding columns no
+# row needs any more are trimmed. torch and transformers are only needed here.
+
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Dict, Iterator, List, Optional
+
+DEFAULT_MAX_TOKENS = 256
+DEFAULT_MAX_BATCH = 8
+DEFAULT_MAX_QUEUE = 64
+DEFAULT_MAX_CONTEXT = 2048
+
+
+class QueueFull(Exception):
+    """Raised by submit() when max_queue requests are already waiting"""
+
+
+class GenerationRequest:
+    """One completion; the scheduler pushes text deltas to `events`, then None"""
+
+    def __init__(self, prompt_ids: List[int], max_tokens: int = DEFAULT_MAX_TOKENS, temperature: float = 1.0,
+                 top_p: float = 1.0, stop: Optional[List[str]] = None):
+        self.prompt_ids = prompt_ids
+        self.max_tokens = max(1, max_tokens)
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop = [s for s in (stop or []) if s]
+        self.output_ids: List[int] = []
+        self.text = ''
+        self.finish_reason: Optional[str] = None
+        self.error: Optional[Exception] = None
+        self.cancelled = False
+        self.submitted_at = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self.events: 'queue.Queue[Optional[str]]' = queue.Queue()
+
+    def stream(self) -> Iterator[str]:
+        """Text deltas as they are generated; raises the scheduler's error, if any"""
+        while True:
+            delta = self.events.get()
+            if delta is None:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield delta
+
+    def result(self) -> str:
+        for _ in self.stream():
+            pass
+        return self.text
+
+
+def _pad_left(tensor, length: int, dim: int):
+    import torch
+
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([torch.zeros(shape, dtype=tensor.dtype, device=tensor.device), tensor], dim=dim)
+
+
+def _kv_layers(cache) -> List:
+    """Per-layer objects holding .keys/.values ([batch, heads, seq, dim])"""
+    return list(cache.layers)
+
+
+class ContinuousBatcher:
+    """
+    Owns the model: requests are submitted from any thread and generated by
+    one scheduler thread, up to `max_batch` sequences per decode step.
+    """
+
+    def __init__(self, model, tokenizer, max_batch: int = DEFAULT_MAX_BATCH, max_queue: int = DEFAULT_MAX_QUEUE,
+                 max_context: int = DEFAULT_MAX_CONTEXT):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.max_context = max_context
+        eos = getattr(model.generation_config, 'eos_token_id', None) or tokenizer.eos_token_id
+        self.eos_ids = set(eos if isinstance(eos, (list, tuple)) else [eos]) - {None}
+
+        self._waiting: deque = deque()
+        self._cond = threading.Condition()
+        self._active: List[GenerationRequest] = []
+        # Batch state, one row per active request
+        self._cache = None
+        self._mask = None
+        self._last_tokens = None
+        self._stopped = False
+        self.stats_counters = {'requests': 0, 'rejected': 0, 'steps': 0, 'step_rows': 0, 'prefill_tokens': 0,
+                               'generated_tokens': 0, 'errors': 0, 'busy_seconds': 0.0}
+        self._thread = threading.Thread(target=self._loop, name='continuous-batcher', daemon=True)
+        self._thread.start()
+
+    # ---------------- SUBMIT ----------------
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                self.stats_counters['rejected'] += 1
+                raise QueueFull(f"{len(self._waiting)} requests already waiting")
+            self._waiting.append(request)
+            self.stats_counters['requests'] += 1
+            self._cond.notify()
+        return request
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    # ---------------- SCHEDULER ----------------
+    def _loop(self):
+        import torch
+
+        while True:
+            with self._cond:
+                while not self._stopped and not self._active and not self._waiting:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                joining = []
+                while self._waiting and len(self._active) + len(joining) < self.max_batch:
+                    joining.append(self._waiting.popleft())
+            started = time.perf_counter()
+            try:
+                with torch.inference_mode():
+                    for request in joining:
+                        if not request.cancelled:
+                            self._prefill(request)
+                        else:
+                            self._finish(request, 'cancelled')
+                    if self._active:
+                        self._step()
+            except Exception as e:
+                # Fail what is in flight and start over with an empty batch
+                print(f"[LocalLLM] Generation failed: {e}")
+                self.stats_counters['errors'] += 1
+                for request in self._active + [r for r in joining if r.finish_reason is None and r not in self._active]:
+                    request.error = e
+                    self._finish(request, 'error')
+                self._active, self._cache, self._mask, self._last_tokens = [], None, None, None
+            self.stats_counters['busy_seconds'] += time.perf_counter() - started
+
+    def _prefill(self, request: GenerationRequest):
+        import torch
+
+        input_ids = torch.tensor([request.prompt_ids], dtype=torch.long)
+        out = self.model(input_ids=input_ids, use_cache=True)
+        self.stats_counters['prefill_tokens'] += len(request.prompt_ids)
+        token = int(self._sample(out.logits[:, -1, :], [request])[0])
+        if self._emit(request, token):
+            return
+        # Join the running batch: left-pad whichever cache is shorter
+        mask = torch.ones((1, len(request.prompt_ids)), dtype=torch.long)
+        last = torch.tensor([[token]], dtype=torch.long)
+        if self._cache is None:
+            self._cache, self._mask, self._last_tokens = out.past_key_values, mask, last
+        else:
+            length = max(self._mask.shape[1], mask.shape[1])
+            for layer, new in zip(_kv_layers(self._cache), _kv_layers(out.past_key_values)):
+                layer.keys = torch.cat([_pad_left(layer.keys, length, 2), _pad_left(new.keys, length, 2)])
+                layer.values = torch.cat([_pad_left(layer.values, length, 2), _pad_left(new.values, length, 2)])
+            self._mask = torch.cat([_pad_left(self._mask, length, 1), _pad_left(mask, length, 1)])
+            self._last_tokens = torch.cat([self._last_tokens, last])
+        self._active.append(request)
+
+    def _step(self):
+        """One decode step for every active sequence"""
+        import torch
+
+        # The new token's position is the number of real tokens before it
+        position_ids = self._mask.sum(dim=1, keepdim=True)
+        self._mask = torch.cat([self._mask, torch.ones((len(self._active), 1), dtype=torch.long)], dim=1)
+        out = self.model(
+            input_ids=self._last_tokens, attention_mask=self._mask, position_ids=position_ids,
+            past_key_values=self._cache, use_cache=True,
+        )
+        self._cache = out.past_key_values
+        tokens = self._sample(out.logits[:, -1, :], self._active)
+        self.stats_counters['steps'] += 1
+        self.stats_counters['step_rows'] += len(self._active)
+
+        keep = []
+        for row, (request, token) in enumerate(zip(self._active, tokens.tolist())):
+            if request.cancelled:
+                self._finish(request, 'cancelled')
+            elif not self._emit(request, token) and int(position_ids[row]) + 2 < self.max_context:
+                keep.append(row)
+            elif request.finish_reason is None:
+                self._finish(request, 'length')
+        if len(keep) < len(self._active):
+            self._filter(keep)
+        self._last_tokens = tokens.view(-1, 1)[keep] if keep else None
+
+    def _filter(self, keep: List[int]):
+        """Drop finished rows and any leading padding no remaining row needs"""
+        import torch
+
+        self._active = [self._active[row] for row in keep]
+        if not keep:
+            self._cache = self._mask = None
+            return
+        index = torch.tensor(keep, dtype=torch.long)
+        self._mask = self._mask.index_select(0, index)
+        start = int(self._mask.any(dim=0).nonzero()[0])
+        self._mask = self._mask[:, start:]
+        for layer in _kv_layers(self._cache):
+            layer.keys = layer.keys.index_select(0, index)[:, :, start:]
+            layer.values = layer.values.index_select(0, index)[:, :, start:]
+
+    def _sample(self, logits, requests: List[GenerationRequest]):
+        import torch
+
+        logits = logits.float()
+        temperatures = torch.tensor([max(r.temperature, 1e-5) for r in requests]).unsqueeze(1)
+        probs = torch.softmax(logits / temperatures, dim=-1)
+        # Nucleus sampling: keep the smallest set of tokens whose mass reaches top_p
+        top_p = torch.tensor([r.top_p for r in requests]).unsqueeze(1)
+        sorted_probs, order = probs.sort(dim=-1, descending=True)
+        sorted_probs[(sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p] = 0
+        sampled = order.gather(1, torch.multinomial(sorted_probs, 1)).squeeze(1)
+        greedy = torch.tensor([r.temperature <= 0 for r in requests])
+        return torch.where(greedy, logits.argmax(dim=-1), sampled)
+
+    # ---------------- OUTPUT ----------------
+    def _emit(self, request: GenerationRequest, token: int) -> bool:
+        """Add a generated token to a request; True when the request is finished"""
+        self.stats_counters['generated_tokens'] += 1
+        if request.first_token_at is None:
+            request.first_token_at = time.monotonic()
+        if token in self.eos_ids:
+            self._finish(request, 'stop')
+            return True
+        request.output_ids.append(token)
+        text = self.tokenizer.decode(request.output_ids, skip_special_tokens=True)
+        for stop in request.stop:
+            cut = text.find(stop)
+            if cut != -1:
+                self._push(request, text[:cut])
+                self._finish(request, 'stop')
+                return True
+        # Hold back an incomplete multi-byte character until the next token completes it
+        if not text.endswith('�'):
+            self._push(request, text)
+        if len(request.output_ids) >= request.max_tokens:
+            self._finish(request, 'length')
+            return True
+        return False
+
+    def _push(self, request: GenerationRequest, text: str):
+        if len(text) > len(request.text) and text.startswith(request.text):
+            request.events.put(text[len(request.text):])
+            request.text = text
+
+    def _finish(self, request: GenerationRequest, reason: str):
+        request.finish_reason = reason
+        request.events.put(None)
+
+    def stats(self) -> Dict:
+        counters = dict(self.stats_counters)
+        with self._cond:
+            waiting = len(self._waiting)
+        busy = counters['busy_seconds']
+        return dict(
+            counters,
+            active=len(self._active),
+            waiting=waiting,
+            max_batch=self.max_batch,
+            mean_batch_size=round(counters['step_rows'] / counters['steps'], 2) if counters['steps'] else None,
+            tokens_per_second=round(counters['generated_tokens'] / busy, 1) if busy else None,
+            busy_seconds=round(busy, 1),
+        )
+
+
+# ---------------- MODEL LOADING ----------------
+def load_model(model_dir: str, threads: Optional[int] = None):
+    """Load a causal LM and its tokenizer for CPU inference"""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    if threads:
+        torch.set_num_threads(threads)
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    model = AutoModelForCausalLM.from_pretrained(model_dir, dtype=torch.float32)
+    model.eval()
+    return model, tokenizer
+
+
+def chat_token_ids(tokenizer, messages: List[Dict], add_generation_prompt: bool = True) -> List[int]:
+    """
+    Token ids of chat messages in the tokenizer's chat template (a plain
+    <|role|> format for tokenizers without one). packing.py tokenizes
+    training data with this too, so training and serving see the same format.
+    """
+    if getattr(tokenizer, 'chat_template', None):
+        ids = tokenizer.apply_chat_template(messages, add_generation_prompt=add_generation_prompt, tokenize=True)
+        # Newer transformers return a BatchEncoding, older ones a list of ids
+        return list(ids['input_ids'] if hasattr(ids, 'keys') else ids)
+    text = ''.join(f"<|{m['role']}|>\n{m['content']}\n" for m in messages)
+    return tokenizer.encode(text + ('<|assistant|>\n' if add_generation_prompt else ''))
+
+
+def render_prompt(tokenizer, messages: List[Dict]) -> List[int]:
+    """
+    Prompt token ids for chat messages. The app appends a second system
+    message (the diagnosis note) after the doctor's message; many chat
+    templates only accept a leading system message, so later ones are folded
+    into the last user message.
+    """
+    folded = []
+    for message in messages:
+        if message['role'] == 'system' and folded and folded[-1]['role'] == 'user':
+            folded[-1] = {'role': 'user', 'content': f"{folded[-1]['content']}\n\n({message['content']})"}
+        else:
+            folded.append({'role': message['role'], 'content': message['content']})
+    return chat_token_ids(tokenizer, folded)
+
+
+# ---------------- HTTP SERVER ----------------
+def create_server(batcher: ContinuousBatcher, model_name: str):
+    """Flask app serving `batcher` under the OpenAI chat completions API"""
+    from flask import Flask, Response, jsonify, request
+
+    server = Flask(__name__)
+
+    def error(status: int, message: str, retry_after: Optional[int] = None):
+        response = jsonify({'error': {'message': message, 'type': 'invalid_request_error' if status == 400 else 'server_error'}})
+        response.status_code = status
+        if retry_after:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    @server.route('/health')
+    def health():
+        return jsonify({'status': 'ok', 'model': model_name})
+
+    @server.route('/stats')
+    def stats():
+        return jsonify(batcher.stats())
+
+    @server.route('/v1/models')
+    def models():
+        return jsonify({'object': 'list', 'data': [{'id': model_name, 'object': 'model', 'owned_by': 'local'}]})
+
+    @server.route('/v1/chat/completions', methods=['POST'])
+    def chat_completions():
+        body = request.get_json(silent=True) or {}
+        messages = body.get('messages')
+        if not isinstance(messages, list) or not messages:
+            return error(400, "'messages' must be a non-empty list")
+        prompt_ids = render_prompt(batcher.tokenizer, messages)
+        max_tokens = int(body.get('max_tokens') or DEFAULT_MAX_TOKENS)
+        if len(prompt_ids) + 1 >= batcher.max_context:
+            return error(400, f"Prompt is {len(prompt_ids)} tokens; the context is {batcher.max_context}")
+        stop = body.get('stop')
+        generation = GenerationRequest(
+            prompt_ids, max_tokens=min(max_tokens, batcher.max_context - len(prompt_ids)),
+            temperature=float(body.get('temperature', 1.0)), top_p=float(body.get('top_p', 1.0)),
+            stop=[stop] if isinstance(stop, str) else stop,
+        )
+        try:
+            batcher.submit(generation)
+        except QueueFull as e:
+            return error(503, f"Server busy: {e}", retry_after=1)
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def usage():
+            return {
+                'prompt_tokens': len(prompt_ids),
+                'completion_tokens': len(generation.output_ids),
+                'total_tokens': len(prompt_ids) + len(generation.output_ids),
+            }
+
+        if not body.get('stream'):
+            try:
+                content = generation.result()
+            except Exception as e:
+                return error(500, str(e))
+            return jsonify({
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': created,
+                'model': model_name,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': generation.finish_reason}],
+                'usage': usage(),
+            })
+
+        include_usage = bool((body.get('stream_options') or {}).get('include_usage'))
+
+        def chunk(choices, **extra):
+            payload = dict({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created,
+                            'model': model_name, 'choices': choices}, **extra)
+            return f"data: {json.dumps(payload)}\n\n"
+
+        def events():
+            try:
+                yield chunk([{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])
+                for delta in generation.stream():
+                    yield chunk([{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}])
+                yield chunk([{'index': 0, 'delta': {}, 'finish_reason': generation.finish_reason}])
+                if include_usage:
+                    yield chunk([], usage=usage())
+                yield "data: [DONE]\n\n"
+            finally:
+                # Client gone (or done): stop generating for it at the next step
+                generation.cancelled = True
+
+        return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    return server
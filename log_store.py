@@ -0,0 +1,332 @@
+# log_store.py - Log lifecycle: daily JSONL files, compressed archives and a manifest
+#
+# logs/ and feedback_logs/ get one JSONL file per day. Once a day is over its
+# file is rewritten as a multi-member gzip archive (one member per ~256KB of
+# raw data) and the member offsets are recorded in manifest.json. The index
+# makes the archives seekable, so downloads can stream any byte range of the
+# original JSONL without decompressing from the start, and listings read the
+# manifest instead of scanning the directory.
+
+import gzip
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows: manifest updates are then per-process only
+    fcntl = None
+
+MANIFEST_VERSION = 1
+MEMBER_SIZE = 256 * 1024
+READ_CHUNK = 64 * 1024
+# Closed days are left alone for this long after their last write
+ROTATE_GRACE_SECONDS = 60
+
+
+def _today() -> str:
+    return datetime.now().strftime('%Y%m%d')
+
+
+class LogStore:
+    def __init__(self, directory: str, prefix: str, background: Optional[Callable] = None):
+        self.directory = directory
+        self.prefix = prefix
+        # Runs the rotation triggered by the first write of a day, e.g. the
+        # app's async log writer, so no request waits on compressing a day;
+        # without one (tools) it runs inline
+        self.background = background
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self._lock_path = os.path.join(directory, '.manifest.lock')
+        self._file_re = re.compile(rf'^{re.escape(prefix)}(\d{{8}})\.jsonl(\.gz)?$')
+        self._registered_day = None
+        self._manifest = None
+        self._manifest_mtime = None
+        self._lock = threading.Lock()
+
+    # ---------------- WRITE ----------------
+    def path_for_day(self, day: str, compressed: bool = False) -> str:
+        return os.path.join(self.directory, f"{self.prefix}{day}.jsonl" + ('.gz' if compressed else ''))
+
+    def append(self, record: Dict):
+        """Append one record to today's file; the first write of a new day rotates older days"""
+        day = _today()
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path_for_day(day), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+        self._register(day)
+
+    def append_many(self, records: List[Dict]):
+        """Append a batch of records to today's file with a single open and write"""
+        if not records:
+            return
+        day = _today()
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path_for_day(day), 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+        self._register(day)
+
+    def _register(self, day: str):
+        if self._registered_day != day:
+            self._registered_day = day
+            self._update_manifest(lambda m: m['days'].setdefault(day, {'name': os.path.basename(self.path_for_day(day)), 'compressed': False}))
+            if self.background is not None:
+                self.background(self.rotate)
+            else:
+                self.rotate()
+
+    # ---------------- MANIFEST ----------------
+    def _locked(self):
+        store = self
+
+        class _FileLock:
+            def __enter__(self):
+                store._lock.acquire()
+                os.makedirs(store.directory, exist_ok=True)
+                self.f = open(store._lock_path, 'a')
+                if fcntl:
+                    fcntl.flock(self.f, fcntl.LOCK_EX)
+                return self
+
+            def __exit__(self, *exc):
+                if fcntl:
+                    fcntl.flock(self.f, fcntl.LOCK_UN)
+                self.f.close()
+                store._lock.release()
+                return False
+
+        return _FileLock()
+
+    def _read_manifest(self) -> Optional[Dict]:
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            return manifest if manifest.get('version') == MANIFEST_VERSION else None
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self, manifest: Dict):
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _scan(self) -> Dict:
+        """Build a manifest from the directory (only when there is none yet)"""
+        manifest = {'version': MANIFEST_VERSION, 'days': {}}
+        if not os.path.isdir(self.directory):
+            return manifest
+        for filename in os.listdir(self.directory):
+            match = self._file_re.match(filename)
+            if not match:
+                continue
+            day, gz = match.group(1), bool(match.group(2))
+            if gz:
+                manifest['days'][day] = self._index_archive(self.path_for_day(day, True))
+            elif day not in manifest['days']:
+                manifest['days'][day] = {'name': filename, 'compressed': False}
+        return manifest
+
+    def _update_manifest(self, fn):
+        with self._locked():
+            manifest = self._read_manifest() or self._scan()
+            fn(manifest)
+            self._write_manifest(manifest)
+            self._manifest = None
+
+    def manifest(self) -> Dict:
+        """Current manifest (re-read only when the file changed)"""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except OSError:
+            if not os.path.isdir(self.directory):
+                return {'version': MANIFEST_VERSION, 'days': {}}
+            self._update_manifest(lambda m: None)
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        if self._manifest is None or mtime != self._manifest_mtime:
+            self._manifest = self._read_manifest() or self._scan()
+            self._manifest_mtime = mtime
+        return self._manifest
+
+    # ---------------- ROTATION ----------------
+    def _compress_day(self, day: str) -> Dict:
+        """Rewrite a closed day as an indexed multi-member gzip archive"""
+        src = self.path_for_day(day)
+        dst = self.path_for_day(day, True)
+        tmp_path = f"{dst}.{os.getpid()}.tmp"
+        members = []
+        raw_offset = comp_offset = lines = 0
+        with open(src, 'rb') as fin, open(tmp_path, 'wb') as fout:
+            while True:
+                # Cut members on line boundaries so each one holds whole records
+                chunk = fin.read(MEMBER_SIZE)
+                if not chunk:
+                    break
+                if not chunk.endswith(b'\n'):
+                    chunk += fin.readline()
+                member = gzip.compress(chunk, compresslevel=9, mtime=0)
+                fout.write(member)
+                members.append([raw_offset, comp_offset])
+                raw_offset += len(chunk)
+                comp_offset += len(member)
+                lines += chunk.count(b'\n')
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_path, dst)
+        os.remove(src)
+        return {
+            'name': os.path.basename(dst),
+            'compressed': True,
+            'raw_size': raw_offset,
+            'compressed_size': comp_offset,
+            'lines': lines,
+            'members': members,
+        }
+
+    def _index_archive(self, path: str) -> Dict:
+        """Recover the member index of an archive that is missing from the manifest"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        members = []
+        raw_offset = comp_offset = lines = 0
+        while comp_offset < len(data):
+            d = zlib.decompressobj(31)
+            raw = d.decompress(data[comp_offset:])
+            members.append([raw_offset, comp_offset])
+            consumed = len(data) - comp_offset - len(d.unused_data)
+            raw_offset += len(raw)
+            lines += raw.count(b'\n')
+            comp_offset += consumed
+        return {
+            'name': os.path.basename(path),
+            'compressed': True,
+            'raw_size': raw_offset,
+            'compressed_size': len(data),
+            'lines': lines,
+            'members': members,
+        }
+
+    def rotate(self) -> List[str]:
+        """Compress every day before today that is still plain JSONL"""
+        today = _today()
+        rotated = []
+
+        def _rotate(manifest):
+            for day, entry in sorted(manifest['days'].items()):
+                path = self.path_for_day(day)
+                if day >= today or entry.get('compressed') or not os.path.exists(path):
+                    continue
+                if time.time() - os.path.getmtime(path) < ROTATE_GRACE_SECONDS:
+                    continue  # a write that started before midnight may still be landing
+                manifest['days'][day] = self._compress_day(day)
+                rotated.append(day)
+
+        self._update_manifest(_rotate)
+        if rotated:
+            print(f"[LogStore] Compressed {len(rotated)} day(s) in {self.directory}")
+        return rotated
+
+    # ---------------- READ ----------------
+    def days(self) -> List[Dict]:
+        """Manifest entries (newest first) with sizes filled in for open days"""
+        entries = []
+        for day, entry in sorted(self.manifest()['days'].items(), reverse=True):
+            entry = dict(entry, day=day)
+            path = os.path.join(self.directory, entry['name'])
+            if not entry['compressed']:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entry['raw_size'] = st.st_size
+                entry['last_modified'] = st.st_mtime
+            entries.append(entry)
+        return entries
+
+    def entry_for(self, filename: str) -> Optional[Dict]:
+        """Look up a day by its JSONL (or archive) filename"""
+        match = self._file_re.match(filename)
+        if not match:
+            return None
+        for entry in self.days():
+            if entry['day'] == match.group(1):
+                return entry
+        return None
+
+    def count_lines(self, entry: Dict) -> int:
+        if entry['compressed']:
+            return entry['lines']
+        with open(os.path.join(self.directory, entry['name']), 'rb') as f:
+            return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(READ_CHUNK), b''))
+
+    def read_range(self, entry: Dict, start: int, stop: int) -> Iterator[bytes]:
+        """Yield raw JSONL bytes [start, stop) of a day, decompressing only the members needed"""
+        path = os.path.join(self.directory, entry['name'])
+        if start >= stop:
+            return
+        if not entry['compressed']:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = f.read(min(READ_CHUNK, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            return
+
+        members = entry['members']
+        raw_starts = [m[0] for m in members]
+        i = max(0, bisect_right(raw_starts, start) - 1)
+        with open(path, 'rb') as f:
+            while i < len(members) and members[i][0] < stop:
+                raw_offset, comp_offset = members[i]
+                comp_end = members[i + 1][1] if i + 1 < len(members) else entry['compressed_size']
+                f.seek(comp_offset)
+                raw = zlib.decompress(f.read(comp_end - comp_offset), 31)
+                yield raw[max(0, start - raw_offset):stop - raw_offset]
+                i += 1
+
+
+def stream_download(store: LogStore, entries: List[Dict], download_name: str, range_header=None):
+    """
+    Streaming Flask response for one or more days concatenated as JSONL.
+    Honours a single HTTP byte range over the concatenated content.
+    """
+    from flask import Response
+
+    entries = sorted(entries, key=lambda e: e['day'])
+    total = sum(e['raw_size'] for e in entries)
+    start, stop, status = 0, total, 200
+    if range_header is not None:
+        byte_range = range_header.range_for_length(total) if range_header.units == 'bytes' and len(range_header.ranges) == 1 else None
+        if byte_range is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f"bytes */{total}"
+            return response
+        start, stop = byte_range
+        status = 206
+
+    def generate():
+        offset = 0
+        for entry in entries:
+            size = entry['raw_size']
+            lo, hi = max(start, offset), min(stop, offset + size)
+            if lo < hi:
+                yield from store.read_range(entry, lo - offset, hi - offset)
+            offset += size
+
+    response = Response(generate(), status=status, mimetype='application/x-ndjson', direct_passthrough=True)
+    response.headers['Content-Length'] = str(stop - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    if status == 206:
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{total}"
+    return response
@@ -0,0 +1,153 @@
+# mock_llm.py - Offline stand-in for the OpenRouter client
+#
+# Implements the small part of the OpenAI client interface the app uses
+# (client.chat.completions.create, streamed or not, with a usage block) and
+# answers from the prompt itself: the patient describes symptoms from the
+# system prompt and thanks the doctor once the diagnosis note is present, and
+# plays the judge of judge.py with scores derived from each transcript.
+# Install it with `app._client = MockLLMClient()` so get_client() returns it.
+
+import hashlib
+import json
+import random
+import re
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Sequence, Union
+
+_MAIN_SYMPTOMS_RE = re.compile(r'Main symptoms \(most important\):\s*(.*)')
+_OTHER_SYMPTOMS_RE = re.compile(r'Other symptoms:\s*(.*)')
+_CANDIDATES_RE = re.compile(r'Possible conditions:\s*(.*)')
+_JUDGE_SECTION_RE = re.compile(r'^### Conversation (\S+)\n(.*?)(?=^### Conversation |\Z)', re.MULTILINE | re.DOTALL)
+_JUDGE_SCORES_RE = re.compile(r'"scores": \{(.*?)\}')
+_JUDGE_DIMENSION_RE = re.compile(r'"(\w+)": <1-5>')
+
+PATIENT_OPENERS = [
+    "Well, doctor, I've been having {symptom}.",
+    "It's mostly {symptom}, to be honest.",
+    "I've noticed {symptom} for a few days now.",
+    "The main thing is {symptom}.",
+]
+PATIENT_FOLLOW_UPS = [
+    " I've also had {symptom}.",
+    " There's some {symptom} too.",
+    " And {symptom}, now that you mention it.",
+]
+PATIENT_QUESTIONS = [
+    " Is it something serious?",
+    " Should I be worried?",
+    "",
+    "",
+]
+DOCTOR_QUESTIONS = [
+    "Can you tell me more about that?",
+    "When did it start?",
+    "Have you noticed anything else?",
+    "Does anything make it better or worse?",
+]
+
+
+def _approx_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class _Completions:
+    def __init__(self, client: 'MockLLMClient'):
+        self.client = client
+
+    def create(self, model: str, messages: List[Dict], stream: bool = False, **kwargs):
+        latency = self.client.latency_for(messages)
+        if latency:
+            time.sleep(latency)
+        content = self.client.reply(messages)
+        self.client.calls += 1
+        usage = SimpleNamespace(
+            prompt_tokens=sum(_approx_tokens(m['content']) for m in messages),
+            completion_tokens=_approx_tokens(content),
+        )
+        usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+        if not stream:
+            return SimpleNamespace(
+                model=model,
+                choices=[SimpleNamespace(message=SimpleNamespace(role='assistant', content=content), finish_reason='stop')],
+                usage=usage,
+            )
+        return self._stream(model, content, usage)
+
+    def _stream(self, model: str, content: str, usage):
+        words = content.split(' ')
+        for i, word in enumerate(words):
+            delta = SimpleNamespace(content=word if i == 0 else ' ' + word)
+            yield SimpleNamespace(model=model, choices=[SimpleNamespace(delta=delta, finish_reason=None)], usage=None)
+        yield SimpleNamespace(model=model, choices=[], usage=usage)
+
+
+class MockLLMClient:
+    """
+    Deterministic fake of OpenAI(...): the same messages always get the same
+    reply. `latency` is a fixed delay in seconds, or a list of recorded
+    latencies to draw from; the draw is keyed on the doctor's message and the
+    turn, so a replayed conversation sees the same latencies every run.
+    """
+
+    def __init__(self, latency: Union[float, Sequence[float]] = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=_Completions(self))
+
+    def latency_for(self, messages: List[Dict]) -> float:
+        if not isinstance(self.latency, (list, tuple)):
+            return self.latency
+        if not self.latency:
+            return 0.0
+        last_user = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+        digest = hashlib.sha256(f"{len(messages)}:{last_user}".encode('utf-8')).digest()
+        return self.latency[int.from_bytes(digest[:8], 'little') % len(self.latency)]
+
+    def reply(self, messages: List[Dict]) -> str:
+        system = messages[0]['content'] if messages and messages[0]['role'] == 'system' else ''
+        rng = random.Random(hashlib.sha256(repr([m['content'] for m in messages]).encode('utf-8')).digest())
+        if system.startswith('You are a doctor'):
+            return self._doctor_reply(messages, system, rng)
+        if system.startswith('You are an examiner'):
+            return self._judge_reply(messages, system)
+        return self._patient_reply(messages, system, rng)
+
+    def _patient_reply(self, messages: List[Dict], system: str, rng: random.Random) -> str:
+        if any(m['role'] == 'system' and 'correctly identified' in m['content'] for m in messages[1:]):
+            return rng.choice(["Thank you doctor, that makes sense.", "Thanks doc, you have been a great help."])
+        symptoms = []
+        for pattern in (_MAIN_SYMPTOMS_RE, _OTHER_SYMPTOMS_RE):
+            match = pattern.search(system)
+            if match and match.group(1).strip() != 'None':
+                symptoms.extend(s.strip() for s in match.group(1).split(',') if s.strip())
+        if not symptoms:
+            return "I'm just not feeling myself, doctor."
+        picked = rng.sample(symptoms, min(len(symptoms), rng.randint(1, 2)))
+        reply = rng.choice(PATIENT_OPENERS).format(symptom=picked[0].lower())
+        for symptom in picked[1:]:
+            reply += rng.choice(PATIENT_FOLLOW_UPS).format(symptom=symptom.lower())
+        return reply + rng.choice(PATIENT_QUESTIONS)
+
+    def _doctor_reply(self, messages: List[Dict], system: str, rng: random.Random) -> str:
+        if 'diagnosis now' in messages[-1]['content']:
+            match = _CANDIDATES_RE.search(system)
+            candidates = [c.strip() for c in match.group(1).split(',')] if match else ['a viral infection']
+            return f"I think you have {rng.choice(candidates)}."
+        return rng.choice(DOCTOR_QUESTIONS)
+
+    def _judge_reply(self, messages: List[Dict], system: str) -> str:
+        match = _JUDGE_SCORES_RE.search(system)
+        dimensions = _JUDGE_DIMENSION_RE.findall(match.group(1)) if match else []
+        verdicts = []
+        for conversation_id, transcript in _JUDGE_SECTION_RE.findall(messages[-1]['content']):
+            # Seeded per transcript, so the same conversation always gets the same verdict
+            rng = random.Random(hashlib.sha256(transcript.strip().encode('utf-8')).digest())
+            replies = [line for line in transcript.splitlines() if line.startswith('Patient: ')]
+            engaged = 1 if replies and sum(len(r.split()) for r in replies) / len(replies) >= 8 else 0
+            verdicts.append({
+                'id': conversation_id,
+                'scores': {name: min(5, rng.randint(2, 4) + engaged) for name in dimensions},
+                'rationale': 'Mock verdict.',
+            })
+        return json.dumps(verdicts)
@@ -0,0 +1,237 @@
+# packing.py - Multi-turn fine-tuning samples packed into fixed-length sequences
+#
+# DatasetCollector.export_for_finetuning writes one sample per turn with every
+# earlier turn pasted into a "Context" string, so a conversation of n turns
+# costs O(n^2) tokens. Here each conversation is one sample in native chat
+# format (system prompt, then alternating "Doctor: ..." and patient messages,
+# the same messages get_patient_response sends), and samples are packed
+# several to a training sequence:
+#   - conversations longer than max_seq_len are split at turn boundaries, each
+#     part keeping the system prompt
+#   - samples are buffered in windows of `window`, sorted by token count and
+#     packed best-fit decreasing into sequences of at most max_seq_len tokens
+#   - packs are streamed to numbered JSONL shards of `shard_size` sequences,
+#     and manifest.json lists the shards with their sample and token counts
+# With a Hugging Face tokenizer each pack also carries input_ids, labels
+# (-100 outside patient messages) and position_ids restarting at every
+# sample, so packing-aware attention keeps samples from attending to each
+# other; the trainer pads packs to max_seq_len. Without one, token counts are
+# estimated at ~4 characters per token and packs hold only the messages.
+
+import json
+import os
+from bisect import bisect_left, insort
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_MAX_SEQ_LEN = 2048
+DEFAULT_SHARD_SIZE = 1000
+DEFAULT_WINDOW = 2000
+IGNORE_INDEX = -100
+CHARS_PER_TOKEN = 4
+# Role markers and separators the chat template adds around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def chat_messages(system_prompt: str, turns: List[Dict]) -> List[Dict]:
+    """Chat messages for {doctor, patient} turns, formatted as get_patient_response sends them"""
+    messages = [{"role": "system", "content": system_prompt}]
+    for turn in turns:
+        messages.append({"role": "user", "content": f"Doctor: {turn['doctor']}"})
+        messages.append({"role": "assistant", "content": turn['patient']})
+    return messages
+
+
+def per_turn_tokens(messages: List[Dict]) -> int:
+    """
+    Estimated tokens of the same conversation in export_for_finetuning's
+    per-turn format, where turn i is repeated in every later sample.
+    """
+    system = sum(len(m['content']) for m in messages if m['role'] == 'system')
+    turns = [len(m['content']) for m in messages if m['role'] != 'system']
+    pairs = [sum(turns[i:i + 2]) for i in range(0, len(turns), 2)]
+    n = len(pairs)
+    chars = n * system + sum((n - i) * length for i, length in enumerate(pairs))
+    return chars // CHARS_PER_TOKEN + n * 3 * MESSAGE_OVERHEAD_TOKENS
+
+
+def pack_lengths(lengths: List[int], capacity: int) -> List[List[int]]:
+    """Best-fit decreasing: indices of `lengths` grouped into bins of at most `capacity` (oversize items get their own bin)"""
+    bins: List[List[int]] = []
+    free: List[Tuple[int, int]] = []  # (remaining capacity, bin), ascending
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        pos = bisect_left(free, (lengths[i], -1))
+        if pos < len(free):
+            remaining, b = free.pop(pos)
+            bins[b].append(i)
+        else:
+            b = len(bins)
+            bins.append([i])
+            remaining = capacity
+        remaining -= lengths[i]
+        if remaining > 0:
+            insort(free, (remaining, b))
+    return bins
+
+
+class TokenCounter:
+    """Token counts (and, with a tokenizer, token ids and labels) of chat samples"""
+
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer
+        self.name = getattr(tokenizer, 'name_or_path', None) or ('tokenizer' if tokenizer else 'estimate')
+
+    def _ids(self, messages: List[Dict], add_generation_prompt: bool = False) -> List[int]:
+        from local_llm import chat_token_ids
+        return chat_token_ids(self.tokenizer, messages, add_generation_prompt) if messages else []
+
+    def message_tokens(self, messages: List[Dict]) -> List[int]:
+        """Tokens each message adds to the sample"""
+        if self.tokenizer is None:
+            return [len(m['content']) // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS for m in messages]
+        lengths = [len(self._ids(messages[:i + 1])) for i in range(len(messages))]
+        return [b - a for a, b in zip([0] + lengths, lengths)]
+
+    def encode(self, messages: List[Dict]) -> Tuple[List[int], List[int]]:
+        """Token ids and labels, with the loss on the patient (assistant) messages only"""
+        ids = self._ids(messages)
+        labels = [IGNORE_INDEX] * len(ids)
+        for i, message in enumerate(messages):
+            if message['role'] == 'assistant':
+                start = len(self._ids(messages[:i], add_generation_prompt=True))
+                end = len(self._ids(messages[:i + 1]))
+                labels[start:end] = ids[start:end]
+        return ids, labels
+
+
+class SequencePacker:
+    """
+    Streams conversations into packed, sharded training sequences:
+    add() each conversation's chat messages, then close() to flush the last
+    window and write the manifest.
+    """
+
+    def __init__(self, out_dir: str, max_seq_len: int = DEFAULT_MAX_SEQ_LEN, tokenizer=None,
+                 shard_size: int = DEFAULT_SHARD_SIZE, window: int = DEFAULT_WINDOW, prefix: str = 'packed'):
+        self.out_dir = out_dir
+        self.max_seq_len = max_seq_len
+        self.counter = TokenCounter(tokenizer)
+        self.shard_size = shard_size
+        self.window = window
+        self.prefix = prefix
+        self.shards: List[Dict] = []
+        self.stats = {
+            'conversations': 0, 'samples': 0, 'split_conversations': 0, 'oversize_samples': 0,
+            'packs': 0, 'tokens': 0, 'per_turn_tokens': 0,
+        }
+        # Samples per power-of-two length bucket, to help choose max_seq_len
+        self.length_buckets: Dict[int, int] = {}
+        # Tokens that fit their sequence (oversize samples are truncated by the trainer)
+        self._filled = 0
+        self._pending: List[Dict] = []
+        self._shard = None
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _parts(self, messages: List[Dict]) -> List[List[Dict]]:
+        """Messages split at turn boundaries into parts of at most max_seq_len tokens"""
+        lengths = self.counter.message_tokens(messages)
+        if sum(lengths) <= self.max_seq_len:
+            return [messages]
+        system, turns = messages[:1], messages[1:]
+        budget = self.max_seq_len - lengths[0]
+        parts, current, used = [], [], 0
+        for i in range(0, len(turns), 2):
+            size = sum(lengths[1 + i:3 + i])
+            if current and used + size > budget:
+                parts.append(system + current)
+                current, used = [], 0
+            current.extend(turns[i:i + 2])
+            used += size
+        parts.append(system + current)
+        return parts
+
+    def add(self, conversation_id, messages: List[Dict]):
+        self.stats['conversations'] += 1
+        self.stats['per_turn_tokens'] += per_turn_tokens(messages)
+        parts = self._parts(messages)
+        if len(parts) > 1:
+            self.stats['split_conversations'] += 1
+        for part_index, part in enumerate(parts):
+            sample = {'conversation_id': conversation_id, 'part': part_index, 'messages': part}
+            if self.counter.tokenizer is None:
+                sample['num_tokens'] = sum(self.counter.message_tokens(part))
+            else:
+                sample['input_ids'], sample['labels'] = self.counter.encode(part)
+                sample['num_tokens'] = len(sample['input_ids'])
+            self._pending.append(sample)
+        if len(self._pending) >= self.window:
+            self._flush()
+
+    def _flush(self):
+        samples, self._pending = self._pending, []
+        for indices in pack_lengths([s['num_tokens'] for s in samples], self.max_seq_len):
+            self._write_pack([samples[i] for i in indices])
+
+    def _write_pack(self, samples: List[Dict]):
+        pack = {'pack_id': self.stats['packs'], 'num_tokens': 0, 'samples': []}
+        if self.counter.tokenizer is not None:
+            pack.update(input_ids=[], labels=[], position_ids=[])
+        for sample in samples:
+            self.stats['samples'] += 1
+            bucket = 1 << max(0, sample['num_tokens'] - 1).bit_length()
+            self.length_buckets[bucket] = self.length_buckets.get(bucket, 0) + 1
+            if sample['num_tokens'] > self.max_seq_len:
+                # The system prompt and a single turn already exceed a sequence: the trainer truncates it
+                self.stats['oversize_samples'] += 1
+            if 'input_ids' in sample:
+                pack['input_ids'].extend(sample.pop('input_ids'))
+                pack['labels'].extend(sample.pop('labels'))
+                pack['position_ids'].extend(range(sample['num_tokens']))
+            pack['num_tokens'] += sample['num_tokens']
+            pack['samples'].append(sample)
+
+        if self._shard is None or self.shards[-1]['packs'] >= self.shard_size:
+            self._open_shard()
+        self._shard.write(json.dumps(pack, ensure_ascii=False) + '\n')
+        shard = self.shards[-1]
+        shard['packs'] += 1
+        shard['samples'] += len(samples)
+        shard['tokens'] += pack['num_tokens']
+        self.stats['packs'] += 1
+        self.stats['tokens'] += pack['num_tokens']
+        self._filled += min(pack['num_tokens'], self.max_seq_len)
+
+    def _open_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+        name = f"{self.prefix}_{len(self.shards):05d}.jsonl"
+        self._shard = open(os.path.join(self.out_dir, name), 'w', encoding='utf-8')
+        self.shards.append({'file': name, 'packs': 0, 'samples': 0, 'tokens': 0})
+
+    def close(self) -> Dict:
+        """Pack the remaining samples and write manifest.json; returns the manifest"""
+        self._flush()
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+        stats = self.stats
+        manifest = {
+            'created': datetime.now().isoformat(),
+            'max_seq_len': self.max_seq_len,
+            'tokenizer': self.counter.name,
+            'window': self.window,
+            **stats,
+            # Share of the packed sequences' max_seq_len slots holding real tokens
+            'fill': round(self._filled / (stats['packs'] * self.max_seq_len), 3) if stats['packs'] else None,
+            'length_buckets': {str(k): v for k, v in sorted(self.length_buckets.items())},
+            'shards': self.shards,
+        }
+        with open(os.path.join(self.out_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+
+def patient_system_prompt(name: Optional[str], condition: Optional[str] = None) -> str:
+    """Short system prompt for samples whose full patient prompt can't be rebuilt"""
+    patient = f"a patient named {name}" if name else "a patient"
+    return f"You are {patient} with {condition}." if condition else f"You are {patient}."
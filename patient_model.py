@@ -0,0 +1,296 @@
+# patient_model.py - Compact patients and conversation histories
+#
+# A patient_data dict carries its own copy of everything: the symptom lists
+# (plus `symptoms`, primary + secondary again), the persona's text and the
+# ~3KB compiled prompt, and every history turn is a dict repeating six keys.
+# Conversations are held in memory (ws_conversation) and serialized into the
+# session cookie on every request, so per-session size matters:
+#   - CaseRecord and PersonaRecord hold a condition's symptoms and a persona's
+#     text once per process, interned by value
+#   - Patient is a __slots__ dataclass referencing those records, plus the
+#     few per-patient fields; prompts are compiled once per distinct
+#     (case, persona, demographics) and shared
+#   - ConversationHistory stores turns column-wise: timestamps and counters
+#     in arrays, texts in lists, detected actions as tuples of interned names
+#   - pack()/unpack() give the session a small JSON form: eight values for a
+#     patient, one list per column for a history
+# Patient and Turn keep the mapping interface the rest of the app and the
+# tools use (patient['condition_name'], patient.get(...), turn['doctor']).
+
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from prompts_and_evaluator import build_prompt_template
+
+PROMPT_CACHE_SIZE = 1024
+
+
+@dataclass(frozen=True, slots=True)
+class CaseRecord:
+    condition_name: str
+    primary_symptoms: Tuple[str, ...]
+    secondary_symptoms: Tuple[str, ...]
+    symptoms: Tuple[str, ...]
+    condition_url: str = ''
+    treatments: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True, slots=True)
+class PersonaRecord:
+    id: str
+    name: str
+    age: int
+    occupation: str
+    personality_traits: str
+    behavior_notes: str
+    communication_style: str
+
+
+_cases: Dict[str, CaseRecord] = {}
+_personas: Dict[str, PersonaRecord] = {}
+_prompts: 'OrderedDict[tuple, str]' = OrderedDict()
+_lock = threading.Lock()
+
+
+def _interned(table: Dict, key: str, record):
+    # The latest record for a key wins (a reloaded dataset may change it);
+    # patients built from an older one keep their reference
+    with _lock:
+        current = table.get(key)
+        if current != record:
+            table[key] = current = record
+        return current
+
+
+def intern_case(condition_name: str, primary_symptoms: Iterable[str], secondary_symptoms: Iterable[str] = (),
+                condition_url: str = '', treatments: Iterable[str] = ()) -> CaseRecord:
+    primary = tuple(sys.intern(s) for s in primary_symptoms)
+    secondary = tuple(sys.intern(s) for s in secondary_symptoms)
+    record = CaseRecord(sys.intern(condition_name), primary, secondary, primary + secondary, condition_url, tuple(treatments))
+    return _interned(_cases, record.condition_name, record)
+
+
+def intern_persona(persona: Dict) -> PersonaRecord:
+    record = PersonaRecord(
+        sys.intern(persona['id']), persona.get('name', ''), int(persona.get('age') or 0), persona.get('occupation', ''),
+        persona.get('personality_traits', ''), persona.get('behavior_notes', ''), persona.get('communication_style', ''),
+    )
+    return _interned(_personas, record.id, record)
+
+
+def case_record(condition_name: str) -> Optional[CaseRecord]:
+    return _cases.get(condition_name)
+
+
+def persona_record(persona_id: str) -> Optional[PersonaRecord]:
+    return _personas.get(persona_id)
+
+
+# Keys of the patient_data mapping, and the ones that may be assigned
+PATIENT_KEYS = (
+    'name', 'age', 'gender', 'occupation', 'personality_type', 'condition_name', 'condition_url', 'symptoms',
+    'primary_symptoms', 'secondary_symptoms', 'treatments', 'personality_traits', 'behavior_notes',
+    'communication_style', 'diagnosis_given', 'disclosed_symptoms', 'prompt_template',
+)
+_WRITABLE = frozenset(('name', 'age', 'gender', 'occupation', 'diagnosis_given', 'disclosed_symptoms'))
+
+
+@dataclass(slots=True, eq=False)
+class Patient:
+    case: CaseRecord
+    persona: PersonaRecord
+    name: str
+    age: int
+    gender: str
+    occupation: str
+    diagnosis_given: bool = False
+    # Bitset of disclosed symptoms (disclosure.py)
+    disclosed_symptoms: int = 0
+    # A fixed prompt instead of the compiled one (the fallback patient)
+    prompt_override: Optional[str] = None
+
+    condition_name = property(lambda self: self.case.condition_name)
+    condition_url = property(lambda self: self.case.condition_url)
+    symptoms = property(lambda self: self.case.symptoms)
+    primary_symptoms = property(lambda self: self.case.primary_symptoms)
+    secondary_symptoms = property(lambda self: self.case.secondary_symptoms)
+    treatments = property(lambda self: self.case.treatments)
+    personality_type = property(lambda self: self.persona.id)
+    personality_traits = property(lambda self: self.persona.personality_traits)
+    behavior_notes = property(lambda self: self.persona.behavior_notes)
+    communication_style = property(lambda self: self.persona.communication_style)
+
+    @property
+    def prompt_template(self) -> str:
+        if self.prompt_override is not None:
+            return self.prompt_override
+        key = (self.case, self.persona, self.name, self.age, self.occupation)
+        with _lock:
+            prompt = _prompts.get(key)
+            if prompt is not None:
+                _prompts.move_to_end(key)
+                return prompt
+        prompt = build_prompt_template(self, self.condition_name, list(self.symptoms))
+        with _lock:
+            _prompts[key] = prompt
+            while len(_prompts) > PROMPT_CACHE_SIZE:
+                _prompts.popitem(last=False)
+        return prompt
+
+    # patient_data mapping interface
+    def __getitem__(self, key: str):
+        if key not in PATIENT_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value):
+        if key not in _WRITABLE:
+            raise KeyError(f"'{key}' can't be set on a patient")
+        setattr(self, key, value)
+
+    def __contains__(self, key) -> bool:
+        return key in PATIENT_KEYS
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in PATIENT_KEYS else default
+
+    def keys(self):
+        return iter(PATIENT_KEYS)
+
+    def copy(self) -> 'Patient':
+        return replace(self)
+
+    def to_dict(self) -> Dict:
+        """The full patient_data dict (for JSON responses)"""
+        return {key: list(value) if isinstance(value, tuple) else value for key, value in ((k, self[k]) for k in PATIENT_KEYS)}
+
+    def pack(self) -> List:
+        """[condition, persona id, name, age, gender, occupation, diagnosis_given, disclosed_symptoms]"""
+        return [self.case.condition_name, self.persona.id, self.name, self.age, self.gender, self.occupation,
+                int(self.diagnosis_given), self.disclosed_symptoms]
+
+    @classmethod
+    def unpack(cls, packed: List, case: CaseRecord, persona: PersonaRecord) -> 'Patient':
+        _, _, name, age, gender, occupation, diagnosis_given, disclosed = packed
+        return cls(case, persona, name, age, gender, occupation, bool(diagnosis_given), disclosed)
+
+    @classmethod
+    def from_dict(cls, patient_data: Dict) -> 'Patient':
+        """A Patient from a patient_data dict (sessions from before this module)"""
+        primary = patient_data.get('primary_symptoms')
+        if primary is None:
+            primary, secondary = patient_data.get('symptoms') or [], []
+        else:
+            secondary = patient_data.get('secondary_symptoms') or []
+        case = intern_case(patient_data['condition_name'], primary, secondary,
+                           patient_data.get('condition_url', ''), patient_data.get('treatments') or ())
+        persona = intern_persona(dict(patient_data, id=patient_data.get('personality_type', '')))
+        return cls(case, persona, patient_data.get('name', ''), patient_data.get('age', 0), patient_data.get('gender', ''),
+                   patient_data.get('occupation', ''), bool(patient_data.get('diagnosis_given')),
+                   patient_data.get('disclosed_symptoms', 0))
+
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+@dataclass(slots=True)
+class Turn:
+    timestamp: str
+    doctor: str
+    patient: str
+    symptoms_revealed: Tuple[str, ...] = ()
+    diagnosis_attempts: int = 0
+    session_end: bool = False
+
+    def __getitem__(self, key: str):
+        if key not in TURN_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in TURN_KEYS else default
+
+    def to_dict(self) -> Dict:
+        return {key: list(value) if isinstance(value, tuple) else value for key, value in ((k, self[k]) for k in TURN_KEYS)}
+
+
+TURN_KEYS = ('timestamp', 'doctor', 'patient', 'symptoms_revealed', 'diagnosis_attempts', 'session_end')
+
+
+class ConversationHistory:
+    """Turns of one conversation, stored column-wise; indexing and iteration yield Turn objects"""
+
+    __slots__ = ('_timestamps', '_doctor', '_patient', '_actions', '_attempts', '_ended')
+
+    def __init__(self):
+        self._timestamps = array('q')  # microseconds since 1970-01-01 (naive local time, as logged)
+        self._doctor: List[str] = []
+        self._patient: List[str] = []
+        self._actions: List[Tuple[str, ...]] = []
+        self._attempts = array('H')
+        self._ended = array('B')
+
+    def append(self, turn: Union[Turn, Dict]):
+        get = turn.get
+        timestamp = datetime.fromisoformat(get('timestamp')) if get('timestamp') else datetime.now()
+        self._timestamps.append((timestamp - _EPOCH) // _MICROSECOND)
+        self._doctor.append(get('doctor'))
+        self._patient.append(get('patient'))
+        # Action names come from a small fixed vocabulary
+        self._actions.append(tuple(sys.intern(a) for a in get('symptoms_revealed') or ()))
+        self._attempts.append(min(int(get('diagnosis_attempts') or 0), 0xFFFF))
+        self._ended.append(1 if get('session_end') else 0)
+
+    def _turn(self, i: int) -> Turn:
+        timestamp = (_EPOCH + self._timestamps[i] * _MICROSECOND).isoformat()
+        return Turn(timestamp, self._doctor[i], self._patient[i], self._actions[i], self._attempts[i], bool(self._ended[i]))
+
+    def __len__(self) -> int:
+        return len(self._doctor)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._turn(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('turn index out of range')
+        return self._turn(index)
+
+    def __iter__(self) -> Iterator[Turn]:
+        return (self._turn(i) for i in range(len(self)))
+
+    @property
+    def patient_replies(self) -> List[str]:
+        return self._patient
+
+    def copy(self) -> 'ConversationHistory':
+        return ConversationHistory.unpack(self.pack())
+
+    def pack(self) -> Dict:
+        return {
+            'ts': self._timestamps.tolist(), 'doctor': list(self._doctor), 'patient': list(self._patient),
+            'actions': [list(a) for a in self._actions], 'attempts': self._attempts.tolist(), 'end': self._ended.tolist(),
+        }
+
+    @classmethod
+    def unpack(cls, packed) -> 'ConversationHistory':
+        """From pack() output, or from a list of turn dicts (sessions from before this module)"""
+        history = cls()
+        if isinstance(packed, dict):
+            history._timestamps.extend(packed['ts'])
+            history._doctor.extend(packed['doctor'])
+            history._patient.extend(packed['patient'])
+            history._actions.extend(tuple(sys.intern(a) for a in actions) for actions in packed['actions'])
+            history._attempts.extend(packed['attempts'])
+            history._ended.extend(packed['end'])
+        else:
+            for turn in packed or ():
+                history.append(turn)
+        return history
@@ -0,0 +1,219 @@
+# profiling.py - On-demand profiling of a live worker
+#
+# Three opt-in tools, all behind PROFILING_TOKEN (unset = disabled):
+#   - StackSampler: samples every thread's stack at a fixed interval for N
+#     seconds and returns collapsed stacks ("frame;frame;frame count"), the
+#     input format of flamegraph.pl and speedscope. The requesting thread
+#     reads sys._current_frames() itself, so no signal handler is needed and
+#     it works from any request thread of a gthread worker.
+#   - RequestProfiler: cProfile for a single request, switched on by the
+#     X-Profile header; the pstats file is saved under profiles/.
+#   - MemoryTracer: tracemalloc baseline + diff, to see which lines keep
+#     allocating (sessions, log buffers) between two points in time.
+# Everything is per worker process: a request profiles whichever worker
+# gunicorn routed it to.
+
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Optional
+
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+MAX_SAMPLE_SECONDS = 60
+DEFAULT_SAMPLE_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 25
+# Saved per-request profiles kept on disk (oldest deleted first)
+MAX_SAVED_PROFILES = 50
+
+
+def authorized(token: Optional[str]) -> bool:
+    """True when profiling is enabled and `token` matches PROFILING_TOKEN"""
+    return bool(PROFILING_TOKEN) and token is not None and hmac.compare_digest(token, PROFILING_TOKEN)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Wall-clock stack sampler over all threads; one run at a time per process"""
+
+    def __init__(self):
+        self._busy = threading.Lock()
+
+    def sample(self, seconds: float, interval: float = DEFAULT_SAMPLE_INTERVAL, idle: bool = False) -> Optional[Dict]:
+        """
+        Sample for `seconds` and return {'stacks': Counter, 'samples': n, ...},
+        or None when another run is in progress. Threads parked in a wait
+        (lock, queue, socket accept) are skipped unless `idle` is set.
+        """
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            seconds = min(max(seconds, 0.1), MAX_SAMPLE_SECONDS)
+            stacks = Counter()
+            samples = 0
+            caller = threading.get_ident()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            started = time.perf_counter()
+            deadline = started + seconds
+            while time.perf_counter() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == caller:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(_frame_label(frame))
+                        frame = frame.f_back
+                    if not idle and stack and stack[0].split(' ', 1)[0] in ('wait', 'select', 'accept', 'get', 'poll', '_wait_for_tstate_lock'):
+                        continue
+                    thread_name = names.get(thread_id) or str(thread_id)
+                    stacks[';'.join([thread_name] + stack[::-1])] += 1
+                samples += 1
+                time.sleep(interval)
+            return {
+                'stacks': stacks,
+                'samples': samples,
+                'seconds': round(time.perf_counter() - started, 3),
+                'interval': interval,
+            }
+        finally:
+            self._busy.release()
+
+
+def collapse(stacks: Counter) -> str:
+    """Collapsed-stack text, heaviest stacks first"""
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class RequestProfiler:
+    """
+    cProfile for single requests. Only one request is profiled at a time per
+    process; concurrent requests asking for it run unprofiled.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._busy = threading.Lock()
+
+    def start(self) -> Optional[cProfile.Profile]:
+        if not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile: cProfile.Profile, label: str) -> Dict:
+        """Stop `profile`, save it as a .prof file and return its name and top functions"""
+        try:
+            profile.disable()
+        finally:
+            self._busy.release()
+        os.makedirs(self.directory, exist_ok=True)
+        safe_label = ''.join(c if c.isalnum() else '_' for c in label).strip('_') or 'request'
+        name = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{safe_label}.prof"
+        profile.dump_stats(os.path.join(self.directory, name))
+        self._prune()
+
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(15)
+        return {'file': name, 'total_seconds': round(stats.total_tt, 4), 'top': out.getvalue()}
+
+    def _prune(self):
+        files = sorted(f for f in os.listdir(self.directory) if f.endswith('.prof'))
+        for name in files[:-MAX_SAVED_PROFILES]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def path(self, name: str) -> Optional[str]:
+        """Path of a saved profile, or None for names that are not one"""
+        if os.path.basename(name) != name or not name.endswith('.prof'):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.exists(path) else None
+
+
+class MemoryTracer:
+    """tracemalloc baseline/diff; tracing costs memory and CPU, so stop it when done"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.baseline = None
+        self.started_at = None
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+    def start(self) -> Dict:
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.baseline = self._snapshot()
+            self.started_at = datetime.now().isoformat()
+            return self.status()
+
+    def stop(self) -> Dict:
+        with self._lock:
+            tracemalloc.stop()
+            self.baseline = None
+            self.started_at = None
+            return self.status()
+
+    def status(self) -> Dict:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {'tracing': tracing, 'baseline_taken': self.started_at, 'traced_bytes': current, 'peak_bytes': peak}
+
+    def diff(self, top: int = 25, key_type: str = 'lineno', match: Optional[str] = None, rebase: bool = False) -> Optional[Dict]:
+        """
+        Allocation growth since the baseline, largest first. `match` keeps
+        entries whose file path contains it (e.g. 'log_store' or 'session');
+        `rebase` makes this snapshot the new baseline. None when not started.
+        """
+        with self._lock:
+            if self.baseline is None:
+                return None
+            snapshot = self._snapshot()
+            stats = snapshot.compare_to(self.baseline, key_type)
+            if match:
+                stats = [s for s in stats if any(match in frame.filename for frame in s.traceback)]
+            result = {
+                'since': self.started_at,
+                'total_growth_bytes': sum(s.size_diff for s in stats),
+                'top': [self._entry(s) for s in stats[:top]],
+            }
+            if rebase:
+                self.baseline = snapshot
+                self.started_at = datetime.now().isoformat()
+            return result
+
+    @staticmethod
+    def _entry(stat) -> Dict:
+        return {
+            'location': [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback][:5],
+            'size_diff': stat.size_diff,
+            'size': stat.size,
+            'count_diff': stat.count_diff,
+            'count': stat.count,
+        }
+
+
+# Global instances
+stack_sampler = StackSampler()
+memory_tracer = MemoryTracer()
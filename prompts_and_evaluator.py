@@ -2,7 +2,6 @@
 
 import json
 import os
-import numpy as np
 from datetime import datetime
 from collections import defaultdict
 from typing import Dict, Any
@@ -32,10 +31,14 @@ class DatasetCollector:
         training_data = []
         for cid, msgs in grouped.items():
             msgs.sort(key=lambda x: x['timestamp'])
-            persona = msgs[0]['persona']
+            # Self-play records carry the persona, older logs its id, app logs the patient's name
+            persona = msgs[0].get('persona')
+            if not isinstance(persona, dict):
+                persona = {'id': msgs[0].get('personality_type') or persona, 'name': msgs[0].get('patient_name')}
             training_data.append({
                 'conversation_id': cid,
                 'persona': persona,
+                'condition': msgs[0].get('condition'),
                 'messages': [{
                     'doctor': m['doctor_message'],
                     'patient': m['patient_response'],
@@ -70,24 +73,56 @@ class DatasetCollector:
             score += 1
         return min(score, 5)
 
-    def export_for_finetuning(self, training_data, format_type="openai"):
+    def _training_conversations(self, training_data, report_path, dedup_threshold):
+        conversations = [conv for conv in training_data if conv['metadata']['quality_score'] >= 3]
+        if dedup_threshold:
+            # Drop near-identical conversations (same patient replies) before they are exported
+            from dedup import NearDuplicateFilter
+            near_duplicates = NearDuplicateFilter(threshold=dedup_threshold)
+            conversations = list(near_duplicates.filter(
+                conversations,
+                key=lambda conv: conv['conversation_id'],
+                text=lambda conv: "\n".join(m['patient'] for m in conv['messages']),
+            ))
+            report = near_duplicates.write_report(report_path)
+            print(f"[DatasetCollector] Dropped {report['dropped']} near-duplicate conversations, kept {report['kept']}")
+        return conversations
+
+    def export_for_finetuning(self, training_data, format_type="openai", dedup_threshold=0.8):
         if format_type == "openai":
             filename = f"{self.output_dir}/finetune_{datetime.now().strftime('%Y%m%d')}.jsonl"
+            conversations = self._training_conversations(training_data, filename[:-len('.jsonl')] + '_dedup.json', dedup_threshold)
+            from packing import patient_system_prompt
             with open(filename, 'w') as f:
-                for conv in training_data:
-                    if conv['metadata']['quality_score'] >= 3:
-                        for i, msg in enumerate(conv['messages']):
-                            context = conv['messages'][:i]
-                            context_str = "\n".join([f"Doctor: {c['doctor']}\nPatient: {c['patient']}" for c in context])
-                            f.write(json.dumps({
-                                "messages": [
-                                    {"role": "system", "content": f"You are a patient named {conv['persona']['name']} with chest pain."},
-                                    {"role": "user", "content": f"Context:\n{context_str}\n\nDoctor: {msg['doctor']}"},
-                                    {"role": "assistant", "content": msg['patient']}
-                                ]
-                            }) + '\n')
+                for conv in conversations:
+                    system_prompt = patient_system_prompt(conv['persona'].get('name'), conv.get('condition'))
+                    for i, msg in enumerate(conv['messages']):
+                        context = conv['messages'][:i]
+                        context_str = "\n".join([f"Doctor: {c['doctor']}\nPatient: {c['patient']}" for c in context])
+                        f.write(json.dumps({
+                            "messages": [
+                                {"role": "system", "content": system_prompt},
+                                {"role": "user", "content": f"Context:\n{context_str}\n\nDoctor: {msg['doctor']}"},
+                                {"role": "assistant", "content": msg['patient']}
+                            ]
+                        }) + '\n')
             return filename
 
+    def export_packed(self, training_data, max_seq_len=2048, tokenizer=None, dedup_threshold=0.8):
+        """
+        One multi-turn chat sample per conversation, packed into sharded
+        sequences of max_seq_len tokens (see packing.py). Returns the manifest.
+        """
+        from packing import SequencePacker, chat_messages, patient_system_prompt
+        out_dir = f"{self.output_dir}/packed_{datetime.now().strftime('%Y%m%d')}"
+        os.makedirs(out_dir, exist_ok=True)
+        conversations = self._training_conversations(training_data, f"{out_dir}/dedup_report.json", dedup_threshold)
+        packer = SequencePacker(out_dir, max_seq_len=max_seq_len, tokenizer=tokenizer)
+        for conv in conversations:
+            system_prompt = patient_system_prompt(conv['persona'].get('name'), conv.get('condition'))
+            packer.add(conv['conversation_id'], chat_messages(system_prompt, conv['messages']))
+        return packer.close()
+
 
 # ---------------- SIMULATION EVALUATOR ----------------
 class PatientSimulationEvaluator:
@@ -95,6 +130,7 @@ class PatientSimulationEvaluator:
         msgs = conv_data.get('messages', [])
         if not msgs:
             return {"overall_score": 0, "reason": "No messages"}
+        import numpy as np
         patient_responses = [m['patient'] for m in msgs]
         doctor_qs = [m['doctor'] for m in msgs]
         return {
@@ -123,6 +159,7 @@ class PatientSimulationEvaluator:
         return min(score, 5)
 
     def _score_engagement(self, responses, questions):
+        import numpy as np
         score = 0
         if sum(1 for r in responses if '?' in r) >= 2:
             score += 2
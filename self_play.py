@@ -0,0 +1,304 @@
+# self_play.py - Doctor-agent self-play for synthetic conversation generation
+#
+# Pairs a doctor agent (scripted, or an LLM prompted to interview and diagnose)
+# with the app's patient pipeline and runs many conversations concurrently.
+# Turns are written in the conversation log schema, plus the `persona` record
+# DatasetCollector.process_conversation_logs expects, so the output feeds the
+# existing fine-tuning export. Runs are deterministic per conversation index
+# (seeded patient, persona and doctor script), which makes checkpoint/resume
+# exact: the checkpoint stores the indices written to the output and its offset,
+# and a resumed run truncates anything written after it and continues
+# (retrying conversations that failed).
+
+import json
+import os
+import random
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from action_mapper import action_mapper
+from disclosure import update_disclosure
+from end_detector import end_detector
+
+SELF_PLAY_NAMESPACE = uuid.UUID('6f1d3c52-5a0e-4f0a-9a43-1f7f4f3e2b10')
+CHECKPOINT_VERSION = 1
+# Seconds between checkpoint writes (also written at the end of a run)
+CHECKPOINT_INTERVAL = 10
+DEFAULT_MAX_TURNS = 12
+
+
+# ---------------- DOCTOR AGENTS ----------------
+OPENINGS = [
+    "Hello, what brings you in today?",
+    "Hi there, how can I help you today?",
+    "Good morning. What seems to be the problem?",
+    "Hello, I'm the doctor on duty. What's been bothering you?",
+]
+FOLLOW_UPS = [
+    "When did this start?",
+    "Can you describe it in a bit more detail?",
+    "How bad is it on a scale of one to ten?",
+    "Have you noticed any other symptoms?",
+    "Does anything make it better or worse?",
+    "Have you had anything like this before?",
+    "Are you taking any medication at the moment?",
+    "Is it affecting your sleep or your work?",
+]
+DIAGNOSES = [
+    "I think you have {condition}.",
+    "Based on your symptoms, this looks like {condition}.",
+    "From what you've told me, the diagnosis is {condition}.",
+]
+
+
+class ScriptedDoctor:
+    """
+    Interviews with a seeded selection of follow-up questions, then diagnoses.
+    With probability `accuracy` the first diagnosis is correct; otherwise a
+    wrong one comes first and the right one after more questions.
+    """
+
+    name = 'scripted'
+
+    def __init__(self, accuracy: float = 0.8, min_questions: int = 2, max_questions: int = 5):
+        self.accuracy = accuracy
+        self.min_questions = min_questions
+        self.max_questions = max_questions
+
+    def session(self, patient_data: Dict, candidates: List[str], rng: random.Random) -> Callable[[List[Dict]], Optional[str]]:
+        questions = rng.sample(FOLLOW_UPS, rng.randint(self.min_questions, self.max_questions))
+        script = [rng.choice(OPENINGS)] + questions
+        condition = patient_data['condition_name']
+        wrong = [c for c in candidates if c != condition]
+        if wrong and rng.random() >= self.accuracy:
+            script.append(rng.choice(DIAGNOSES).format(condition=rng.choice(wrong)))
+            script.extend(rng.sample([q for q in FOLLOW_UPS if q not in questions], 2))
+        script.append(rng.choice(DIAGNOSES).format(condition=condition))
+        return lambda history: script[len(history)] if len(history) < len(script) else None
+
+
+class LLMDoctor:
+    """Doctor played by a model; it sees a differential list, not the answer"""
+
+    name = 'llm'
+
+    SYSTEM_PROMPT = (
+        "You are a doctor (a GP) interviewing a patient. Ask one short question at a time about "
+        "their symptoms, onset, severity and history. When you are confident, give your diagnosis "
+        "in the form \"I think you have <condition>.\" Do not list options or explain your reasoning.\n"
+        "Possible conditions: {candidates}"
+    )
+
+    def __init__(self, get_client: Callable, model: str, max_questions: int = 8, differential_size: int = 8):
+        self.get_client = get_client
+        self.model = model
+        self.max_questions = max_questions
+        self.differential_size = differential_size
+
+    def session(self, patient_data: Dict, candidates: List[str], rng: random.Random) -> Callable[[List[Dict]], Optional[str]]:
+        condition = patient_data['condition_name']
+        others = [c for c in candidates if c != condition]
+        differential = rng.sample(others, min(len(others), self.differential_size - 1)) + [condition]
+        rng.shuffle(differential)
+        system = self.SYSTEM_PROMPT.format(candidates=', '.join(differential))
+
+        def next_message(history: List[Dict]) -> Optional[str]:
+            if history and patient_data.get('diagnosis_given'):
+                return None
+            messages = [{"role": "system", "content": system}]
+            for turn in history:
+                messages.append({"role": "assistant", "content": turn['doctor']})
+                messages.append({"role": "user", "content": turn['patient']})
+            if len(history) >= self.max_questions:
+                messages.append({"role": "user", "content": "Please give your diagnosis now."})
+            elif not history:
+                messages.append({"role": "user", "content": "The patient has just sat down."})
+            response = self.get_client().chat.completions.create(
+                model=self.model, messages=messages, max_tokens=120, temperature=0.9
+            )
+            content = (response.choices[0].message.content or '').strip()
+            return content or None
+
+        return next_message
+
+
+# ---------------- ENGINE ----------------
+class SelfPlayEngine:
+    """
+    Runs `total` conversations with at most `concurrency` in flight.
+    `simulator` is the app's MedicalPatientSimulator and `respond` its
+    get_patient_response; LLM calls go through whatever client the app has.
+    """
+
+    def __init__(self, simulator, respond: Callable, doctor, output_path: str, model_name: str,
+                 concurrency: int = 8, max_turns: int = DEFAULT_MAX_TURNS, seed: int = 0):
+        self.simulator = simulator
+        self.respond = respond
+        self.doctor = doctor
+        self.output_path = output_path
+        self.checkpoint_path = output_path + '.checkpoint.json'
+        self.model_name = model_name
+        self.concurrency = concurrency
+        self.max_turns = max_turns
+        self.seed = seed
+        self.stats = {'conversations': 0, 'turns': 0, 'diagnosed': 0, 'errors': 0}
+
+    # ---------------- ONE CONVERSATION ----------------
+    def conversation_id(self, index: int) -> str:
+        return str(uuid.uuid5(SELF_PLAY_NAMESPACE, f"{self.seed}:{index}"))
+
+    def run_conversation(self, index: int) -> List[Dict]:
+        """Play conversation `index` to the end and return its turn records"""
+        rng = random.Random(f"{self.seed}:{index}")
+        dataset = self.simulator.dataset
+        disease = rng.choice(dataset.disease_names)
+        persona = rng.choice(dataset.personas)
+        patient_data = self.simulator.build_patient(disease, persona)
+        next_message = self.doctor.session(patient_data, dataset.disease_names, rng)
+        conversation_id = self.conversation_id(index)
+
+        history, records = [], []
+        while len(history) < self.max_turns:
+            doctor_message = next_message(history)
+            if not doctor_message:
+                break
+            started = time.perf_counter()
+            patient_response, is_error = self.respond(
+                patient_data, history, doctor_message,
+                model_name=self.model_name, prompt_template=patient_data['prompt_template'],
+                conversation_id=conversation_id,
+            )
+            latency_ms = (time.perf_counter() - started) * 1000
+            if is_error:
+                # Failed calls are not training data; drop the whole conversation
+                return []
+            history.append({'doctor': doctor_message, 'patient': patient_response})
+            coverage = update_disclosure(patient_data, patient_response)
+            ended = bool(patient_data.get('diagnosis_given') and end_detector.detect(patient_response))
+            records.append({
+                'conversation_id': conversation_id,
+                'persona': {
+                    'id': persona['id'],
+                    'name': patient_data['name'],
+                    'age': patient_data['age'],
+                    'occupation': patient_data['occupation'],
+                },
+                'patient_name': patient_data['name'],
+                'condition': disease,
+                'personality_type': persona['id'],
+                'timestamp': datetime.now().isoformat(),
+                'doctor_message': doctor_message,
+                'patient_response': patient_response,
+                'model_name': self.model_name,
+                # find_actions rather than process_patient_message: no per-message console output
+                'symptoms_revealed': [a['action'] for a in action_mapper.find_actions(patient_response)],
+                'diagnosis_attempts': 0,
+                'session_end': ended,
+                'diagnosis_given': patient_data.get('diagnosis_given', False),
+                'latency_ms': round(latency_ms, 1),
+                'disclosed_symptoms': coverage['bits'],
+                'symptom_coverage': coverage['coverage'],
+                'primary_coverage': round(coverage['primary_disclosed'] / coverage['primary_total'], 3) if coverage['primary_total'] else None,
+                'newly_disclosed': coverage['newly_disclosed'],
+                'source': 'self_play',
+                'doctor_agent': self.doctor.name,
+            })
+            if ended:
+                break
+        return records
+
+    # ---------------- CHECKPOINTS ----------------
+    def _load_checkpoint(self) -> Dict:
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('version') == CHECKPOINT_VERSION and checkpoint.get('seed') == self.seed:
+                return checkpoint
+        except (OSError, ValueError):
+            pass
+        return {'version': CHECKPOINT_VERSION, 'seed': self.seed, 'done': [], 'offset': 0, 'stats': {}}
+
+    def _save_checkpoint(self, done: set, offset: int):
+        tmp_path = f"{self.checkpoint_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': CHECKPOINT_VERSION,
+                'seed': self.seed,
+                'done': sorted(done),
+                'offset': offset,
+                'stats': self.stats,
+            }, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    # ---------------- RUN ----------------
+    def run(self, total: int, progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+        """Generate conversations 0..total-1, skipping the ones a previous run finished"""
+        checkpoint = self._load_checkpoint()
+        done = set(checkpoint['done'])
+        self.stats.update(checkpoint.get('stats', {}))
+        os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+
+        # Anything past the checkpointed offset belongs to conversations that
+        # are not in `done`; drop it so they are not written twice
+        out = open(self.output_path, 'ab')
+        out.truncate(checkpoint['offset'])
+        out.seek(checkpoint['offset'])
+
+        pending = (i for i in range(total) if i not in done)
+        started = time.monotonic()
+        new_conversations = 0
+        last_checkpoint = started
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                in_flight = {}
+                while True:
+                    # Keep at most `concurrency` conversations queued beyond the running ones
+                    while len(in_flight) < self.concurrency * 2:
+                        index = next(pending, None)
+                        if index is None:
+                            break
+                        in_flight[pool.submit(self.run_conversation, index)] = index
+                    if not in_flight:
+                        break
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        index = in_flight.pop(future)
+                        records = future.result()
+                        if records:
+                            out.write(''.join(json.dumps(r) + '\n' for r in records).encode('utf-8'))
+                            self.stats['conversations'] += 1
+                            self.stats['turns'] += len(records)
+                            self.stats['diagnosed'] += int(records[-1]['diagnosis_given'])
+                            new_conversations += 1
+                            done.add(index)
+                        else:
+                            # Not checkpointed: a rerun with the same seed retries it
+                            self.stats['errors'] += 1
+
+                    if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                        out.flush()
+                        os.fsync(out.fileno())
+                        self._save_checkpoint(done, out.tell())
+                        last_checkpoint = time.monotonic()
+                        if progress:
+                            progress(self.throughput(len(done), total, new_conversations, started))
+        finally:
+            # Only conversations whose records are fully on disk are checkpointed
+            out.flush()
+            os.fsync(out.fileno())
+            self._save_checkpoint(done, out.tell())
+            out.close()
+        return self.throughput(len(done), total, new_conversations, started)
+
+    def throughput(self, done: int, total: int, new_conversations: int, started: float) -> Dict:
+        elapsed = max(time.monotonic() - started, 1e-9)
+        return dict(
+            self.stats,
+            done=done,
+            total=total,
+            elapsed_seconds=round(elapsed, 1),
+            conversations_per_hour=round(new_conversations / elapsed * 3600),
+        )
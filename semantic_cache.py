@@ -0,0 +1,282 @@
+# semantic_cache.py - Reuse patient replies for paraphrased doctor questions
+#
+# The shared response cache only hits on byte-identical requests, but early
+# turns are mostly the same few questions in different words ("what brings
+# you in today?", "what brought you in?"). This cache sits in front of it:
+#   - the doctor's message is embedded on CPU, by default as a hashed bag of
+#     word unigrams, bigrams and character 4-grams (contractions expanded,
+#     function words down-weighted, L2-normalised); SEMANTIC_CACHE_MODEL can
+#     point at a local sentence-transformers model instead
+#   - each (model, condition, persona, turn stage, prompt) scope has its own
+#     index: random-hyperplane LSH tables give candidate messages, which are
+#     re-ranked by exact cosine similarity
+#   - a match at or above SEMANTIC_CACHE_THRESHOLD serves one of that
+#     message's stored replies; while it has fewer than
+#     SEMANTIC_CACHE_VARIANTS, a match is still sent to the LLM with
+#     probability 1 - SEMANTIC_CACHE_REUSE and the new reply added as a
+#     variant, so a repeated question doesn't always get the same answer.
+#     Replies the patient already gave in the conversation are never reused
+# Only the first SEMANTIC_CACHE_MAX_TURN turns are eligible: later replies
+# depend on the conversation so far. The index lives in each worker's memory
+# and is bounded by SEMANTIC_CACHE_MAX_ENTRIES (least recently used scopes go
+# first); SEMANTIC_CACHE_THRESHOLD=0 turns it off.
+
+import hashlib
+import os
+import random
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.8'))
+SEMANTIC_CACHE_REUSE = float(os.getenv('SEMANTIC_CACHE_REUSE', '0.8'))
+SEMANTIC_CACHE_VARIANTS = int(os.getenv('SEMANTIC_CACHE_VARIANTS', '3'))
+SEMANTIC_CACHE_MAX_TURN = int(os.getenv('SEMANTIC_CACHE_MAX_TURN', '3'))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', '10000'))
+SEMANTIC_CACHE_MODEL = os.getenv('SEMANTIC_CACHE_MODEL')
+
+HASH_DIM = 512
+# 20 tables of 8 hyperplanes: ~97% of neighbours at cosine 0.8 share a bucket
+LSH_TABLES = 20
+LSH_BITS = 8
+SCOPE_MAX_ENTRIES = 256
+
+_CONTRACTIONS = [
+    (re.compile(r"\bwon't\b"), 'will not'), (re.compile(r"\bcan't\b"), 'can not'),
+    (re.compile(r"n't\b"), ' not'), (re.compile(r"'re\b"), ' are'), (re.compile(r"'ve\b"), ' have'),
+    (re.compile(r"'m\b"), ' am'), (re.compile(r"'ll\b"), ' will'), (re.compile(r"'d\b"), ' would'),
+    (re.compile(r"\b(what|where|how|who|that|it|there)'s\b"), r'\1 is'),
+]
+_WORD_RE = re.compile(r"[a-z0-9]+")
+# Present in most questions, so they say little about which question it is
+STOPWORDS = frozenset(
+    "a an the these those this that is are am be been was were do does did you your i me my we our to of in on "
+    "at for with and or so it there any have has had can could would will please doctor doc just today now".split()
+)
+# Chat spellings and interview synonyms, mapped before stemming
+SYNONYMS = {
+    'u': 'you', 'ur': 'your', 'hello': 'hi', 'hey': 'hi', 'hiya': 'hi', 'meds': 'medication',
+    'medicine': 'medication', 'medicines': 'medication', 'pills': 'medication', 'tablets': 'medication',
+    'brought': 'bring', 'bad': 'severe', 'serious': 'severe', 'problem': 'issue', 'trouble': 'issue',
+    'began': 'start', 'begin': 'start', 'started': 'start', 'starting': 'start', 'temperature': 'fever',
+}
+
+
+def _hash(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=4).digest(), 'little')
+
+
+def _stem(word: str) -> str:
+    for suffix in ('ing', 'ed', 'es', 's'):
+        if len(word) > len(suffix) + 3 and word.endswith(suffix):
+            return word[:-len(suffix)]
+    return word
+
+
+def normalize(text: str) -> List[str]:
+    """Lower-cased words with contractions expanded, synonyms mapped and plural/tense suffixes stripped"""
+    text = text.lower().replace('\u2019', "'")
+    for pattern, replacement in _CONTRACTIONS:
+        text = pattern.sub(replacement, text)
+    words = (SYNONYMS.get(word, word) for word in _WORD_RE.findall(text))
+    return [word if word in STOPWORDS else _stem(word) for word in words]
+
+
+class HashingEmbedder:
+    """Signed feature hashing of words, word bigrams and character 4-grams (typos, plurals)"""
+
+    name = 'hashing'
+
+    def __init__(self, dim: int = HASH_DIM):
+        import numpy as np
+
+        self.np = np
+        self.dim = dim
+
+    def features(self, text: str) -> Dict[str, float]:
+        words = normalize(text)
+        features: Dict[str, float] = {}
+        for word in words:
+            weight = 0.3 if word in STOPWORDS else 1.0
+            features['w:' + word] = features.get('w:' + word, 0.0) + weight
+            if weight == 1.0 and len(word) > 4:
+                padded = f"<{word}>"
+                grams = [padded[i:i + 4] for i in range(len(padded) - 3)]
+                for gram in grams:
+                    features['c:' + gram] = features.get('c:' + gram, 0.0) + 0.5 / len(grams) ** 0.5
+        for a, b in zip(words, words[1:]):
+            weight = 0.2 if a in STOPWORDS and b in STOPWORDS else 0.7
+            features[f"b:{a} {b}"] = features.get(f"b:{a} {b}", 0.0) + weight
+        return features
+
+    def embed(self, text: str):
+        np = self.np
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, weight in self.features(text).items():
+            h = _hash(feature)
+            vector[h % self.dim] += weight if h >> 31 else -weight
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+
+class ModelEmbedder:
+    """A local sentence-transformers model, run on CPU"""
+
+    name = 'model'
+
+    def __init__(self, path: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(path, device='cpu')
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, text: str):
+        return self.model.encode(text, normalize_embeddings=True).astype('float32')
+
+
+def turn_stage(turn: int, max_turn: int = SEMANTIC_CACHE_MAX_TURN) -> Optional[str]:
+    """Scope component for the turn index; None once replies depend too much on the conversation"""
+    if turn >= max_turn:
+        return None
+    return 'opening' if turn == 0 else 'early'
+
+
+class _Scope:
+    def __init__(self):
+        self.entries: List[Dict] = []
+        self.tables: List[Dict[int, List[int]]] = [{} for _ in range(LSH_TABLES)]
+        self.tick = 0
+
+    def candidates(self, keys: List[int]) -> List[int]:
+        found = set()
+        for table, key in zip(self.tables, keys):
+            found.update(table.get(key, ()))
+        return list(found)
+
+    def add(self, entry: Dict):
+        self.tick += 1
+        entry['used'] = self.tick
+        if len(self.entries) < SCOPE_MAX_ENTRIES:
+            slot = len(self.entries)
+            self.entries.append(entry)
+        else:
+            # Reuse the slot of the least recently matched message
+            slot = min(range(len(self.entries)), key=lambda i: self.entries[i]['used'])
+            for table, key in zip(self.tables, self.entries[slot]['keys']):
+                table[key].remove(slot)
+            self.entries[slot] = entry
+        for table, key in zip(self.tables, entry['keys']):
+            table.setdefault(key, []).append(slot)
+
+
+class SemanticCache:
+    """
+    lookup() returns (reply, ticket): a reply stored for a similar message, or
+    None and a ticket to pass to store() with the reply the LLM gave.
+    """
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, reuse: float = SEMANTIC_CACHE_REUSE,
+                 variants: int = SEMANTIC_CACHE_VARIANTS, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+                 embedder=None, seed: int = 0):
+        self.threshold = threshold
+        self.reuse = reuse
+        self.variants = variants
+        self.max_entries = max_entries
+        self.embedder = embedder
+        self._planes = None
+        self._seed = seed
+        self._scopes: 'OrderedDict[Tuple, _Scope]' = OrderedDict()
+        self._entries = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self.stats_counters = {'lookups': 0, 'hits': 0, 'misses': 0, 'refreshes': 0, 'stores': 0, 'evicted_scopes': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def _embed(self, text: str) -> Tuple:
+        # numpy is imported on the first lookup, not when the app starts
+        import numpy as np
+
+        if self.embedder is None:
+            # Built on first use so the optional model is only loaded by workers that need it
+            self.embedder = ModelEmbedder(SEMANTIC_CACHE_MODEL) if SEMANTIC_CACHE_MODEL else HashingEmbedder()
+        vector = self.embedder.embed(text)
+        if self._planes is None:
+            rng = np.random.RandomState(self._seed)
+            self._planes = rng.standard_normal((LSH_TABLES * LSH_BITS, len(vector))).astype(np.float32)
+        bits = (self._planes @ vector > 0).reshape(LSH_TABLES, LSH_BITS)
+        keys = (bits.astype(np.int64) << np.arange(LSH_BITS)).sum(axis=1)
+        return vector, keys.tolist()
+
+    def lookup(self, scope: Tuple, message: str, avoid: Iterable[str] = ()) -> Tuple[Optional[str], Dict]:
+        import numpy as np
+
+        vector, keys = self._embed(message)
+        ticket = {'scope': scope, 'vector': vector, 'keys': keys, 'entry': None}
+        with self._lock:
+            self.stats_counters['lookups'] += 1
+            index = self._scopes.get(scope)
+            best, best_similarity = None, self.threshold
+            if index is not None:
+                self._scopes.move_to_end(scope)
+                candidates = index.candidates(keys)
+                if candidates:
+                    similarities = np.stack([index.entries[i]['vector'] for i in candidates]) @ vector
+                    top = int(similarities.argmax())
+                    if similarities[top] >= best_similarity:
+                        best = index.entries[candidates[top]]
+            if best is None:
+                self.stats_counters['misses'] += 1
+                return None, ticket
+
+            index.tick += 1
+            best['used'] = index.tick
+            ticket['entry'] = best
+            avoid = set(avoid)
+            replies = [r for r in best['replies'] if r not in avoid]
+            if not replies or (len(best['replies']) < self.variants and self._rng.random() >= self.reuse):
+                self.stats_counters['refreshes'] += 1
+                return None, ticket
+            self.stats_counters['hits'] += 1
+            return self._rng.choice(replies), ticket
+
+    def store(self, ticket: Dict, reply: str):
+        with self._lock:
+            self.stats_counters['stores'] += 1
+            entry = ticket['entry']
+            if entry is not None:
+                # A refresh: the new reply becomes another variant of the matched message
+                if reply not in entry['replies']:
+                    if len(entry['replies']) >= self.variants:
+                        entry['replies'].pop(self._rng.randrange(len(entry['replies'])))
+                    entry['replies'].append(reply)
+                return
+            index = self._scopes.get(ticket['scope'])
+            if index is None:
+                index = self._scopes[ticket['scope']] = _Scope()
+            self._scopes.move_to_end(ticket['scope'])
+            before = len(index.entries)
+            index.add({'vector': ticket['vector'], 'keys': ticket['keys'], 'replies': [reply]})
+            self._entries += len(index.entries) - before
+            while self._entries > self.max_entries and len(self._scopes) > 1:
+                _, evicted = self._scopes.popitem(last=False)
+                self._entries -= len(evicted.entries)
+                self.stats_counters['evicted_scopes'] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counters = dict(self.stats_counters)
+            scopes, entries = len(self._scopes), self._entries
+        return dict(
+            counters,
+            enabled=self.enabled,
+            embedder=self.embedder.name if self.embedder is not None else None,
+            threshold=self.threshold,
+            reuse=self.reuse,
+            hit_rate=round(counters['hits'] / counters['lookups'], 3) if counters['lookups'] else None,
+            scopes=scopes,
+            entries=entries,
+            max_entries=self.max_entries,
+        )
@@ -0,0 +1,315 @@
+# shared_cache.py - Node-wide cache shared by every gunicorn worker
+#
+# Two tiers:
+#   L1  a small in-process LRU (per worker) in front of
+#   L2  a sqlite database in WAL mode on local disk, read and written by all
+#       workers on the node, so an entry computed by one worker is a hit for
+#       the others and capacity grows with the size limit, not the worker count
+# Entries carry a TTL. L2 is bounded by SHARED_CACHE_MAX_MB and evicts the
+# least recently used rows; last-access times are only written back every
+# ACCESS_RESOLUTION seconds so reads stay read-only in the common case.
+# get_or_compute() protects against stampedes: within a worker concurrent
+# misses for one key wait on a single computation, and across workers a lease
+# row makes the others poll L2 for the result instead of computing it again.
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+SHARED_CACHE_MAX_MB = float(os.getenv('SHARED_CACHE_MAX_MB', '256'))
+L1_MAX_ENTRIES = int(os.getenv('SHARED_CACHE_L1_ENTRIES', '2048'))
+# L1 never keeps an entry longer than this, so expiry/eviction in L2 is seen within it
+L1_MAX_TTL = 60.0
+ACCESS_RESOLUTION = 60.0
+# Check the L2 size limit every this many writes
+EVICT_EVERY = 100
+# How long other workers wait on a lease before computing themselves
+LEASE_SECONDS = 30.0
+LEASE_POLL = 0.05
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed);
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+_MISSING = object()
+
+
+def _os_thread_local():
+    """
+    A threading.local per OS thread. In a gevent worker (cooperative.py)
+    threading.local is per greenlet; the sqlite connection is shared by the
+    greenlets of a thread instead of opened for every request.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return monkey.get_original('threading', 'local')()
+    return threading.local()
+
+
+def cache_key(*parts) -> str:
+    """Stable key for JSON-serializable parts (model, messages, parameters...)"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class SharedCache:
+    def __init__(self, path: str, namespace: str = '', max_bytes: int = int(SHARED_CACHE_MAX_MB * 1024 * 1024),
+                 l1_entries: int = L1_MAX_ENTRIES):
+        self.path = path
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.l1_entries = l1_entries
+        self._l1: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._l1_lock = threading.Lock()
+        self._local = _os_thread_local()
+        self._inflight: Dict[str, threading.Event] = {}
+        self._inflight_lock = threading.Lock()
+        self._writes = 0
+        self.stats_counters = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0, 'computed': 0, 'waited': 0, 'evicted': 0}
+
+    # ---------------- CONNECTION ----------------
+    def _db(self) -> sqlite3.Connection:
+        # One connection per thread and per process: connections must not
+        # cross a fork (the app is imported in the gunicorn master). Greenlets
+        # of a gevent worker share their thread's connection: statements run
+        # to completion without yielding, so they never interleave
+        db = getattr(self._local, 'db', None)
+        if db is not None and self._local.pid == os.getpid():
+            return db
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(_SCHEMA)
+        self._local.db = db
+        self._local.pid = os.getpid()
+        return db
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}" if self.namespace else key
+
+    # ---------------- L1 ----------------
+    def _l1_get(self, key: str, now: float):
+        with self._l1_lock:
+            item = self._l1.get(key)
+            if item is None:
+                return _MISSING
+            value, expires = item
+            if expires <= now:
+                del self._l1[key]
+                return _MISSING
+            self._l1.move_to_end(key)
+            return value
+
+    def _l1_put(self, key: str, value, expires: float, now: float):
+        with self._l1_lock:
+            self._l1[key] = (value, min(expires, now + L1_MAX_TTL))
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_entries:
+                self._l1.popitem(last=False)
+
+    # ---------------- GET / SET ----------------
+    def get(self, key: str, default=None):
+        value = self._get(self._key(key))
+        return default if value is _MISSING else value
+
+    def _get(self, key: str):
+        now = time.time()
+        value = self._l1_get(key, now)
+        if value is not _MISSING:
+            self.stats_counters['l1_hits'] += 1
+            return value
+        try:
+            db = self._db()
+            row = db.execute('SELECT value, expires, accessed FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] <= now:
+                self.stats_counters['misses'] += 1
+                return _MISSING
+            if now - row[2] >= ACCESS_RESOLUTION:
+                db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        except sqlite3.Error as e:
+            # The cache is an optimization: a locked or broken database is a miss
+            print(f"[SharedCache] Read failed: {e}")
+            self.stats_counters['misses'] += 1
+            return _MISSING
+        value = json.loads(row[0])
+        self._l1_put(key, value, row[1], now)
+        self.stats_counters['l2_hits'] += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl: float):
+        self._set(self._key(key), value, ttl)
+
+    def _set(self, key: str, value: Any, ttl: float):
+        now = time.time()
+        expires = now + ttl
+        self._l1_put(key, value, expires, now)
+        encoded = json.dumps(value, separators=(',', ':'))
+        try:
+            self._db().execute(
+                'INSERT OR REPLACE INTO cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, encoded, len(encoded) + len(key), expires, now),
+            )
+        except sqlite3.Error as e:
+            print(f"[SharedCache] Write failed: {e}")
+            return
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def delete(self, key: str):
+        key = self._key(key)
+        with self._l1_lock:
+            self._l1.pop(key, None)
+        try:
+            self._db().execute('DELETE FROM cache WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            print(f"[SharedCache] Delete failed: {e}")
+
+    # ---------------- STAMPEDE PROTECTION ----------------
+    def get_or_compute(self, key: str, compute: Callable[[], Any], ttl: float):
+        """
+        Cached value for `key`, computing it with `compute()` on a miss. Only
+        one caller on the node computes a given key at a time; the others
+        wait for its result. Exceptions from compute() propagate and nothing
+        is cached.
+        """
+        key = self._key(key)
+        value = self._get(key)
+        if value is not _MISSING:
+            return value
+
+        # Single flight within this worker
+        with self._inflight_lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+        if not leader:
+            event.wait(LEASE_SECONDS)
+            value = self._get(key)
+            if value is not _MISSING:
+                self.stats_counters['waited'] += 1
+                return value
+            return compute()
+
+        try:
+            # Across workers: take the lease or wait for whoever holds it
+            if not self._acquire_lease(key):
+                value = self._wait_for(key)
+                if value is not _MISSING:
+                    self.stats_counters['waited'] += 1
+                    return value
+            try:
+                value = compute()
+                self.stats_counters['computed'] += 1
+                self._set(key, value, ttl)
+                return value
+            finally:
+                self._release_lease(key)
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def _owner(self) -> str:
+        return f"{os.getpid()}:{threading.get_ident()}"
+
+    def _acquire_lease(self, key: str) -> bool:
+        now = time.time()
+        try:
+            db = self._db()
+            db.execute('DELETE FROM leases WHERE key = ? AND expires <= ?', (key, now))
+            cursor = db.execute('INSERT OR IGNORE INTO leases (key, owner, expires) VALUES (?, ?, ?)',
+                                (key, self._owner(), now + LEASE_SECONDS))
+            return cursor.rowcount == 1
+        except sqlite3.Error:
+            return True
+
+    def _release_lease(self, key: str):
+        try:
+            self._db().execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, self._owner()))
+        except sqlite3.Error:
+            pass
+
+    def _wait_for(self, key: str):
+        deadline = time.time() + LEASE_SECONDS
+        while time.time() < deadline:
+            time.sleep(LEASE_POLL)
+            value = self._get(key)
+            if value is not _MISSING:
+                return value
+            try:
+                if self._db().execute('SELECT 1 FROM leases WHERE key = ?', (key,)).fetchone() is None:
+                    # The holder finished without caching (its compute failed)
+                    return _MISSING
+            except sqlite3.Error:
+                return _MISSING
+        return _MISSING
+
+    # ---------------- EVICTION ----------------
+    def evict(self) -> int:
+        """Drop expired rows, then least recently used rows until under max_bytes"""
+        now = time.time()
+        try:
+            db = self._db()
+            removed = db.execute('DELETE FROM cache WHERE expires <= ?', (now,)).rowcount
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+            if total > self.max_bytes:
+                # Trim to 90% so eviction doesn't run again on the next write
+                excess = total - int(self.max_bytes * 0.9)
+                freed = 0
+                stale = []
+                for key, size in db.execute('SELECT key, size FROM cache ORDER BY accessed'):
+                    stale.append((key,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                db.executemany('DELETE FROM cache WHERE key = ?', stale)
+                removed += len(stale)
+            db.execute('DELETE FROM leases WHERE expires <= ?', (now,))
+        except sqlite3.Error as e:
+            print(f"[SharedCache] Eviction failed: {e}")
+            return 0
+        self.stats_counters['evicted'] += removed
+        return removed
+
+    # ---------------- STATS ----------------
+    def stats(self) -> Dict:
+        counters = dict(self.stats_counters)
+        lookups = counters['l1_hits'] + counters['l2_hits'] + counters['misses']
+        entries = size = None
+        try:
+            prefix = f"{self.namespace}:" if self.namespace else ''
+            entries, size = self._db().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache WHERE key >= ? AND key < ?',
+                (prefix, prefix + '￿'),
+            ).fetchone()
+        except sqlite3.Error:
+            pass
+        return dict(
+            counters,
+            namespace=self.namespace,
+            hit_rate=round((counters['l1_hits'] + counters['l2_hits']) / lookups, 3) if lookups else None,
+            l1_entries=len(self._l1),
+            l2_entries=entries,
+            l2_bytes=size,
+            l2_max_bytes=self.max_bytes,
+        )
@@ -0,0 +1,85 @@
+# similarity.py - Condition-similarity index for hints and MCQ distractors
+#
+# Every condition is turned into a TF-IDF vector over the key terms of its
+# symptom phrases (the same lemmatized terms disclosure.py matches replies
+# with; primary symptoms weigh more than secondary ones). The cosine
+# similarity of all pairs is computed once as one NumPy matrix product and
+# only the top-k neighbours of each condition are kept, so a hint or an MCQ
+# looks its differentials up instead of scanning the dataset. The index is
+# tied to the dataset's source digest and rebuilt only when that changes.
+
+import random
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from disclosure import key_terms
+
+# Term weight of primary symptoms relative to secondary ones
+PRIMARY_WEIGHT = 2.0
+TOP_K = 10
+# Distractors are drawn from this many nearest neighbours, so the options
+# are plausible without always being the same ones
+DIFFERENTIAL_POOL = 5
+
+
+class ConditionIndex:
+    def __init__(self, dataset, top_k: int = TOP_K):
+        # Imported here: the index is built on the first hint or MCQ, not at startup
+        import numpy as np
+
+        self.source_digest = dataset.source_digest
+        names = list(dataset.disease_names)
+        self.top_k = min(top_k, max(len(names) - 1, 0))
+
+        vocabulary: Dict[str, int] = {}
+        rows = []
+        for name in names:
+            primary, secondary = dataset.symptoms(name)
+            weights: Dict[int, float] = {}
+            for symptoms, weight in ((primary, PRIMARY_WEIGHT), (secondary, 1.0)):
+                for symptom in symptoms:
+                    for term in key_terms(symptom):
+                        column = vocabulary.setdefault(term, len(vocabulary))
+                        weights[column] = weights.get(column, 0.0) + weight
+            rows.append(weights)
+
+        tf = np.zeros((len(names), len(vocabulary)), dtype=np.float32)
+        for i, weights in enumerate(rows):
+            if weights:
+                tf[i, list(weights)] = list(weights.values())
+        # Smoothed IDF: terms shared by every condition ("temperature") count least
+        df = np.count_nonzero(tf, axis=0)
+        idf = np.log((1 + len(names)) / (1 + df)) + 1
+        vectors = tf * idf
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+
+        similarity = vectors @ vectors.T
+        np.fill_diagonal(similarity, -1.0)
+        order = np.argsort(-similarity, axis=1, kind='stable')[:, :self.top_k]
+        self._neighbours: Dict[str, Tuple[Tuple[str, float], ...]] = {
+            name: tuple((names[j], round(float(similarity[i, j]), 4)) for j in order[i])
+            for i, name in enumerate(names)
+        }
+        self._dataset = dataset
+
+    def neighbours(self, condition: str, k: Optional[int] = None) -> List[Tuple[str, float]]:
+        """Most similar conditions with their cosine similarity, closest first"""
+        return list(self._neighbours.get(condition, ())[:k])
+
+    def differentials(self, condition: str, n: int, pool: int = DIFFERENTIAL_POOL) -> List[str]:
+        """`n` conditions picked from the `pool` nearest neighbours (at least n)"""
+        candidates = [name for name, _ in self.neighbours(condition, max(n, pool))]
+        return random.sample(candidates, min(n, len(candidates)))
+
+    def symptom_distractors(self, condition: str, exclude: Sequence[str], n: int) -> List[str]:
+        """
+        Primary symptoms of the nearest conditions that `condition` does not
+        share: wrong answers that still sound like the right kind of illness
+        """
+        excluded = set(exclude)
+        candidates = []
+        for name, _ in self.neighbours(condition, DIFFERENTIAL_POOL):
+            for symptom in self._dataset.primary_symptoms(name):
+                if symptom not in excluded and symptom not in candidates:
+                    candidates.append(symptom)
+        return random.sample(candidates, min(n, len(candidates)))
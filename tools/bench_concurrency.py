@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from mock_llm import DOCTOR_QUESTIONS, MockLLMClient
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Directories the app writes to; everything else is linked into the server's work dir
+WRITABLE_DIRS = {"logs", "feedback_logs", "usage_logs", "cache", "profiles", "replay_results", "bench_results", "__pycache__"}
+# A session starts a new patient every this many turns (keeps the session cookie realistic)
+TURNS_PER_PATIENT = 8
+DEFAULT_LEVELS = [8, 16, 32, 64, 128, 256, 512]
+DEFAULT_MAX_SLOWDOWN = 1.5
+
+
+def _percentile(values: List[float], q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))], 3)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ---------------- STUB UPSTREAM ----------------
+def _sse(payload) -> bytes:
+    data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode("utf-8")
+    return f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n"
+
+
+async def _serve_completion(reader, writer, latency: float, client: MockLLMClient):
+    """OpenAI-compatible /v1/chat/completions that answers after `latency` seconds (keep-alive, streamed or not)"""
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.decode("latin-1").split("\r\n")[1:]:
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            body = json.loads(await reader.readexactly(length)) if length else {}
+            await asyncio.sleep(latency)
+            messages = body.get("messages") or []
+            content = client.reply(messages)
+            usage = {"prompt_tokens": sum(len(m["content"]) for m in messages) // 4, "completion_tokens": len(content) // 4}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": body.get("model", "bench")}
+            if body.get("stream"):
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+                words = content.split(" ")
+                for i, word in enumerate(words):
+                    delta = {"content": word if i == 0 else " " + word}
+                    writer.write(_sse(dict(base, object="chat.completion.chunk", choices=[{"index": 0, "delta": delta, "finish_reason": None}])))
+                writer.write(_sse(dict(base, object="chat.completion.chunk", choices=[], usage=usage)))
+                writer.write(_sse("[DONE]") + b"0\r\n\r\n")
+            else:
+                data = json.dumps(dict(base, object="chat.completion", usage=usage, choices=[
+                    {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                ])).encode("utf-8")
+                writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode("ascii") + data)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_upstream(port: int, latency: float):
+    """Stub LLM provider (runs in its own process): every request waits `latency` seconds"""
+    client = MockLLMClient()
+
+    async def main():
+        server = await asyncio.start_server(lambda r, w: _serve_completion(r, w, latency, client), "127.0.0.1", port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+# ---------------- APP SERVER ----------------
+def _work_dir() -> str:
+    """The repository linked into a temporary directory, with empty log and cache directories"""
+    work_dir = tempfile.mkdtemp(prefix="bench_concurrency_")
+    for name in os.listdir(ROOT_DIR):
+        if name not in WRITABLE_DIRS and not name.startswith("."):
+            os.symlink(os.path.join(ROOT_DIR, name), os.path.join(work_dir, name))
+    return work_dir
+
+
+class AppServer:
+    """One gunicorn worker (gunicorn.conf.py, LLM_BACKEND=local pointed at the stub) pinned to `cpus`"""
+
+    def __init__(self, worker_class: str, threads: int, upstream_url: str, timeout: float, cpus: Optional[set]):
+        self.worker_class = worker_class
+        self.port = _free_port()
+        self.work_dir = _work_dir()
+        env = dict(
+            os.environ,
+            PORT=str(self.port), WEB_CONCURRENCY="1", GUNICORN_WORKER_CLASS=worker_class, GUNICORN_THREADS=str(threads),
+            LLM_BACKEND="local", LOCAL_LLM_URL=upstream_url, LOCAL_LLM_TIMEOUT=str(timeout),
+            # Measure the server, not the caches or the provider quota
+            LLM_CACHE_TTL="0", SEMANTIC_CACHE_THRESHOLD="0",
+            LLM_MAX_CONCURRENCY="100000", LLM_MAX_QUEUE="100000", LLM_MAX_WAIT=str(timeout),
+            LLM_RATE_PER_MINUTE="1e9", LLM_RATE_BURST="1e9",
+            SHARED_CACHE_PATH=os.path.join(self.work_dir, "cache", "shared_cache.sqlite3"),
+        )
+        self.log_path = os.path.join(self.work_dir, "gunicorn.log")
+        self._log = open(self.log_path, "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "app:app", "-c", "gunicorn.conf.py", "--chdir", self.work_dir],
+            cwd=self.work_dir, env=env, stdout=self._log, stderr=subprocess.STDOUT,
+            preexec_fn=(lambda: os.sched_setaffinity(0, cpus)) if cpus else None,
+        )
+
+    def wait_ready(self, timeout: float = 120.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=1) as s:
+                    s.sendall(b"GET /admission_stats HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n")
+                    if s.recv(64).startswith(b"HTTP/1.1 200"):
+                        return
+            except OSError:
+                pass
+            time.sleep(0.5)
+        with open(self.log_path, "r", encoding="utf-8", errors="replace") as f:
+            log = f.read()[-2000:]
+        raise RuntimeError(f"gunicorn ({self.worker_class}) did not start:\n{log}")
+
+    def worker_cpu_seconds(self) -> float:
+        """User + system CPU time of the worker processes (children of the master)"""
+        ticks = os.sysconf("SC_CLK_TCK")
+        try:
+            with open(f"/proc/{self.process.pid}/task/{self.process.pid}/children") as f:
+                children = f.read().split()
+        except OSError:
+            return 0.0
+        total = 0.0
+        for pid in children:
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                total += (int(fields[11]) + int(fields[12])) / ticks
+            except (OSError, IndexError, ValueError):
+                pass
+        return total
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self._log.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+# ---------------- LOAD ----------------
+async def _request(port: int, method: str, path: str, body: Optional[Dict], cookie: Optional[str]):
+    """One HTTP/1.1 request on its own connection; returns (status, session cookie)"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        head = f"{method} {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\nContent-Length: {len(data)}\r\n"
+        if body is not None:
+            head += "Content-Type: application/json\r\n"
+        if cookie:
+            head += f"Cookie: session={cookie}\r\n"
+        writer.write(head.encode("latin-1") + b"\r\n" + data)
+        await writer.drain()
+        raw = await reader.read()
+    finally:
+        writer.close()
+    lines = raw.partition(b"\r\n\r\n")[0].decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1]) if lines and len(lines[0].split()) > 1 else 0
+    for line in lines[1:]:
+        if line.lower().startswith("set-cookie: session="):
+            cookie = line.split("=", 1)[1].split(";", 1)[0]
+    return status, cookie
+
+
+async def _session(port: int, index: int, start: float, measure_from: float, stop_at: float,
+                   think: float, timeout: float, samples: List[Dict]):
+    """Closed loop: a new patient every TURNS_PER_PATIENT turns, the next question as soon as the reply arrives"""
+    await asyncio.sleep(max(0.0, start - time.perf_counter()))
+    cookie, turn = None, 0
+    while time.perf_counter() < stop_at:
+        started = time.perf_counter()
+        try:
+            if turn % TURNS_PER_PATIENT == 0:
+                status, cookie = await asyncio.wait_for(_request(port, "GET", "/generate_patient", None, None), timeout)
+                if status != 200:
+                    raise RuntimeError(f"/generate_patient returned {status}")
+                started = time.perf_counter()
+            message = DOCTOR_QUESTIONS[(index + turn) % len(DOCTOR_QUESTIONS)]
+            status, cookie = await asyncio.wait_for(_request(port, "POST", "/send_message", {"message": message}, cookie), timeout)
+        except (asyncio.TimeoutError, OSError, RuntimeError, ValueError):
+            status = 0
+        if started >= measure_from:
+            samples.append({"latency": time.perf_counter() - started, "status": status})
+        turn += 1
+        if think:
+            await asyncio.sleep(think)
+
+
+def run_level(server: AppServer, sessions: int, llm_latency: float, duration: float, think: float, timeout: float) -> Dict:
+    """`sessions` concurrent conversations for `duration` seconds after ramp-up; latency, throughput and worker CPU"""
+    samples: List[Dict] = []
+
+    async def main():
+        t0 = time.perf_counter()
+        # Stagger the first turns over one LLM latency, then let the load settle for another
+        measure_from = t0 + 2 * llm_latency
+        stop_at = measure_from + duration
+        tasks = [
+            asyncio.ensure_future(_session(server.port, i, t0 + llm_latency * i / sessions, measure_from, stop_at, think, timeout, samples))
+            for i in range(sessions)
+        ]
+        await asyncio.sleep(max(0.0, measure_from - time.perf_counter()))
+        cpu_start, wall_start = server.worker_cpu_seconds(), time.perf_counter()
+        await asyncio.sleep(max(0.0, stop_at - time.perf_counter()))
+        cpu, wall = server.worker_cpu_seconds() - cpu_start, time.perf_counter() - wall_start
+        await asyncio.gather(*tasks)
+        return cpu, wall
+
+    cpu, wall = asyncio.run(main())
+    ok = [s["latency"] for s in samples if s["status"] == 200]
+    return {
+        "sessions": sessions,
+        "turns": len(ok),
+        "errors": len(samples) - len(ok),
+        "turns_per_second": round(len(ok) / wall, 2) if wall else None,
+        "latency_p50": _percentile(ok, 50),
+        "latency_p95": _percentile(ok, 95),
+        "worker_cpu": round(cpu / wall, 3) if wall else None,
+        "cpu_ms_per_turn": round(cpu * 1000 / len(ok), 2) if ok else None,
+    }
+
+
+def held(row: Dict, llm_latency: float, max_slowdown: float) -> bool:
+    """Every conversation got its replies, within max_slowdown of the LLM's own latency"""
+    return bool(row["turns"]) and not row["errors"] and row["latency_p95"] <= llm_latency * max_slowdown
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent conversations one gunicorn worker (one core) holds with gthread vs gevent workers, against a stub LLM with a fixed latency")
+    parser.add_argument("--worker_classes", nargs="+", default=["gthread", "gevent"], choices=["gthread", "gevent"])
+    parser.add_argument("--levels", nargs="+", type=int, default=DEFAULT_LEVELS, help="Concurrent conversations to try, ascending")
+    parser.add_argument("--llm_latency", type=float, default=3.0, help="Seconds the stub LLM takes per call")
+    parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds per level (after ramp-up)")
+    parser.add_argument("--think", type=float, default=0.0, help="Seconds between a reply and the next question")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("GUNICORN_THREADS", "8")), help="GUNICORN_THREADS for gthread")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Client timeout per request")
+    parser.add_argument("--max_slowdown", type=float, default=DEFAULT_MAX_SLOWDOWN, help="A level is held when p95 latency is within this factor of --llm_latency, with no errors")
+    parser.add_argument("--cpu", type=int, default=None, help="CPU to pin the server to (default: the last one; the load generator uses the others)")
+    parser.add_argument("--keep_going", action="store_true", help="Try every level even after one is not held")
+    parser.add_argument("--output_dir", default=os.path.join(ROOT_DIR, "bench_results"))
+    args = parser.parse_args()
+
+    available = sorted(os.sched_getaffinity(0))
+    server_cpus = None
+    if args.cpu is not None or len(available) > 1:
+        server_cpus = {args.cpu if args.cpu is not None else available[-1]}
+        if set(available) - server_cpus:
+            os.sched_setaffinity(0, set(available) - server_cpus)
+    else:
+        print("[Bench] Only one CPU: the load generator and the stub LLM share it with the server, so results are a lower bound")
+
+    upstream_port = _free_port()
+    # The stub inherits this process's affinity: off the server's core
+    upstream = multiprocessing.Process(target=run_upstream, args=(upstream_port, args.llm_latency), daemon=True)
+    upstream.start()
+
+    results = {}
+    try:
+        for worker_class in args.worker_classes:
+            server = AppServer(worker_class, args.threads, f"http://127.0.0.1:{upstream_port}/v1", args.timeout, server_cpus)
+            try:
+                server.wait_ready()
+                rows = []
+                for sessions in args.levels:
+                    row = run_level(server, sessions, args.llm_latency, args.duration, args.think, args.timeout)
+                    row["held"] = held(row, args.llm_latency, args.max_slowdown)
+                    rows.append(row)
+                    print(f"[Bench] {worker_class:8s} {sessions:5d} sessions: {row['turns_per_second']} turns/s, "
+                          f"p50 {row['latency_p50']}s, p95 {row['latency_p95']}s, {row['errors']} errors, "
+                          f"worker CPU {row['worker_cpu']}, {row['cpu_ms_per_turn']} ms/turn{'' if row['held'] else '  (not held)'}")
+                    if not row["held"] and not args.keep_going:
+                        break
+                results[worker_class] = rows
+            finally:
+                server.stop()
+    finally:
+        upstream.terminate()
+
+    summary = {}
+    for worker_class, rows in results.items():
+        held_rows = [r for r in rows if r["held"]]
+        cpu_ms = [r["cpu_ms_per_turn"] for r in rows if r["cpu_ms_per_turn"]]
+        summary[worker_class] = {
+            # Conversations waiting on the LLM at once that the pinned worker kept up with
+            "sessions_per_core": max((r["sessions"] for r in held_rows), default=0),
+            # Ceiling from the worker's CPU cost per turn: a core is busy when (turns/s x CPU per turn) reaches 1
+            "cpu_bound_sessions_per_core": int(args.llm_latency * 1000 / min(cpu_ms)) if cpu_ms else None,
+        }
+    print()
+    print(f"{'worker':10s}{'sessions/core':>16s}{'CPU-bound limit':>18s}")
+    for worker_class, row in summary.items():
+        print(f"{worker_class:10s}{row['sessions_per_core']:>16d}{str(row['cpu_bound_sessions_per_core']):>18s}")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report_path = os.path.join(args.output_dir, f"bench_concurrency_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "created": datetime.now().isoformat(), "llm_latency": args.llm_latency, "duration": args.duration,
+            "think": args.think, "threads": args.threads, "max_slowdown": args.max_slowdown,
+            "server_cpus": sorted(server_cpus) if server_cpus else available, "results": results, "summary": summary,
+        }, f, indent=2)
+    print(f"Report: {report_path}")
@@ -0,0 +1,24 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from assets import AssetPipeline
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fingerprint and precompress the avatar page assets into static/dist")
+    parser.add_argument("--static_dir", default=os.path.join(ROOT_DIR, "static"))
+    args = parser.parse_args()
+
+    pipeline = AssetPipeline(os.path.abspath(args.static_dir))
+    manifest = pipeline.build()
+    for logical_path, asset in sorted(manifest["assets"].items()):
+        variants = []
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if encoding in asset["encodings"]:
+                variants.append(f"{encoding} {os.path.getsize(os.path.join(pipeline.dist_dir, asset['path'] + suffix))}B")
+        print(f"{logical_path} -> {asset['path']} ({asset['size']}B; {', '.join(variants)})")
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from end_detector import ConversationEndDetector
+from log_store import LogStore
+
+
+# The list-scan implementation that check_if_should_end_chat used before the
+# compiled detector, kept here as the reference for the equivalence check.
+_LEGACY_LITERALS = [
+    'thank you doctor', 'thank you doc', 'thanks doctor', 'thanks doc',
+    'thankyou doctor', 'thankyou doc', 'thankyou doctor for helping me',
+    'thanks doc, you have been a great help', 'thank you for the diagnosis',
+    'thanks for the diagnosis', 'thank you for helping', 'thanks for helping',
+    'thank you for your help', 'thanks for your help', 'thank you so much',
+    'thanks so much',
+    'thankyou doctor', 'thankyou doc', 'thank you, doctor', 'thank you, doc',
+    'thanks, doctor', 'thanks, doc', 'thankyou, doctor', 'thankyou, doc',
+    'goodbye doctor', 'bye doctor', 'see you later', 'have a good day', 'take care',
+]
+_LEGACY_REGEXES = [
+    r'thank\s*you\s*,?\s*doctor', r'thanks\s*,?\s*doc', r'thank\s*you\s*,?\s*doc',
+    r'thanks\s*,?\s*doctor', r'thankyou\s*,?\s*doctor', r'thankyou\s*,?\s*doc',
+]
+
+# Hand-written phrasings that the logs may not cover yet
+_EXTRA_PHRASES = [
+    "Thank you, Doctor. I feel much better knowing what it is.",
+    "Thanks doc, you have been a great help",
+    "Thankyou doctor for helping me",
+    "Oh thank you so much, I was so worried.",
+    "Well, goodbye doctor and thanks again.",
+    "Take care of yourself too.",
+    "Thanks for the diagnosis!",
+    "THANKS,DOC",
+    "I'm thankful, but what should I do next?",
+    "The docks near my house flood every spring.",
+    "",
+]
+
+
+def legacy_should_end(text):
+    lower = text.lower()
+    if any(p in lower for p in _LEGACY_LITERALS):
+        return True
+    return any(re.search(p, lower, re.IGNORECASE) for p in _LEGACY_REGEXES)
+
+
+def _tokens(text):
+    # Split the way a streaming API would deliver a reply: short word pieces
+    return re.findall(r"\s*\S{1,4}", text) or [text]
+
+
+def iter_phrasings(logs_dir):
+    # Through the LogStore, so compressed (rotated) days are read too
+    store = LogStore(logs_dir, "conversations_")
+    for day in sorted(store.days(), key=lambda e: e["day"]):
+        data = b"".join(store.read_range(day, 0, day["raw_size"]))
+        for line in data.decode("utf-8").splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            yield day["name"], entry.get("patient_response") or ""
+    for phrase in _EXTRA_PHRASES:
+        yield "<extra>", phrase
+
+
+def check(logs_dir):
+    detector = ConversationEndDetector()
+    checked = 0
+    fired = 0
+    mismatches = []
+    for source, text in iter_phrasings(logs_dir):
+        checked += 1
+        expected = legacy_should_end(text)
+        rule = detector.detect(text)
+
+        stream = detector.stream()
+        early_at = None
+        for i, token in enumerate(_tokens(text)):
+            if stream.feed(token) and early_at is None:
+                early_at = i
+        streamed = stream.finish()
+
+        if expected != (rule is not None) or streamed != rule:
+            mismatches.append((source, text[:120], expected, rule, streamed))
+        if rule:
+            fired += 1
+
+    print(f"Checked {checked} replies, {fired} flagged as conversation end, {len(mismatches)} mismatches")
+    for source, text, expected, rule, streamed in mismatches:
+        print(f"  {os.path.basename(source)}: legacy={expected} detect={rule} stream={streamed} :: {text!r}")
+    return not mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the compiled end detector against the legacy list scans on logged replies")
+    parser.add_argument("--logs_dir", default=os.path.join(os.path.dirname(__file__), "..", "logs"))
+    args = parser.parse_args()
+    sys.exit(0 if check(os.path.abspath(args.logs_dir)) else 1)
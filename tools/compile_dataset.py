@@ -0,0 +1,27 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dataset_store import CompiledDataset, DatasetStore
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the symptom dataset and personas into the binary artifact served by the app")
+    parser.add_argument("--symptoms", nargs="+", default=[
+        os.path.join(ROOT_DIR, "disease_to_symptom_sentences_prioritized.json"),
+        os.path.join(ROOT_DIR, "disease_to_symptom_sentences_exact.json"),
+    ], help="Candidate symptom datasets, first existing one wins")
+    parser.add_argument("--personas", default=os.path.join(ROOT_DIR, "personas.json"))
+    parser.add_argument("--out", default=os.path.join(ROOT_DIR, "data", "patient_dataset.bin"))
+    args = parser.parse_args()
+
+    store = DatasetStore(os.path.abspath(args.out), [os.path.abspath(p) for p in args.symptoms], os.path.abspath(args.personas))
+    data = store.build()
+    dataset = CompiledDataset(data)
+    # Running workers pick up the new file within DATASET_CHECK_INTERVAL seconds
+    print(f"Compiled {len(dataset.disease_names)} diseases and {len(dataset.personas)} personas "
+          f"({len(data)} bytes, {'prioritized' if dataset.prioritized else 'exact'} symptoms) to {store.artifact_path}")
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from judge import LLMJudge, VerdictStore, conversation_hash
+from log_store import LogStore
+from prompts_and_evaluator import PatientSimulationEvaluator
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def load_scripts(logs_dir: str, conditions, persona_ids, min_turns: int, max_turns: int, limit: int) -> List[Dict]:
+    """
+    Doctor scripts from historical conversations: the doctor's messages in
+    order, with the condition and persona the conversation was run with.
+    Only conversations whose condition and persona still exist are used.
+    """
+    store = LogStore(logs_dir, "conversations_")
+    conversations = defaultdict(list)
+    for entry in store.days():
+        for line in b"".join(store.read_range(entry, 0, entry["raw_size"])).splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            conversations[record.get("conversation_id")].append(record)
+
+    scripts = []
+    for conversation_id, records in conversations.items():
+        first = records[0]
+        if first.get("condition") not in conditions or first.get("personality_type") not in persona_ids:
+            continue
+        records.sort(key=lambda r: r.get("timestamp", ""))
+        doctor_messages = [r["doctor_message"] for r in records if r.get("doctor_message", "").strip()]
+        if len(doctor_messages) < min_turns:
+            continue
+        scripts.append({
+            "conversation_id": conversation_id,
+            "condition": first["condition"],
+            "personality_type": first["personality_type"],
+            "doctor_messages": doctor_messages[:max_turns],
+        })
+    # Longest conversations first: they exercise diagnosis and closing turns
+    scripts.sort(key=lambda s: (-len(s["doctor_messages"]), s["conversation_id"]))
+    return scripts[:limit]
+
+
+class TimingHandler:
+    """Stream handler for get_patient_response that times the first token and counts chunks"""
+
+    def __init__(self):
+        self.started = None
+        self.first_token = None
+        self.chunks = 0
+
+    def start(self):
+        # Called again on every retry, so only the successful attempt is measured
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.chunks = 0
+
+    def feed(self, delta: str):
+        if self.first_token is None:
+            self.first_token = time.perf_counter() - self.started
+        self.chunks += 1
+
+
+def run_script(app_module, model: str, script: Dict, evaluator: PatientSimulationEvaluator) -> Dict:
+    """Replay one doctor script against one model (blocking, runs on a worker thread)"""
+    simulator = app_module.simulator
+    persona = next(p for p in simulator.dataset.personas if p["id"] == script["personality_type"])
+    patient_data = simulator.build_patient(script["condition"], persona)
+    history, turns = [], []
+    for doctor_message in script["doctor_messages"]:
+        handler = TimingHandler()
+        started = time.perf_counter()
+        reply, is_error = app_module.get_patient_response(
+            patient_data, history, doctor_message, model_name=model,
+            stream_handler=handler, prompt_template=patient_data["prompt_template"],
+        )
+        latency = time.perf_counter() - started
+        turns.append({
+            "latency": latency,
+            "ttft": handler.first_token,
+            # OpenRouter streams roughly one token per chunk
+            "tokens": handler.chunks,
+            "generation_seconds": latency - handler.first_token if handler.first_token is not None else None,
+            "is_error": is_error,
+        })
+        if is_error:
+            break
+        history.append({"doctor": doctor_message, "patient": reply})
+
+    result = {
+        "conversation_id": script["conversation_id"],
+        "condition": script["condition"],
+        "personality_type": script["personality_type"],
+        "turns": turns,
+        "transcript": history,
+        "failed": any(t["is_error"] for t in turns),
+    }
+    if history and not result["failed"]:
+        evaluation = evaluator.evaluate_conversation({"messages": history}, persona)
+        result["quality"] = {
+            "overall_score": evaluation["overall_score"],
+            **evaluation["criterion_scores"],
+        }
+    return result
+
+
+async def evaluate_models(app_module, models: List[str], scripts: List[Dict], concurrency: int) -> Dict[str, List[Dict]]:
+    """Run every script against every model at once, at most `concurrency` conversations per model"""
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=len(models) * concurrency))
+    limits = {model: asyncio.Semaphore(concurrency) for model in models}
+    evaluator = PatientSimulationEvaluator()
+    total = len(models) * len(scripts)
+    done = 0
+
+    async def replay(model, script):
+        nonlocal done
+        async with limits[model]:
+            result = await asyncio.to_thread(run_script, app_module, model, script, evaluator)
+        done += 1
+        status = "failed" if result["failed"] else f"{len(result['turns'])} turns"
+        print(f"[{done}/{total}] {model} {script['condition']}: {status}")
+        return model, result
+
+    results = defaultdict(list)
+    for model, result in await asyncio.gather(*(replay(m, s) for m in models for s in scripts)):
+        results[model].append(result)
+    return results
+
+
+def _percentile(values: List[float], q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else None
+
+
+def summarize(runs: List[Dict]) -> Dict:
+    turns = [t for run in runs for t in run["turns"]]
+    ok = [t for t in turns if not t["is_error"]]
+    latencies = [t["latency"] for t in ok]
+    ttfts = [t["ttft"] for t in ok if t["ttft"] is not None]
+    generated = [t for t in ok if t["generation_seconds"]]
+    quality = [run["quality"] for run in runs if "quality" in run]
+    judged = [run["judge"]["overall"] for run in runs if run.get("judge")]
+    return {
+        "conversations": len(runs),
+        "failed_conversations": sum(1 for run in runs if run["failed"]),
+        "turns": len(turns),
+        "error_rate": round(1 - len(ok) / len(turns), 3) if turns else None,
+        "latency_p50": _percentile(latencies, 50),
+        "latency_p90": _percentile(latencies, 90),
+        "latency_p99": _percentile(latencies, 99),
+        "ttft_p50": _percentile(ttfts, 50),
+        "tokens_per_sec": (sum(t["tokens"] for t in generated) / sum(t["generation_seconds"] for t in generated)) if generated else None,
+        "overall_score": _mean([q["overall_score"] for q in quality]),
+        "realism": _mean([q["realism"] for q in quality]),
+        "engagement": _mean([q["engagement"] for q in quality]),
+        "judge_score": _mean(judged),
+    }
+
+
+def print_table(summaries: Dict[str, Dict]):
+    columns = [
+        ("model", 46), ("error_rate", 10), ("latency_p50", 11), ("latency_p90", 11), ("latency_p99", 11),
+        ("ttft_p50", 9), ("tokens_per_sec", 14), ("overall_score", 13), ("realism", 8), ("engagement", 10),
+        ("judge_score", 11),
+    ]
+    print("  ".join(name.rjust(width) if i else name.ljust(width) for i, (name, width) in enumerate(columns)))
+    ranked = sorted(summaries.items(), key=lambda kv: -(kv[1]["overall_score"] or 0))
+    for model, summary in ranked:
+        cells = [model.ljust(columns[0][1])]
+        for name, width in columns[1:]:
+            value = summary[name]
+            cells.append(("-" if value is None else f"{value:.2f}").rjust(width))
+        print("  ".join(cells))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay historical doctor scripts against every evaluation model and compare latency, throughput and quality")
+    parser.add_argument("--logs_dir", default=os.path.join(ROOT_DIR, "logs"))
+    parser.add_argument("--output_dir", default=os.path.join(ROOT_DIR, "eval_results"))
+    parser.add_argument("--models", nargs="+", help="Models to compare (default: MODEL_NAMES in app.py)")
+    parser.add_argument("--scripts", type=int, default=10, help="Number of doctor scripts to replay per model")
+    parser.add_argument("--min_turns", type=int, default=3)
+    parser.add_argument("--max_turns", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=2, help="Concurrent conversations per model")
+    parser.add_argument("--judge_model", default=None, help="Also score the transcripts with this judge model (see judge.py)")
+    parser.add_argument("--judge_batch_size", type=int, default=8)
+    args = parser.parse_args()
+
+    import app as app_module
+
+    # Every call must reach the model: cached replies (exact or paraphrase
+    # matches) would skew latency and quality
+    app_module.LLM_CACHE_TTL = 0
+    app_module.semantic_cache.threshold = 0
+    if app_module.llm_backend.name == "openrouter" and not os.getenv("OPENROUTER_API_KEY"):
+        parser.error("OPENROUTER_API_KEY is not set (or choose another LLM_BACKEND)")
+    dataset = app_module.simulator.dataset
+    if dataset is None:
+        parser.error("Patient dataset could not be loaded")
+
+    models = args.models or app_module.MODEL_NAMES
+    scripts = load_scripts(
+        os.path.abspath(args.logs_dir), set(dataset.disease_names), {p["id"] for p in dataset.personas},
+        args.min_turns, args.max_turns, args.scripts,
+    )
+    if not scripts:
+        parser.error(f"No conversations with at least {args.min_turns} turns for a known condition in {args.logs_dir}")
+    print(f"Replaying {len(scripts)} scripts ({sum(len(s['doctor_messages']) for s in scripts)} turns) against {len(models)} models")
+
+    started = time.perf_counter()
+    results = asyncio.run(evaluate_models(app_module, models, scripts, args.concurrency))
+    elapsed = time.perf_counter() - started
+    if args.judge_model:
+        # Verdicts are cached with the judge tool's, so reruns only judge new transcripts
+        judge = LLMJudge(
+            app_module.get_client, args.judge_model,
+            VerdictStore(os.path.join(args.output_dir, "judge_verdicts.jsonl")),
+            batch_size=args.judge_batch_size, concurrency=args.concurrency,
+        )
+        transcripts = [
+            (run, {"condition": run["condition"], "personality_type": run["personality_type"], "turns": run["transcript"]})
+            for model in models for run in results[model]
+            if run["transcript"] and not run["failed"]
+        ]
+        verdicts = judge.judge([transcript for _, transcript in transcripts])
+        for run, transcript in transcripts:
+            run["judge"] = verdicts.get(conversation_hash(transcript))
+        print(f"Judged {judge.stats['judged']} transcripts ({judge.stats['cached']} cached, {judge.stats['failed']} failed) with {args.judge_model}")
+    summaries = {model: summarize(results[model]) for model in models}
+    # Token counts and cost come from the app's usage accounting of the same calls
+    usage = app_module.usage_accountant.stats()["models"]
+    for model in models:
+        model_usage = usage.get(model, {})
+        summaries[model]["prompt_tokens"] = model_usage.get("prompt_tokens", 0)
+        summaries[model]["completion_tokens"] = model_usage.get("completion_tokens", 0)
+        summaries[model]["cost"] = model_usage.get("cost", 0.0)
+
+    print(f"\nFinished in {elapsed:.0f}s\n")
+    print_table(summaries)
+    print("\n" + "\n".join(
+        f"{model}: {s['prompt_tokens']} prompt + {s['completion_tokens']} completion tokens, ${s['cost']:.4f}"
+        for model, s in summaries.items()
+    ))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    out_path = os.path.join(args.output_dir, f"eval_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "created": datetime.now().isoformat(),
+            "elapsed_seconds": round(elapsed, 1),
+            "scripts": scripts,
+            "summary": summaries,
+            "runs": results,
+        }, f, indent=2)
+    print(f"\nFull report: {out_path}")
@@ -0,0 +1,38 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from analytics import LogQuery, conversation_exporter, feedback_exporter
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export conversation and feedback logs to partitioned Parquet datasets (only new or grown days)")
+    parser.add_argument("--logs_dir", default=os.path.join(ROOT_DIR, "logs"))
+    parser.add_argument("--feedback_dir", default=os.path.join(ROOT_DIR, "feedback_logs"))
+    parser.add_argument("--output_dir", default=os.path.join(ROOT_DIR, "analytics"))
+    parser.add_argument("--full", action="store_true", help="Re-export every day instead of only the changed ones")
+    parser.add_argument("--summary", action="store_true", help="Print the standard aggregates after exporting")
+    args = parser.parse_args()
+
+    output_dir = os.path.abspath(args.output_dir)
+    for exporter in (
+        conversation_exporter(os.path.abspath(args.logs_dir), output_dir),
+        feedback_exporter(os.path.abspath(args.feedback_dir), output_dir),
+    ):
+        exported = exporter.export(full=args.full)
+        print(f"{exporter.output_dir}: exported {len(exported)} day(s), {sum(exported.values())} rows")
+
+    if args.summary:
+        query = LogQuery(output_dir)
+        print("\nDiagnosis rate by condition:")
+        print(query.diagnosis_rate().to_string(index=False))
+        print("\nSymptom coverage by condition:")
+        print(query.symptom_coverage().to_string(index=False))
+        print("\nLatency by model (ms):")
+        print(query.latency().to_string(index=False))
+        print("\nFeedback by condition:")
+        print(query.feedback_summary().to_string(index=False))
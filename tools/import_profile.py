@@ -0,0 +1,82 @@
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Startup regression budget for `import app`. The total includes loading the
+# symptom dataset and personas, which happens at import time.
+DEFAULT_BUDGET_MS = 600
+
+# Modules that must stay deferred until first use; importing app.py should
+# never pull these in.
+DEFERRED_MODULES = ["pandas", "numpy", "openai", "requests", "nltk"]
+
+
+def run_importtime(module: str) -> List[Dict]:
+    """Import a module in a fresh interpreter with -X importtime and parse the report"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr[-2000:]}")
+
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        except ValueError:
+            continue
+        name = name[1:]  # drop the separator space, keep the nesting indent
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        entries.append({
+            "module": name.strip(),
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+            "depth": depth,
+        })
+    return entries
+
+
+def report(module: str, budget_ms: float, top: int) -> bool:
+    entries = run_importtime(module)
+    # Depth 0 entries are imported directly by the interpreter; their
+    # cumulative times add up to the whole import.
+    total_ms = sum(e["cumulative_ms"] for e in entries if e["depth"] == 0)
+    imported = {e["module"].split(".")[0] for e in entries}
+    leaked = [m for m in DEFERRED_MODULES if m in imported]
+
+    print(f"Import profile for '{module}': {total_ms:.1f} ms total, {len(entries)} modules")
+    print(f"\nTop {top} by cumulative time:")
+    for e in sorted(entries, key=lambda e: e["cumulative_ms"], reverse=True)[:top]:
+        print(f"  {e['cumulative_ms']:9.1f} ms  {e['module']}")
+    print(f"\nTop {top} by self time:")
+    for e in sorted(entries, key=lambda e: e["self_ms"], reverse=True)[:top]:
+        print(f"  {e['self_ms']:9.1f} ms  {e['module']}")
+
+    ok = True
+    if total_ms > budget_ms:
+        print(f"\nFAIL: import took {total_ms:.1f} ms, budget is {budget_ms:.0f} ms")
+        ok = False
+    if leaked:
+        print(f"\nFAIL: deferred modules imported at startup: {', '.join(leaked)}")
+        ok = False
+    if ok:
+        print(f"\nOK: within {budget_ms:.0f} ms budget, no deferred modules imported")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report import time of the app (like python -X importtime) and enforce a startup budget")
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--budget_ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", DEFAULT_BUDGET_MS)))
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+    sys.exit(0 if report(args.module, args.budget_ms, args.top) else 1)
@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from feedback_stats import RATINGS
+from judge import DEFAULT_BATCH_SIZE, DIMENSIONS, RUBRIC_VERSION, LLMJudge, VerdictStore, conversation_hash
+from log_store import LogStore
+from prompts_and_evaluator import PatientSimulationEvaluator
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def _records(source: str, prefix: str = "conversations_"):
+    """Records from a log directory (<prefix>*.jsonl) or a JSONL file such as a self-play dataset"""
+    if os.path.isdir(source):
+        store = LogStore(source, prefix)
+        chunks = (b"".join(store.read_range(entry, 0, entry["raw_size"])) for entry in store.days())
+    else:
+        with open(source, "rb") as f:
+            chunks = [f.read()]
+    for chunk in chunks:
+        for line in chunk.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get("conversation_id"):
+                yield record
+
+
+def load_conversations(sources: List[str], min_turns: int, limit: Optional[int]) -> List[Dict]:
+    conversations = defaultdict(list)
+    for source in sources:
+        for record in _records(source):
+            conversations[record["conversation_id"]].append(record)
+
+    loaded = []
+    for conversation_id, records in conversations.items():
+        records.sort(key=lambda r: r.get("timestamp", ""))
+        turns = [
+            {"doctor": r["doctor_message"], "patient": r["patient_response"]}
+            for r in records if r.get("doctor_message") and r.get("patient_response")
+        ]
+        if len(turns) < min_turns:
+            continue
+        loaded.append({
+            "conversation_id": conversation_id,
+            "condition": records[0].get("condition"),
+            "personality_type": records[0].get("personality_type"),
+            "model_name": records[-1].get("model_name") or "unknown",  # as in feedback_stats and analytics
+            "turns": turns,
+        })
+    loaded.sort(key=lambda c: c["conversation_id"])
+    return loaded[:limit] if limit else loaded
+
+
+def load_human_ratings(feedback_dir: str) -> Dict[str, Dict[str, float]]:
+    """Feedback ratings by conversation id (the mean when a conversation was rated more than once)"""
+    ratings = defaultdict(lambda: defaultdict(list))
+    for record in _records(feedback_dir, "feedback_") if os.path.isdir(feedback_dir) else []:
+        for name in RATINGS:
+            try:
+                value = int(record.get(name))
+            except (TypeError, ValueError):
+                continue
+            ratings[record["conversation_id"]][name[:-len("_rating")]].append(value)
+    return {cid: {name: sum(v) / len(v) for name, v in dims.items()} for cid, dims in ratings.items()}
+
+
+def _correlation(pairs) -> Optional[float]:
+    if len(pairs) < 3:
+        return None
+    x, y = np.array(pairs, dtype=float).T
+    if x.std() == 0 or y.std() == 0:
+        return None
+    return round(float(np.corrcoef(x, y)[0, 1]), 3)
+
+
+def summarize(conversations: List[Dict], verdicts: Dict[str, Dict], human: Dict[str, Dict]) -> Dict:
+    heuristic = PatientSimulationEvaluator()
+    groups = defaultdict(list)
+    agreement = defaultdict(list)
+    for conversation in conversations:
+        verdict = verdicts.get(conversation_hash(conversation))
+        if verdict is None:
+            continue
+        for key in ("all", f"model:{conversation['model_name']}", f"condition:{conversation['condition']}"):
+            groups[key].append(verdict)
+        rated = human.get(conversation["conversation_id"])
+        if not rated:
+            continue
+        for name in DIMENSIONS:
+            if name in rated:
+                agreement[name].append((verdict["scores"][name], rated[name]))
+        human_overall = sum(rated.values()) / len(rated)
+        agreement["overall"].append((verdict["overall"], human_overall))
+        evaluation = heuristic.evaluate_conversation({"messages": conversation["turns"]}, None)
+        agreement["heuristic_overall"].append((evaluation["overall_score"], human_overall))
+
+    return {
+        "groups": {
+            key: dict(
+                conversations=len(group),
+                overall=round(sum(v["overall"] for v in group) / len(group), 3),
+                **{name: round(sum(v["scores"][name] for v in group) / len(group), 3) for name in DIMENSIONS},
+            )
+            for key, group in sorted(groups.items())
+        },
+        # Pearson correlation with the human ratings of the same conversations
+        "human_agreement": {name: {"pairs": len(pairs), "r": _correlation(pairs)} for name, pairs in agreement.items()},
+    }
+
+
+def _report(progress: Dict):
+    print(
+        f"[Judge] batch {progress['batches_done']}/{progress['batches']}: {progress['judged']} judged, "
+        f"{progress['failed']} failed, {progress['calls']} calls, {progress['elapsed_seconds']}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score conversations with a judge model, reusing cached verdicts")
+    parser.add_argument("--inputs", nargs="+", default=[os.path.join(ROOT_DIR, "logs")], help="Log directories and/or conversation JSONL files (e.g. datasets/selfplay_0.jsonl)")
+    parser.add_argument("--feedback_dir", default=os.path.join(ROOT_DIR, "feedback_logs"), help="Human ratings to compare the verdicts with")
+    parser.add_argument("--model", default=None, help="Judge model (default: MODEL_NAME in app.py)")
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help="Conversations per judge call")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate_per_minute", type=float, default=20, help="Judge calls started per minute")
+    parser.add_argument("--min_turns", type=int, default=2)
+    parser.add_argument("--limit", type=int, default=None, help="Judge only the first N conversations")
+    parser.add_argument("--verdicts", default=os.path.join(ROOT_DIR, "eval_results", "judge_verdicts.jsonl"), help="Verdict cache; rerunning resumes from it")
+    parser.add_argument("--output_dir", default=os.path.join(ROOT_DIR, "eval_results"))
+    parser.add_argument("--mock", action="store_true", help="Use the offline mock judge instead of OpenRouter")
+    args = parser.parse_args()
+
+    if args.mock:
+        from mock_llm import MockLLMClient
+        client = MockLLMClient()
+        get_client = lambda: client
+        model = args.model or "mock-judge"
+    else:
+        import app as app_module
+        if app_module.llm_backend.name == "openrouter" and not os.getenv("OPENROUTER_API_KEY"):
+            parser.error("OPENROUTER_API_KEY is not set (use --mock or another LLM_BACKEND)")
+        get_client = app_module.get_client
+        model = args.model or app_module.MODEL_NAME
+
+    conversations = load_conversations([os.path.abspath(p) for p in args.inputs], args.min_turns, args.limit)
+    if not conversations:
+        parser.error(f"No conversations with at least {args.min_turns} turns in {', '.join(args.inputs)}")
+    store = VerdictStore(args.verdicts)
+    judge = LLMJudge(get_client, model, store, batch_size=args.batch_size, concurrency=args.concurrency, rate_per_minute=args.rate_per_minute)
+    print(f"[Judge] {len(conversations)} conversations, judge {model}, rubric v{RUBRIC_VERSION}, {len(store.verdicts)} cached verdicts")
+
+    started = time.perf_counter()
+    verdicts = judge.judge(conversations, progress=_report)
+    elapsed = time.perf_counter() - started
+    summary = summarize(conversations, verdicts, load_human_ratings(os.path.abspath(args.feedback_dir)))
+
+    stats = judge.stats
+    print(f"\n[Judge] Finished in {elapsed:.1f}s: {stats['judged']} judged, {stats['cached']} from cache, {stats['failed']} failed, "
+          f"{stats['calls']} calls, {stats['prompt_tokens']} prompt + {stats['completion_tokens']} completion tokens\n")
+    columns = [("group", 40), ("conversations", 13), ("overall", 8)] + [(name, max(len(name), 6)) for name in DIMENSIONS]
+    print("  ".join(name.rjust(width) if i else name.ljust(width) for i, (name, width) in enumerate(columns)))
+    for key, group in summary["groups"].items():
+        print("  ".join([key[:40].ljust(40)] + [f"{group[name]:g}".rjust(width) for name, width in columns[1:]]))
+    if summary["human_agreement"]:
+        print("\nAgreement with human ratings (Pearson r):")
+        for name, agreement in summary["human_agreement"].items():
+            print(f"  {name}: r={agreement['r']} over {agreement['pairs']} conversations")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    out_path = os.path.join(args.output_dir, f"judge_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "created": datetime.now().isoformat(),
+            "judge_model": model,
+            "rubric_version": RUBRIC_VERSION,
+            "elapsed_seconds": round(elapsed, 1),
+            "stats": stats,
+            "summary": summary,
+        }, f, indent=2)
+    print(f"\nReport: {out_path}")
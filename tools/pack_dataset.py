@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from analytics import ERROR_PREFIXES
+from dedup import DEFAULT_THRESHOLD, NearDuplicateFilter
+from log_store import LogStore
+from packing import DEFAULT_MAX_SEQ_LEN, DEFAULT_SHARD_SIZE, DEFAULT_WINDOW, SequencePacker, chat_messages, patient_system_prompt
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def _records(source: str):
+    """Records from a log directory (conversations_*.jsonl) or a JSONL file (self-play or sft_*.jsonl)"""
+    if os.path.isdir(source):
+        store = LogStore(source, "conversations_")
+        chunks = (b"".join(store.read_range(entry, 0, entry["raw_size"])) for entry in store.days())
+    else:
+        with open(source, "rb") as f:
+            chunks = [f.read()]
+    for chunk in chunks:
+        for line in chunk.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get("conversation_id"):
+                yield record
+
+
+class SystemPrompts:
+    """
+    The patient prompt each conversation was served with, rebuilt from its
+    condition and persona by the app's simulator. Demographics are the
+    persona's fixed name, age and occupation (as _generate_demographics
+    assigns them), so the rebuilt prompt is the same on every run. The short
+    prompt is used when the condition or persona is no longer in the dataset,
+    when the logged patient name is not the persona's (the served demographics
+    are then unknown), or with full=False.
+    """
+
+    def __init__(self, full: bool):
+        self.simulator = None
+        if full:
+            import app as app_module
+            if app_module.simulator.dataset is not None:
+                self.simulator = app_module.simulator
+        self._cache: Dict[tuple, str] = {}
+
+    def __call__(self, name: Optional[str], condition: Optional[str], personality_type: Optional[str]) -> str:
+        key = (name, condition, personality_type)
+        if key not in self._cache:
+            dataset = self.simulator.dataset if self.simulator else None
+            persona = next((p for p in dataset.personas if p["id"] == personality_type), None) if dataset else None
+            if persona and condition in dataset.disease_names and name in (None, persona["name"]):
+                reference = {
+                    "condition_name": condition, "personality_type": personality_type,
+                    "name": persona["name"], "age": persona["age"], "occupation": persona["occupation"],
+                }
+                self._cache[key] = self.simulator.restore_patient(reference)["prompt_template"]
+            else:
+                self._cache[key] = patient_system_prompt(name, condition)
+        return self._cache[key]
+
+
+def load_samples(sources: List[str], system_prompts: SystemPrompts, min_turns: int) -> Iterator[Dict]:
+    """
+    {conversation_id, messages} per conversation. Chat-format records (from
+    prepare_dataset.py) are used as they are; turn records (app logs,
+    self-play) are grouped by conversation and given their patient prompt.
+    """
+    for source in sources:
+        conversations = defaultdict(list)
+        for record in _records(source):
+            if isinstance(record.get("messages"), list):
+                if sum(1 for m in record["messages"] if m.get("role") == "assistant") >= min_turns:
+                    yield {"conversation_id": record["conversation_id"], "messages": record["messages"]}
+            elif record.get("doctor_message") and record.get("patient_response"):
+                conversations[record["conversation_id"]].append(record)
+
+        for conversation_id, records in conversations.items():
+            records.sort(key=lambda r: r.get("timestamp", ""))
+            # Turns after an error reply answer the error, not the patient: keep what came before
+            turns = []
+            for r in records:
+                if r["patient_response"].startswith(ERROR_PREFIXES):
+                    break
+                turns.append({"doctor": r["doctor_message"], "patient": r["patient_response"]})
+            if len(turns) < min_turns:
+                continue
+            first = records[0]
+            # Older logs store the persona id, self-play records the persona itself
+            persona = first.get("persona") if isinstance(first.get("persona"), dict) else {"id": first.get("persona")}
+            system_prompt = system_prompts(
+                first.get("patient_name") or persona.get("name"), first.get("condition"),
+                first.get("personality_type") or persona.get("id"),
+            )
+            yield {"conversation_id": conversation_id, "messages": chat_messages(system_prompt, turns)}
+
+
+def _patient_text(sample: Dict) -> str:
+    return "\n".join(m["content"] for m in sample["messages"] if m["role"] == "assistant")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export one multi-turn chat sample per conversation, packed into fixed-length, sharded training sequences")
+    parser.add_argument("--inputs", nargs="+", default=[os.path.join(ROOT_DIR, "logs")], help="Log directories and/or JSONL files (self-play datasets, sft_*.jsonl)")
+    parser.add_argument("--out_dir", default=os.path.join(ROOT_DIR, "datasets", "packed"))
+    parser.add_argument("--max_seq_len", type=int, default=DEFAULT_MAX_SEQ_LEN, help="Tokens per packed training sequence")
+    parser.add_argument("--tokenizer", default=None, help="Hugging Face tokenizer directory; writes input_ids/labels/position_ids and counts exact tokens (default: ~4 chars per token)")
+    parser.add_argument("--shard_size", type=int, default=DEFAULT_SHARD_SIZE, help="Packed sequences per shard")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW, help="Samples sorted by length and packed together")
+    parser.add_argument("--min_turns", type=int, default=2)
+    parser.add_argument("--dedup_threshold", type=float, default=DEFAULT_THRESHOLD, help="Near-duplicate similarity threshold (0 disables)")
+    parser.add_argument("--short_system_prompt", action="store_true", help="Use 'You are a patient named X with <condition>.' instead of rebuilding the full patient prompt. "
+                        "The full prompt uses the persona's fixed demographics, so it is the same on every run; conversations whose "
+                        "condition or persona is gone, or whose patient name is not the persona's, always get the short prompt")
+    args = parser.parse_args()
+
+    tokenizer = None
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    samples = load_samples([os.path.abspath(p) for p in args.inputs], SystemPrompts(not args.short_system_prompt), args.min_turns)
+    if args.dedup_threshold:
+        near_duplicates = NearDuplicateFilter(threshold=args.dedup_threshold)
+        samples = near_duplicates.filter(samples, key=lambda s: s["conversation_id"], text=_patient_text)
+
+    started = time.perf_counter()
+    packer = SequencePacker(args.out_dir, max_seq_len=args.max_seq_len, tokenizer=tokenizer, shard_size=args.shard_size, window=args.window)
+    for sample in samples:
+        packer.add(sample["conversation_id"], sample["messages"])
+    manifest = packer.close()
+    elapsed = time.perf_counter() - started
+    if args.dedup_threshold:
+        report = near_duplicates.write_report(os.path.join(args.out_dir, "dedup_report.json"))
+        print(f"Dedup (threshold {args.dedup_threshold}): kept {report['kept']}, dropped {report['dropped']} near-duplicate conversations")
+
+    if not manifest["conversations"]:
+        parser.error(f"No conversations with at least {args.min_turns} turns in {', '.join(args.inputs)}")
+    print(
+        f"Packed {manifest['conversations']} conversations ({manifest['samples']} samples, {manifest['split_conversations']} split) "
+        f"into {manifest['packs']} sequences of {args.max_seq_len} tokens in {len(manifest['shards'])} shards, {elapsed:.1f}s"
+    )
+    print(
+        f"{manifest['tokens']} tokens ({manifest['tokenizer']}), fill {manifest['fill']}; "
+        f"the per-turn export would be ~{manifest['per_turn_tokens']} tokens"
+    )
+    if manifest["oversize_samples"]:
+        print(f"{manifest['oversize_samples']} samples (system prompt and one turn) exceed {args.max_seq_len} tokens and will be truncated")
+    print(f"Manifest: {os.path.join(args.out_dir, 'manifest.json')}")
@@ -3,9 +3,14 @@ import json
 import os
 import random
 import re
+import sys
 import unicodedata
 from typing import Dict, List
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dedup import DEFAULT_THRESHOLD, NearDuplicateFilter
+
 
 def _clean_system_prompt(text: str) -> str:
     text = _normalize_unicode(text)
@@ -102,11 +107,24 @@ def _normalize_symptoms(symptoms: List[str]) -> List[str]:
     return result[:20]
 
 
-def prepare_dataset(input_path: str, out_dir: str, val_ratio: float = 0.05, seed: int = 42, preserve_formatting: bool = True, output_suffix: str = ""):
+def _assistant_text(conv: Dict) -> str:
+    return "\n".join(m.get("content") or "" for m in conv.get("messages", []) if m.get("role") == "assistant")
+
+
+def prepare_dataset(input_path: str, out_dir: str, val_ratio: float = 0.05, seed: int = 42, preserve_formatting: bool = True, output_suffix: str = "", dedup_threshold: float = DEFAULT_THRESHOLD):
     os.makedirs(out_dir, exist_ok=True)
     with open(input_path, "r", encoding="utf-8") as f:
         conversations = json.load(f)
 
+    suffix = output_suffix or ("_strict" if preserve_formatting else "")
+
+    # Drop near-duplicate conversations before the split so copies can't land in both train and val
+    if dedup_threshold:
+        near_duplicates = NearDuplicateFilter(threshold=dedup_threshold)
+        conversations = list(near_duplicates.filter(conversations, key=lambda c: c.get("conversation_id"), text=_assistant_text))
+        report = near_duplicates.write_report(os.path.join(out_dir, f"dedup_report{suffix}.json"))
+        print(f"Dedup (threshold {dedup_threshold}): kept {report['kept']}, dropped {report['dropped']} near-duplicate conversations")
+
     # Shuffle conversation_ids for split
     random.seed(seed)
     ids = [c.get("conversation_id") for c in conversations]
@@ -114,7 +132,6 @@ def prepare_dataset(input_path: str, out_dir: str, val_ratio: float = 0.05, seed
     val_cut = max(1, int(len(ids) * val_ratio))
     val_ids = set(ids[:val_cut])
 
-    suffix = output_suffix or ("_strict" if preserve_formatting else "")
     train_out = open(os.path.join(out_dir, f"sft_train{suffix}.jsonl"), "w", encoding="utf-8")
     val_out = open(os.path.join(out_dir, f"sft_val{suffix}.jsonl"), "w", encoding="utf-8")
     all_out = open(os.path.join(out_dir, f"sft_all{suffix}.jsonl"), "w", encoding="utf-8")
@@ -181,6 +198,7 @@ if __name__ == "__main__":
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--preserve_formatting", action="store_true", help="Keep bold/quotes and original system rules")
     parser.add_argument("--output_suffix", default="", help="Suffix for output filenames (e.g., _strict)")
+    parser.add_argument("--dedup_threshold", type=float, default=DEFAULT_THRESHOLD, help="Estimated Jaccard similarity of patient turns above which a conversation is dropped (0 disables)")
     args = parser.parse_args()
 
     input_path = os.path.abspath(args.input)
@@ -192,6 +210,7 @@ if __name__ == "__main__":
         args.seed,
         preserve_formatting=bool(args.preserve_formatting),
         output_suffix=args.output_suffix,
+        dedup_threshold=args.dedup_threshold,
     )
 
 
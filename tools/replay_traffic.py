@@ -0,0 +1,349 @@
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from html import unescape
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from log_store import LogStore
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Mock LLM latency when the logs hold too few recorded latencies (lognormal, median ~1.2s)
+MIN_RECORDED_LATENCIES = 20
+DEFAULT_LATENCY_MEDIAN_MS = 1200
+DEFAULT_LATENCY_SIGMA = 0.5
+# Regression gate: a metric fails when it is this much worse than the baseline...
+DEFAULT_MAX_REGRESSION = 0.2
+# ...and worse by at least this many ms (keeps sub-millisecond noise from failing the gate)
+DEFAULT_MIN_DELTA_MS = 2.0
+GATED_METRICS = ["latency_p50", "latency_p90", "cpu_mean", "cpu_p90"]
+
+_SERVER_TIMING_RE = re.compile(r"(\w+);dur=([\d.]+)")
+
+
+# ---------------- GOLDEN TRAFFIC ----------------
+def load_sessions(logs_dir: str, limit: Optional[int] = None) -> List[Dict]:
+    """Conversations from the logs, oldest first: condition, persona and timestamped doctor turns"""
+    store = LogStore(logs_dir, "conversations_")
+    sessions = {}
+    for entry in sorted(store.days(), key=lambda e: e["day"]):
+        data = b"".join(store.read_range(entry, 0, entry["raw_size"]))
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+                timestamp = datetime.fromisoformat(record["timestamp"]).timestamp()
+            except (ValueError, KeyError, TypeError):
+                continue
+            if not record.get("doctor_message") or not record.get("conversation_id"):
+                continue
+            session = sessions.setdefault(record["conversation_id"], {
+                "conversation_id": record["conversation_id"],
+                "condition": record.get("condition"),
+                "personality_type": record.get("personality_type"),
+                "turns": [],
+            })
+            session["turns"].append({
+                "timestamp": timestamp,
+                "message": record["doctor_message"],
+                "latency_ms": record.get("latency_ms"),
+            })
+    ordered = sorted(sessions.values(), key=lambda s: s["turns"][0]["timestamp"])
+    return ordered[:limit] if limit else ordered
+
+
+def schedule(sessions: List[Dict], speed: float, max_gap: float) -> List[Dict]:
+    """
+    Offsets (seconds from the start of the replay) for every session start
+    and every turn, keeping the recorded inter-arrival times divided by
+    `speed`. Idle gaps longer than `max_gap` (overnight, between test days)
+    are cut to `max_gap` first.
+    """
+    planned, clock, previous_start = [], 0.0, None
+    for session in sessions:
+        turns = sorted(session["turns"], key=lambda t: t["timestamp"])
+        start = turns[0]["timestamp"]
+        if previous_start is not None:
+            clock += min(start - previous_start, max_gap) / speed
+        previous_start = start
+        offsets, offset = [], 0.0
+        for i, turn in enumerate(turns):
+            if i:
+                offset += min(turn["timestamp"] - turns[i - 1]["timestamp"], max_gap) / speed
+            offsets.append(offset)
+        planned.append(dict(session, start=clock, turns=[dict(t, offset=o) for t, o in zip(turns, offsets)]))
+    return planned
+
+
+def recorded_latencies(sessions: List[Dict], seed: int) -> List[float]:
+    """LLM latencies (ms) logged with the turns, or a default distribution when there are too few"""
+    values = [t["latency_ms"] for s in sessions for t in s["turns"] if t.get("latency_ms")]
+    if len(values) >= MIN_RECORDED_LATENCIES:
+        return values
+    rng = random.Random(seed)
+    return [round(rng.lognormvariate(math.log(DEFAULT_LATENCY_MEDIAN_MS), DEFAULT_LATENCY_SIGMA), 1) for _ in range(500)]
+
+
+# ---------------- CLIENTS ----------------
+class InProcessClient:
+    """Drives the app through Flask's test client: one cookie jar per session"""
+
+    def __init__(self, app_module):
+        self.app_module = app_module
+        self.client = app_module.app.test_client()
+
+    def request(self, method: str, path: str, body: Optional[Dict] = None):
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.headers.get("Server-Timing", "")
+
+    def conditions(self) -> set:
+        return set(self.app_module.simulator.disease_names)
+
+
+class HTTPClient:
+    """Drives a running app over HTTP (start it with LLM_MOCK=1 SERVER_TIMING=1)"""
+
+    def __init__(self, base_url: str, timeout: float):
+        import requests
+
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.timeout = timeout
+
+    def request(self, method: str, path: str, body: Optional[Dict] = None):
+        response = self.session.request(method, self.base_url + path, json=body, timeout=self.timeout)
+        return response.status_code, response.headers.get("Server-Timing", "")
+
+    def conditions(self) -> set:
+        # /disease_list is an HTML page (templates/disease_list.html)
+        html = self.session.get(self.base_url + "/disease_list", timeout=self.timeout).text
+        return {unescape(name.strip()) for name in re.findall(r'class="disease-name">(.*?)</div>', html, re.S)}
+
+
+# ---------------- REPLAY ----------------
+class Replayer:
+    def __init__(self, make_client, concurrency: int):
+        self.make_client = make_client
+        self.concurrency = concurrency
+        self.samples = defaultdict(list)
+        self.lag = []
+        self._conditions = None
+        self._lock = threading.Lock()
+
+    def known_conditions(self, client) -> set:
+        with self._lock:
+            if self._conditions is None:
+                self._conditions = client.conditions()
+            return self._conditions
+
+    def _timed(self, client, endpoint: str, method: str, path: str, body: Optional[Dict] = None) -> bool:
+        started = time.perf_counter()
+        try:
+            status, server_timing = client.request(method, path, body)
+        except Exception as e:
+            print(f"[Replay] {endpoint} failed: {e}")
+            status, server_timing = 0, ""
+        wall_ms = (time.perf_counter() - started) * 1000
+        timing = {name: float(value) for name, value in _SERVER_TIMING_RE.findall(server_timing)}
+        with self._lock:
+            self.samples[endpoint].append({"wall_ms": wall_ms, "cpu_ms": timing.get("cpu"), "status": status})
+        return 200 <= status < 300
+
+    def _run_session(self, session: Dict, t0: float):
+        self._wait_until(t0 + session["start"])
+        client = self.make_client()
+        body = {"condition": session["condition"], "personality_type": session["personality_type"]}
+        if session["condition"] not in self.known_conditions(client):
+            # Logged before the condition left the dataset: replay it on a random case
+            body.pop("condition")
+        if not self._timed(client, "new_patient", "POST", "/new_patient", body):
+            return
+        session_start = time.perf_counter()
+        for turn in session["turns"]:
+            # Closed loop: a turn goes out at its recorded offset, but never before the previous reply
+            self._wait_until(session_start + turn["offset"])
+            self._timed(client, "send_message", "POST", "/send_message", {"message": turn["message"]})
+
+    def _wait_until(self, when: float):
+        delay = when - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            with self._lock:
+                self.lag.append(-delay * 1000)
+
+    def run(self, sessions: List[Dict]) -> float:
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for future in [pool.submit(self._run_session, s, t0) for s in sessions]:
+                future.result()
+        return time.perf_counter() - t0
+
+
+# ---------------- REPORT ----------------
+def _percentile(values: List[float], q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))], 2)
+
+
+def summarize(samples: Dict[str, List[Dict]]) -> Dict[str, Dict]:
+    summary = {}
+    for endpoint, rows in sorted(samples.items()):
+        ok = [r for r in rows if 200 <= r["status"] < 300]
+        walls = [r["wall_ms"] for r in ok]
+        cpus = [r["cpu_ms"] for r in ok if r["cpu_ms"] is not None]
+        summary[endpoint] = {
+            "requests": len(rows),
+            "errors": len(rows) - len(ok),
+            "statuses": dict(sorted(Counter(str(r["status"]) for r in rows).items())),
+            "latency_p50": _percentile(walls, 50),
+            "latency_p90": _percentile(walls, 90),
+            "latency_p99": _percentile(walls, 99),
+            "cpu_mean": round(sum(cpus) / len(cpus), 2) if cpus else None,
+            "cpu_p90": _percentile(cpus, 90),
+        }
+    return summary
+
+
+def compare(summary: Dict, baseline: Dict, max_regression: float, min_delta_ms: float) -> List[str]:
+    """Regressions against the baseline summary, as readable lines (empty = pass)"""
+    failures = []
+    for endpoint, base in baseline.items():
+        current = summary.get(endpoint)
+        if current is None:
+            failures.append(f"{endpoint}: not exercised in this run")
+            continue
+        if current["errors"] > base["errors"]:
+            failures.append(f"{endpoint}: {current['errors']} errors (baseline {base['errors']})")
+        for metric in GATED_METRICS:
+            before, after = base.get(metric), current.get(metric)
+            if before is None or after is None:
+                continue
+            if after - before > max(before * max_regression, min_delta_ms):
+                failures.append(f"{endpoint} {metric}: {after:.2f}ms vs baseline {before:.2f}ms (+{(after / before - 1) * 100 if before else float('inf'):.0f}%)")
+    return failures
+
+
+def print_table(summary: Dict, baseline: Optional[Dict] = None):
+    columns = ["requests", "errors", "latency_p50", "latency_p90", "latency_p99", "cpu_mean", "cpu_p90"]
+    print("endpoint".ljust(14) + "".join(c.rjust(13) for c in columns))
+    for endpoint, row in summary.items():
+        print(endpoint.ljust(14) + "".join(("-" if row[c] is None else str(row[c])).rjust(13) for c in columns))
+        base = (baseline or {}).get(endpoint)
+        if base:
+            print("  baseline".ljust(14) + "".join(("-" if base.get(c) is None else str(base[c])).rjust(13) for c in columns))
+
+
+def _in_process_app(latencies: List[float], work_dir: str, rate_per_minute: float):
+    """Import the app with the mock LLM and every log, cache and usage file redirected to work_dir"""
+    import app as app_module
+    from admission import AdmissionController
+    from mock_llm import MockLLMClient
+    from shared_cache import SharedCache
+
+    app_module._client = MockLLMClient([ms / 1000 for ms in latencies])
+    app_module.app.config["SERVER_TIMING"] = True
+    app_module.conversation_logs = LogStore(os.path.join(work_dir, "logs"), "conversations_")
+    app_module.feedback_logs = LogStore(os.path.join(work_dir, "feedback_logs"), "feedback_")
+    app_module.usage_accountant.store = LogStore(os.path.join(work_dir, "usage_logs"), "usage_")
+    app_module.response_cache = SharedCache(os.path.join(work_dir, "cache.sqlite3"), "llm")
+    # The provider quota doesn't apply to the mock; concurrency and queueing limits stay as configured
+    app_module.admission_controller = AdmissionController(rate_per_minute=rate_per_minute, burst=max(rate_per_minute / 60, 1))
+    return app_module
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded doctor traffic against the app with a mock LLM and gate on performance regressions")
+    parser.add_argument("--logs_dir", default=os.path.join(ROOT_DIR, "logs"))
+    parser.add_argument("--url", default=None, help="Replay against a running app (started with LLM_MOCK=1 SERVER_TIMING=1) instead of in-process")
+    parser.add_argument("--sessions", type=int, default=None, help="Replay only the first N conversations")
+    parser.add_argument("--speed", type=float, default=10.0, help="Time compression factor for inter-arrival times (1 = real time)")
+    parser.add_argument("--max_gap", type=float, default=60.0, help="Cap (recorded seconds) on idle gaps before compression")
+    parser.add_argument("--latency_scale", type=float, default=1.0, help="Multiply the sampled mock LLM latencies")
+    parser.add_argument("--concurrency", type=int, default=64, help="Maximum conversations in flight")
+    parser.add_argument("--llm_rate_per_minute", type=float, default=6000, help="Admission-control rate limit for the in-process run (the provider quota does not apply to the mock)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="HTTP timeout per request (--url)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=None, help="Baseline report to compare with; exits 1 on regressions")
+    parser.add_argument("--save_baseline", default=None, help="Write this run's summary as the new baseline")
+    parser.add_argument("--max_regression", type=float, default=DEFAULT_MAX_REGRESSION, help="Allowed relative slowdown per metric (0.2 = 20%%)")
+    parser.add_argument("--min_delta_ms", type=float, default=DEFAULT_MIN_DELTA_MS, help="Ignore slowdowns smaller than this")
+    parser.add_argument("--output_dir", default=os.path.join(ROOT_DIR, "replay_results"))
+    parser.add_argument("--export_latencies", default=None, help="Write the mock latency distribution (ms) for LLM_MOCK_LATENCIES and exit")
+    args = parser.parse_args()
+
+    sessions = load_sessions(os.path.abspath(args.logs_dir), args.sessions)
+    if not sessions:
+        parser.error(f"No conversations found in {args.logs_dir}")
+    planned = schedule(sessions, args.speed, args.max_gap)
+    latencies = [ms * args.latency_scale for ms in recorded_latencies(sessions, args.seed)]
+    if args.export_latencies:
+        with open(args.export_latencies, "w", encoding="utf-8") as f:
+            json.dump(latencies, f)
+        print(f"[Replay] Wrote {len(latencies)} latencies to {args.export_latencies}")
+        sys.exit(0)
+    turns = sum(len(s["turns"]) for s in planned)
+    duration = max(s["start"] + s["turns"][-1]["offset"] for s in planned)
+    print(f"[Replay] {len(planned)} conversations, {turns} turns over ~{duration:.0f}s (speed x{args.speed:g}), "
+          f"mock LLM latency median {sorted(latencies)[len(latencies) // 2]:.0f}ms")
+
+    if args.url:
+        make_client = lambda: HTTPClient(args.url, args.timeout)
+        work_dir = None
+    else:
+        work_dir = tempfile.mkdtemp(prefix="replay_")
+        app_module = _in_process_app(latencies, work_dir, args.llm_rate_per_minute)
+        make_client = lambda: InProcessClient(app_module)
+
+    replayer = Replayer(make_client, args.concurrency)
+    elapsed = replayer.run(planned)
+    summary = summarize(replayer.samples)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["summary"]
+    print(f"\n[Replay] Finished in {elapsed:.1f}s; schedule lag p90 {_percentile(replayer.lag, 90) or 0:.0f}ms\n")
+    print_table(summary, baseline)
+
+    report = {
+        "created": datetime.now().isoformat(),
+        "mode": "http" if args.url else "in_process",
+        "speed": args.speed,
+        "conversations": len(planned),
+        "turns": turns,
+        "elapsed_seconds": round(elapsed, 1),
+        "schedule_lag_p90_ms": _percentile(replayer.lag, 90),
+        "summary": summary,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    out_path = os.path.join(args.output_dir, f"replay_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport: {out_path}")
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if baseline is not None:
+        failures = compare(summary, baseline, args.max_regression, args.min_delta_ms)
+        if failures:
+            print("\nPerformance regressions:")
+            for failure in failures:
+                print(f"  - {failure}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
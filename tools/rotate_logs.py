@@ -0,0 +1,24 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from log_store import LogStore
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compress closed days of conversation and feedback logs and refresh their manifests")
+    parser.add_argument("--logs_dir", default=os.path.join(ROOT_DIR, "logs"))
+    parser.add_argument("--feedback_dir", default=os.path.join(ROOT_DIR, "feedback_logs"))
+    args = parser.parse_args()
+
+    for directory, prefix in ((args.logs_dir, "conversations_"), (args.feedback_dir, "feedback_")):
+        store = LogStore(os.path.abspath(directory), prefix)
+        rotated = store.rotate()
+        days = store.days()
+        raw = sum(d["raw_size"] for d in days)
+        on_disk = sum(d["compressed_size"] if d["compressed"] else d["raw_size"] for d in days)
+        print(f"{store.directory}: {len(days)} day(s), {len(rotated)} newly compressed, {raw} bytes of JSONL stored in {on_disk} bytes")
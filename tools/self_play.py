@@ -0,0 +1,65 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from self_play import LLMDoctor, ScriptedDoctor, SelfPlayEngine
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def _report(stats):
+    print(
+        f"[SelfPlay] {stats['done']}/{stats['total']} done, {stats['conversations']} written "
+        f"({stats['turns']} turns, {stats['errors']} failed), {stats['conversations_per_hour']} conversations/hour"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic consultations by pairing a doctor agent with the patient simulator")
+    parser.add_argument("--conversations", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--doctor", choices=["scripted", "llm"], default="scripted")
+    parser.add_argument("--doctor_model", default=None, help="Model for --doctor llm (default: the patient model)")
+    parser.add_argument("--model", default=None, help="Patient model (default: MODEL_NAME in app.py)")
+    parser.add_argument("--max_turns", type=int, default=12)
+    parser.add_argument("--accuracy", type=float, default=0.8, help="Share of scripted doctors whose first diagnosis is right")
+    parser.add_argument("--seed", type=int, default=0, help="Run seed; rerunning with the same seed resumes from the checkpoint")
+    parser.add_argument("--output", default=None, help="Output JSONL (default: datasets/selfplay_<seed>.jsonl)")
+    parser.add_argument("--mock", action="store_true", help="Use the offline mock LLM instead of OpenRouter")
+    parser.add_argument("--mock_latency", type=float, default=0.0, help="Seconds of simulated latency per mock call")
+    args = parser.parse_args()
+
+    import app as app_module
+
+    # Every conversation must be generated, not replayed from the response
+    # cache or reused from a paraphrased question
+    app_module.LLM_CACHE_TTL = 0
+    app_module.semantic_cache.threshold = 0
+    if args.mock:
+        from mock_llm import MockLLMClient
+        app_module._client = MockLLMClient(latency=args.mock_latency)
+        # Mock calls cost nothing; keep them out of usage_logs/
+        app_module.usage_accountant.enabled = False
+    elif app_module.llm_backend.name == "openrouter" and not os.getenv("OPENROUTER_API_KEY"):
+        parser.error("OPENROUTER_API_KEY is not set (use --mock or another LLM_BACKEND)")
+    if app_module.simulator.dataset is None:
+        parser.error("Patient dataset could not be loaded")
+
+    model = args.model or app_module.MODEL_NAME
+    if args.doctor == "llm":
+        doctor = LLMDoctor(app_module.get_client, args.doctor_model or model)
+    else:
+        doctor = ScriptedDoctor(accuracy=args.accuracy)
+
+    output = os.path.abspath(args.output or os.path.join(ROOT_DIR, "datasets", f"selfplay_{args.seed}.jsonl"))
+    engine = SelfPlayEngine(
+        app_module.simulator, app_module.get_patient_response, doctor, output, model,
+        concurrency=args.concurrency, max_turns=args.max_turns, seed=args.seed,
+    )
+    print(f"[SelfPlay] Writing to {output} ({args.doctor} doctor, patient model {model}{', mock LLM' if args.mock else ''})")
+    stats = engine.run(args.conversations, progress=_report)
+    _report(stats)
+    print(f"[SelfPlay] Diagnosed in {stats['diagnosed']} of {stats['conversations']} conversations; "
+          f"load with DatasetCollector().process_conversation_logs('{output}')")
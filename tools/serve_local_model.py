@@ -0,0 +1,34 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from local_llm import DEFAULT_MAX_BATCH, DEFAULT_MAX_CONTEXT, DEFAULT_MAX_QUEUE, ContinuousBatcher, create_server, load_model
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a local causal LM behind an OpenAI-compatible API with continuous batching")
+    parser.add_argument("--model_dir", required=True, help="Hugging Face model directory (e.g. a model fine-tuned on sft_train.jsonl)")
+    parser.add_argument("--served_model_name", default=None, help="Model name reported to clients (default: the directory name)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--max_batch", type=int, default=DEFAULT_MAX_BATCH, help="Sequences decoded together per step")
+    parser.add_argument("--max_queue", type=int, default=DEFAULT_MAX_QUEUE, help="Waiting requests before 503")
+    parser.add_argument("--max_context", type=int, default=DEFAULT_MAX_CONTEXT, help="Prompt + completion tokens per sequence")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads (default: torch's choice)")
+    args = parser.parse_args()
+
+    from werkzeug.serving import make_server
+
+    model, tokenizer = load_model(args.model_dir, args.threads)
+    name = args.served_model_name or os.path.basename(os.path.normpath(args.model_dir))
+    batcher = ContinuousBatcher(model, tokenizer, max_batch=args.max_batch, max_queue=args.max_queue, max_context=args.max_context)
+    # One process owns the model; request threads only wait on the batcher
+    server = make_server(args.host, args.port, create_server(batcher, name), threaded=True)
+    print(f"[LocalLLM] Serving {name} on http://{args.host}:{args.port}/v1 (max batch {args.max_batch})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batcher.stop()
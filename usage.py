@@ -0,0 +1,272 @@
+# usage.py - Token and cost accounting for LLM calls
+#
+# get_patient_response reports every completed call here with the provider's
+# usage block (prompt/completion tokens) and its latency. The accountant:
+#   - splits prompt tokens into system prompt / history window / current turn
+#     (by character share), to size the context window on measured data
+#   - prices the call (OpenRouter's own cost when returned, else a price table)
+#   - keeps running totals per model, condition and session for today
+#   - buffers the per-call records and flushes them in batches to a LogStore
+#   - compares totals against token/cost budgets and raises alerts at 80% and
+#     100%; with LLM_ENFORCE_BUDGETS=1 exhausted budgets turn requests away
+# Totals are per worker process, like the admission limits.
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from admission import WORKER_COUNT
+
+# Flush buffered records after this many seconds or records
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', '30'))
+USAGE_FLUSH_BATCH = int(os.getenv('USAGE_FLUSH_BATCH', '200'))
+# Sessions with running totals kept in memory (least recently used dropped)
+USAGE_MAX_SESSIONS = int(os.getenv('USAGE_MAX_SESSIONS', '10000'))
+
+# Budgets; 0 means unlimited. Daily budgets are split across gunicorn workers
+# (WORKER_COUNT, the same count admission control splits the rate quota by).
+LLM_DAILY_TOKEN_BUDGET = int(os.getenv('LLM_DAILY_TOKEN_BUDGET', '0')) // WORKER_COUNT
+LLM_DAILY_COST_BUDGET = float(os.getenv('LLM_DAILY_COST_BUDGET', '0')) / WORKER_COUNT
+LLM_SESSION_TOKEN_BUDGET = int(os.getenv('LLM_SESSION_TOKEN_BUDGET', '0'))
+LLM_ENFORCE_BUDGETS = os.getenv('LLM_ENFORCE_BUDGETS', '0') == '1'
+ALERT_LEVELS = (0.8, 1.0)
+RECENT_ALERTS = 50
+
+# USD per million (prompt, completion) tokens; ':free' models cost nothing.
+# Override or extend with LLM_PRICES='{"model": [prompt, completion]}'.
+MODEL_PRICES = {
+    'qwen/qwen-2.5-72b-instruct': (0.12, 0.39),
+    'meta-llama/llama-3.3-70b-instruct': (0.13, 0.40),
+    'deepseek/deepseek-chat-v3-0324': (0.27, 1.10),
+    'google/gemma-3-27b-it': (0.10, 0.20),
+    'mistralai/mistral-small-3.2-24b-instruct': (0.10, 0.30),
+}
+MODEL_PRICES.update({k: tuple(v) for k, v in json.loads(os.getenv('LLM_PRICES', '{}')).items()})
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for calls whose provider returned no usage (~4 chars per token)"""
+    return max(1, len(text) // 4) if text else 0
+
+
+def price(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    if model.endswith(':free'):
+        return 0.0
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+def _new_totals() -> Dict:
+    return {
+        'calls': 0,
+        'errors': 0,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'system_tokens': 0,
+        'history_tokens': 0,
+        'message_tokens': 0,
+        'cost': 0.0,
+        'latency_ms': 0.0,
+        'estimated_calls': 0,
+    }
+
+
+def _add(totals: Dict, record: Dict):
+    totals['calls'] += 1
+    for field in ('prompt_tokens', 'completion_tokens', 'system_tokens', 'history_tokens', 'message_tokens', 'cost', 'latency_ms'):
+        totals[field] += record[field]
+    totals['estimated_calls'] += int(record['estimated'])
+
+
+def _summary(totals: Dict) -> Dict:
+    calls = totals['calls'] or 1
+    return dict(
+        totals,
+        cost=round(totals['cost'], 6),
+        latency_ms=round(totals['latency_ms'], 1),
+        total_tokens=totals['prompt_tokens'] + totals['completion_tokens'],
+        avg_prompt_tokens=round(totals['prompt_tokens'] / calls, 1),
+        avg_completion_tokens=round(totals['completion_tokens'] / calls, 1),
+        avg_latency_ms=round(totals['latency_ms'] / calls, 1),
+    )
+
+
+class UsageAccountant:
+    def __init__(self, store=None, submit: Optional[Callable] = None):
+        self.store = store
+        self.submit = submit  # runs the flush off the request thread (AsyncLogWriter.submit)
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._buffer: List[Dict] = []
+        self._last_flush = time.monotonic()
+        self.alerts = deque(maxlen=RECENT_ALERTS)
+        self._reset_day(datetime.now().strftime('%Y%m%d'))
+
+    def _reset_day(self, day: str):
+        self.day = day
+        self.total = _new_totals()
+        self.by_model: Dict[str, Dict] = {}
+        self.by_condition: Dict[str, Dict] = {}
+        self.by_session: 'OrderedDict[str, Dict]' = OrderedDict()
+        self._alerted = set()
+
+    # ---------------- RECORD ----------------
+    def record(self, model: str, usage, latency_ms: float, conversation_id: Optional[str] = None,
+               condition: Optional[str] = None, prompt_parts: Optional[Dict[str, str]] = None, completion: str = ''):
+        """
+        Account one completed call. `usage` is the provider's usage block (or
+        None); `prompt_parts` maps 'system'/'history'/'message' to the text
+        sent for each, used to split the prompt tokens.
+        """
+        if not self.enabled:
+            return
+        prompt_parts = prompt_parts or {}
+        prompt_tokens = getattr(usage, 'prompt_tokens', None) if usage is not None else None
+        completion_tokens = getattr(usage, 'completion_tokens', None) if usage is not None else None
+        estimated = prompt_tokens is None or completion_tokens is None
+        if estimated:
+            prompt_tokens = sum(estimate_tokens(t) for t in prompt_parts.values())
+            completion_tokens = estimate_tokens(completion)
+
+        # Split prompt tokens by each part's share of the prompt text
+        chars = {part: len(prompt_parts.get(part, '')) for part in ('system', 'history', 'message')}
+        total_chars = sum(chars.values()) or 1
+        split = {part: round(prompt_tokens * n / total_chars) for part, n in chars.items()}
+        provider_cost = getattr(usage, 'cost', None) if usage is not None else None
+
+        record = {
+            'timestamp': datetime.now().isoformat(),
+            'conversation_id': conversation_id,
+            'model': model,
+            'condition': condition,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'system_tokens': split['system'],
+            'history_tokens': split['history'],
+            'message_tokens': split['message'],
+            'cost': float(provider_cost) if provider_cost is not None else price(model, prompt_tokens, completion_tokens),
+            'latency_ms': round(latency_ms, 1),
+            'estimated': estimated,
+        }
+
+        with self._lock:
+            day = record['timestamp'][:10].replace('-', '')
+            if day != self.day:
+                self._reset_day(day)
+            _add(self.total, record)
+            _add(self.by_model.setdefault(model, _new_totals()), record)
+            if condition:
+                _add(self.by_condition.setdefault(condition, _new_totals()), record)
+            if conversation_id:
+                session = self.by_session.get(conversation_id)
+                if session is None:
+                    session = self.by_session[conversation_id] = _new_totals()
+                    while len(self.by_session) > USAGE_MAX_SESSIONS:
+                        self.by_session.popitem(last=False)
+                else:
+                    self.by_session.move_to_end(conversation_id)
+                _add(session, record)
+            self._buffer.append(record)
+            alerts = self._check_budgets(conversation_id)
+            self._buffer.extend(alerts)
+            due = len(self._buffer) >= USAGE_FLUSH_BATCH or time.monotonic() - self._last_flush >= USAGE_FLUSH_INTERVAL
+        for alert in alerts:
+            print(f"[Usage] {alert['level'].upper()}: {alert['message']}")
+        if due:
+            self.flush(background=True)
+
+    def record_error(self, model: str):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.total['errors'] += 1
+            self.by_model.setdefault(model, _new_totals())['errors'] += 1
+
+    # ---------------- BUDGETS ----------------
+    def _budgets(self, conversation_id: Optional[str]) -> List[tuple]:
+        """(name, used, limit) for every configured budget"""
+        budgets = []
+        if LLM_DAILY_TOKEN_BUDGET:
+            budgets.append(('daily_tokens', self.total['prompt_tokens'] + self.total['completion_tokens'], LLM_DAILY_TOKEN_BUDGET))
+        if LLM_DAILY_COST_BUDGET:
+            budgets.append(('daily_cost', self.total['cost'], LLM_DAILY_COST_BUDGET))
+        if LLM_SESSION_TOKEN_BUDGET and conversation_id in self.by_session:
+            session = self.by_session[conversation_id]
+            budgets.append((f'session_tokens:{conversation_id}', session['prompt_tokens'] + session['completion_tokens'], LLM_SESSION_TOKEN_BUDGET))
+        return budgets
+
+    def _check_budgets(self, conversation_id: Optional[str]) -> List[Dict]:
+        alerts = []
+        for name, used, limit in self._budgets(conversation_id):
+            for level in ALERT_LEVELS:
+                if used >= limit * level and (name, level) not in self._alerted:
+                    self._alerted.add((name, level))
+                    alert = {
+                        'type': 'alert',
+                        'timestamp': datetime.now().isoformat(),
+                        'level': 'exceeded' if level >= 1.0 else 'warning',
+                        'budget': name,
+                        'used': round(used, 6),
+                        'limit': limit,
+                        'message': f"{name} at {used / limit:.0%} of budget ({round(used, 4)} / {limit})",
+                    }
+                    alerts.append(alert)
+                    self.alerts.append(alert)
+        return alerts
+
+    def over_budget(self, conversation_id: Optional[str] = None) -> Optional[tuple]:
+        """
+        (reason, retry_after_seconds) when an enforced budget is exhausted,
+        otherwise None. Only active with LLM_ENFORCE_BUDGETS=1.
+        """
+        if not LLM_ENFORCE_BUDGETS or not self.enabled:
+            return None
+        with self._lock:
+            for name, used, limit in self._budgets(conversation_id):
+                if used >= limit:
+                    if name.startswith('session'):
+                        return 'This conversation has used its token budget. Please start a new patient.', 60
+                    tomorrow = (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+                    return 'The daily LLM budget has been used up. Please try again tomorrow.', (tomorrow - datetime.now()).total_seconds()
+        return None
+
+    # ---------------- FLUSH ----------------
+    def flush(self, background: bool = False):
+        """Write buffered records (and alerts) to the usage log store"""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+        if not batch or self.store is None:
+            return
+        if background and self.submit is not None:
+            self.submit(self.store.append_many, batch)
+        else:
+            self.store.append_many(batch)
+
+    # ---------------- STATS ----------------
+    def stats(self, top_sessions: int = 10) -> Dict:
+        with self._lock:
+            sessions = sorted(
+                self.by_session.items(),
+                key=lambda kv: -(kv[1]['prompt_tokens'] + kv[1]['completion_tokens']),
+            )[:top_sessions]
+            return {
+                'day': self.day,
+                'total': _summary(self.total),
+                'models': {model: _summary(t) for model, t in self.by_model.items()},
+                'conditions': {condition: _summary(t) for condition, t in self.by_condition.items()},
+                'top_sessions': {cid: _summary(t) for cid, t in sessions},
+                'sessions_tracked': len(self.by_session),
+                'budgets': {
+                    'daily_tokens': LLM_DAILY_TOKEN_BUDGET or None,
+                    'daily_cost': LLM_DAILY_COST_BUDGET or None,
+                    'session_tokens': LLM_SESSION_TOKEN_BUDGET or None,
+                    'enforced': LLM_ENFORCE_BUDGETS,
+                },
+                'alerts': list(self.alerts),
+                'pending_records': len(self._buffer),
+            }
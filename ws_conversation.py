@@ -0,0 +1,170 @@
+# ws_conversation.py - WebSocket conversation channel with resident per-session state
+#
+# Over HTTP every doctor turn re-parses the cookie session, rebuilds the system
+# prompt and re-creates the message list. A chat page connected to
+# /ws/conversation instead keeps its conversation (patient, history, compiled
+# prompt, model) resident in the worker for the socket's lifetime. Replies are
+# pushed as frames (typing indicator, streamed tokens, actions, final reply) and
+# log writes happen on a background thread.
+#
+# The cookie session stays the source of truth for HTTP requests and for the
+# next socket, which may be served by another worker: every reply frame carries
+# the turn's state, signed by the server, and the page posts it back to
+# /sync_session so the cookie follows the resident copy. The socket is only
+# offered with the gevent worker, where an open connection costs a greenlet
+# rather than a worker thread.
+
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from action_events import ActionStream
+from patient_model import ConversationHistory, Patient
+
+# Conversations kept in memory per worker (least recently used are dropped)
+WS_RESIDENT_CONVERSATIONS = int(os.getenv('WS_RESIDENT_CONVERSATIONS', '1000'))
+# Pending log writes before writers fall back to writing inline
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+
+class ResidentConversation:
+    """Conversation state kept in memory while a socket is connected"""
+
+    def __init__(self, conversation_id: str, patient_data: Patient, history: ConversationHistory, model: str):
+        self.conversation_id = conversation_id
+        self.patient_data = patient_data.copy()
+        self.history = history.copy()
+        self.model = model
+        # Compiled once and shared by every conversation with the same patient
+        self.prompt_template = self.patient_data.prompt_template
+        self.lock = threading.Lock()  # one turn at a time per conversation
+        self.last_active = time.monotonic()
+
+    def snapshot(self) -> Dict:
+        """Session values for the current state (see /sync_session)"""
+        return {
+            'conversation_id': self.conversation_id,
+            'turns': len(self.history),
+            'patient_data': self.patient_data.pack(),
+            'conversation_history': self.history.pack(),
+        }
+
+
+class ResidentConversationStore:
+    """LRU of resident conversations so a reconnecting page picks up where it left off"""
+
+    def __init__(self, capacity: int = WS_RESIDENT_CONVERSATIONS):
+        self.capacity = capacity
+        self._items: 'OrderedDict[str, ResidentConversation]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, conversation_id: str, factory: Callable[[], ResidentConversation]) -> ResidentConversation:
+        with self._lock:
+            conversation = self._items.get(conversation_id)
+            if conversation is None:
+                conversation = self._items[conversation_id] = factory()
+                while len(self._items) > self.capacity:
+                    self._items.popitem(last=False)
+            else:
+                self._items.move_to_end(conversation_id)
+            conversation.last_active = time.monotonic()
+            return conversation
+
+    def discard(self, conversation_id: str):
+        with self._lock:
+            self._items.pop(conversation_id, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SocketPublisher:
+    """Sends JSON frames on a socket; also the event sink for ActionStream"""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self._lock = threading.Lock()
+
+    def send(self, frame: Dict):
+        with self._lock:
+            self.ws.send(json.dumps(frame))
+
+    def publish(self, event_type: str, data: Dict):
+        self.send(dict(data, type=event_type))
+
+
+class SocketStreamHandler:
+    """Stream handler for get_patient_response: pushes tokens, actions and the end signal as frames"""
+
+    def __init__(self, publisher: SocketPublisher, patient_data: Optional[Patient] = None):
+        self.publisher = publisher
+        self.actions = ActionStream(publisher, patient_data)
+
+    def start(self):
+        self.actions.start()
+
+    def feed(self, delta: str):
+        self.publisher.send({'type': 'token', 'reply_id': self.actions.reply_id, 'text': delta})
+        self.actions.feed(delta)
+
+    def end_rule(self, reply: str) -> Optional[str]:
+        return self.actions.end_rule(reply)
+
+    def finish(self, reply: str, **extra):
+        return self.actions.finish(reply, **extra)
+
+
+class AsyncLogWriter:
+    """
+    Runs log writes on a background thread so the socket loop never waits on
+    disk. The thread is started on first use, i.e. inside the worker after any
+    preload fork. When the queue is full the write happens inline.
+    """
+
+    def __init__(self, maxsize: int = LOG_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='async-log-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait((fn, args, kwargs))
+        except queue.Full:
+            fn(*args, **kwargs)
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until every submitted write has been persisted"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def _run(self):
+        while True:
+            fn, args, kwargs = self._queue.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(f"[AsyncLogWriter] Failed to write log entry: {e}")
+            finally:
+                self._queue.task_done()
+
+
+# Global instances
+resident_conversations = ResidentConversationStore()
+async_log_writer = AsyncLogWriter()